@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from goods.models import GoodsSKU
+from cart.utils import load_cart_skus
+
+
+def load_one_by_one(cart_items):
+    """原来的实现: 每个购物车条目查询一次数据库"""
+    skus = []
+    for sku_id, count in cart_items:
+        sku = GoodsSKU.objects.get(id=sku_id)
+        sku.count = int(count)
+        sku.amount = sku.price * int(count)
+        skus.append(sku)
+    return skus
+
+
+class Command(BaseCommand):
+    """购物车商品加载基准测试: 逐条查询 vs 批量查询"""
+    help = '对比购物车为1/10/100条时逐条查询与批量加载的SQL条数和耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1,10,100', help='购物车条目数, 逗号分隔')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        sku_ids = list(GoodsSKU.objects.order_by('id').values_list('id', flat=True)[:max(sizes)])
+        if not sku_ids:
+            raise CommandError('数据库中没有商品')
+
+        for size in sizes:
+            # 商品不够时重复使用
+            cart_items = [(sku_ids[i % len(sku_ids)], 1) for i in range(size)]
+            for name, loader in (('one_by_one', load_one_by_one), ('bulk', load_cart_skus)):
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    loader(cart_items)
+                    elapsed = (time.perf_counter() - start) * 1000
+                self.stdout.write('lines=%-4d %-10s queries=%-4d time=%.2fms' % (
+                    size, name, len(queries), elapsed))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from utils.redis_memory import compact_user_keys
+
+
+class Command(BaseCommand):
+    """统计并回收按用户保存的redis键(购物车, 浏览记录)"""
+    help = '扫描cart_*/history_*键, 统计内存占用, 设置闲置过期时间, 压缩购物车hash编码'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='每次SCAN的键数量')
+        parser.add_argument('--dry-run', action='store_true', help='只统计, 不修改')
+
+    def handle(self, *args, **options):
+        report = compact_user_keys(batch_size=options['batch_size'], dry_run=options['dry_run'])
+
+        for name, stats in report['families'].items():
+            self.stdout.write('%-10s keys=%d bytes=%d active=%d expire_set=%d deleted=%d(%d bytes) '
+                              'rewritten=%d oversized=%d' % (
+                                  name, stats['keys'], stats['bytes'], stats['active_keys'],
+                                  stats['expire_set'], stats['deleted'], stats['deleted_bytes'],
+                                  stats['rewritten'], stats['oversized']))
+        self.stdout.write('活跃用户: %d  内存占用: %d bytes  每个活跃用户: %d bytes%s' % (
+            report['active_users'], report['bytes'], report['bytes_per_active_user'],
+            '  (dry run)' if report['dry_run'] else ''))
@@ -0,0 +1,85 @@
+from django_redis import get_redis_connection
+from goods.models import GoodsSKU
+from goods import stock as stock_mirror
+from utils.redis_scripts import CART_SET, CART_DELETE, CART_ADD, CART_BATCH
+
+
+def cart_keys(user_id):
+    """购物车键和购物车商品总件数键"""
+    return 'cart_%d' % user_id, 'cart_total_%d' % user_id
+
+
+def get_cart_count(user_id):
+    """获取用户购物车内的商品总条目数"""
+    conn = get_redis_connection('default')
+    cart_key, cart_total_key = cart_keys(user_id)
+    return conn.hlen(cart_key)
+
+
+def set_cart_count(user_id, sku_id, count):
+    """
+    设置购物车中商品的数量, 同时更新商品总件数(一次redis往返)
+    :return: (商品总件数, 商品条目数)
+    """
+    total_count, line_count = CART_SET(keys=cart_keys(user_id), args=[sku_id, count])
+    return total_count, line_count
+
+
+def add_cart_sku(user_id, sku_id, count):
+    """
+    添加商品到购物车, 校验库存并累加数量(库存镜像存在时一次redis往返, 不查询数据库)
+    商品不存在时抛出GoodsSKU.DoesNotExist
+    :return: 商品条目数, 库存不足返回None
+    """
+    keys = cart_keys(user_id) + (stock_mirror.STOCK_KEY,)
+    status, line_count = CART_ADD(keys=keys, args=[sku_id, count, ''])
+    if status == 2:
+        # 库存镜像中没有该商品, 从数据库加载
+        stock = stock_mirror.load_stock(sku_id)
+        status, line_count = CART_ADD(keys=keys, args=[sku_id, count, stock])
+
+    if status == 1:
+        return None
+    return line_count
+
+
+def delete_cart_skus(user_id, *sku_ids):
+    """
+    删除购物车中的商品, 同时更新商品总件数(一次redis往返)
+    :return: 商品总件数
+    """
+    return CART_DELETE(keys=cart_keys(user_id), args=sku_ids)
+
+
+def batch_update_cart(user_id, operations):
+    """
+    批量修改购物车(一次redis往返)
+    :param operations: [(商品id, 数量), ...] 数量为0表示删除该商品
+    :return: (商品总件数, 商品条目数)
+    """
+    args = []
+    for sku_id, count in operations:
+        args.extend([sku_id, count])
+    total_count, line_count = CART_BATCH(keys=cart_keys(user_id), args=args)
+    return total_count, line_count
+
+
+def load_cart_skus(cart_items):
+    """
+    一次查询加载购物车中的商品, 按购物车中的顺序返回
+    :param cart_items: [(商品id, 数量), ...]
+    :return: 商品对象列表, 动态增加count(数量)和amount(小计)属性, 已不存在的商品会被跳过
+    """
+    cart_items = [(int(sku_id), int(count)) for sku_id, count in cart_items]
+    skus = GoodsSKU.objects.in_bulk([sku_id for sku_id, count in cart_items])
+
+    result = []
+    for sku_id, count in cart_items:
+        sku = skus.get(sku_id)
+        if sku is None:
+            continue
+        # 动态给sku对象增加属性count和amount, 保存商品数量和小计
+        sku.count = count
+        sku.amount = sku.price * count
+        result.append(sku)
+    return result
@@ -1,9 +1,12 @@
+import json
+
 from django.shortcuts import render
 from django.views.generic import View
 from django.http import JsonResponse
 from goods.models import GoodsSKU
 from django_redis import get_redis_connection
 from utils.mixin import LoginRequiredMixin
+from cart.utils import load_cart_skus, set_cart_count, delete_cart_skus, add_cart_sku, batch_update_cart
 
 
 # 添加商品到购物车
@@ -36,32 +39,17 @@ class CartAddView(View):
             # 数目出错
             return JsonResponse({'res': 2, 'errmsg': '商品数目出错'})
 
-        # 校验商品是否存在
+        # 3.业务处理
+        # 校验商品库存(使用redis库存镜像)并累加购物车商品数目, 一次redis往返
+        # 返回用户购物车中的商品条目
         try:
-            sku = GoodsSKU.objects.get(id=sku_id)
+            total_count = add_cart_sku(user.id, sku_id, count)
         except GoodsSKU.DoesNotExist:
             return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
 
-        # 3.业务处理
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-        # 尝试先获取sku_id的值, --> hget cart_key
-        # 如果获取不到返回None
-        cart_count = conn.hget(cart_key, sku_id)
-        if cart_count:
-            # 累加购物车商品数目
-            count += int(cart_count)
-
-        # 校验商品的库存
-        if count > sku.stock:
+        if total_count is None:
             return JsonResponse({'res': 4, 'errmsg': '库存不足'})
 
-        # 设置hash中sku_id对应的值, 如果sku_id不存在则添加, 存在则更新
-        conn.hset(cart_key, sku_id, count)
-
-        # 统计用户购物车中的商品条目
-        total_count = conn.hlen(cart_key)
-
         # 4.返回响应
         return JsonResponse({'res': 5, 'total_count': total_count, 'errmsg': '添加成功'})
 
@@ -78,26 +66,12 @@ class CartInfoView(LoginRequiredMixin, View):
         # {'商品id': '商品数量'}
         cart_dict = conn.hgetall(cart_key)
 
-        skus = []
-        # 保存用户购物车中商品的总件数，总价格
-        total_count = 0
-        total_price = 0
-        # 遍历获取商品信息
-        for sku_id, count in cart_dict.items():
-            # 根据商品id获取商品数量
-            sku = GoodsSKU.objects.get(id=sku_id)
-            # 计算商品的小计
-            amount = sku.price*int(count)
-            # 动态给sku对象增加一个属性amount, 保存商品小计
-            sku.amount = amount
-            # 动态给sku对象增加一个属性count, 保存商品数量
-            sku.count = count
-            # 添加商品对象
-            skus.append(sku)
-
-            # 累加计算商品总件数和总价格
-            total_count += int(count)
-            total_price += amount
+        # 一次查询获取购物车中所有商品的信息
+        skus = load_cart_skus(cart_dict.items())
+
+        # 计算用户购物车中商品的总件数，总价格
+        total_count = sum(sku.count for sku in skus)
+        total_price = sum(sku.amount for sku in skus)
 
         # 组织上下文
         context = {
@@ -141,22 +115,12 @@ class CartUpdateView(View):
         except GoodsSKU.DoesNotExist:
             return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
 
-        # 业务处理：更新购物车记录
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-
         # 校验商品库存
         if count > sku.stock:
             return JsonResponse({'res': 4, 'errmsg': '商品库存不足'})
 
-        # 更新
-        conn.hset(cart_key, sku_id, count)
-
-        # 计算用户购物车种商品总件数
-        vals = conn.hvals(cart_key)
-        total_count = 0
-        for val in vals:
-            total_count += int(val)
+        # 业务处理：更新购物车记录, 同时得到用户购物车中商品总件数(一次redis往返)
+        total_count, line_count = set_cart_count(user.id, sku_id, count)
 
         # 返回应答
         return JsonResponse({'res': 5, 'total_count': total_count, 'ermsg': '更新成功'})
@@ -187,21 +151,56 @@ class CartDeleteView(View):
         except GoodsSKU.DoesNotExist:
             return JsonResponse({'res': 2, 'errmsg': '商品不存在'})
 
-        # 业务处理:删除购物车记录
-        conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-
-        # 删除 hdel
-        conn.hdel(cart_key, sku_id)
-
-        # 计算用户购物车种商品总件数
-        vals = conn.hvals(cart_key)
-        total_count = 0
-        for val in vals:
-            total_count += int(val)
+        # 业务处理:删除购物车记录, 同时得到用户购物车中商品总件数(一次redis往返)
+        total_count = delete_cart_skus(user.id, sku_id)
 
         # 返回应答
         return JsonResponse({'res': 3, 'total_count': total_count, 'errmsg': '删除成功'})
 
 
+# 批量修改购物车记录(例如全选删除, 多个商品同时修改数量)
+# ajax post
+# 前端传递参数：operations, json字符串 [{"sku_id": 商品id, "count": 数量}, {"sku_id": 商品id, "delete": true}, ...]
+class CartBatchView(View):
+    """批量修改购物车记录"""
+    def post(self, request):
+        user = request.user
+        if not user.is_authenticated():
+            # 用户未登录
+            return JsonResponse({'res': 0, 'errmsg': '请先登录'})
 
+        # 接收数据
+        try:
+            operations = json.loads(request.POST.get('operations', ''))
+        except ValueError as e:
+            return JsonResponse({'res': 1, 'errmsg': '数据不完整'})
+
+        if not isinstance(operations, list) or not operations:
+            return JsonResponse({'res': 1, 'errmsg': '数据不完整'})
+
+        # 数据校验, 整理为 {商品id: 数量}, 数量为0表示删除
+        counts = {}
+        try:
+            for operation in operations:
+                sku_id = int(operation['sku_id'])
+                counts[sku_id] = 0 if operation.get('delete') else int(operation['count'])
+                if counts[sku_id] < 0:
+                    raise ValueError
+        except (KeyError, TypeError, ValueError) as e:
+            return JsonResponse({'res': 2, 'errmsg': '商品数目出错'})
+
+        # 一次查询校验商品是否存在, 校验商品库存(删除操作不需要校验)
+        update_ids = [sku_id for sku_id, count in counts.items() if count > 0]
+        stocks = dict(GoodsSKU.objects.filter(id__in=update_ids).values_list('id', 'stock')) if update_ids else {}
+        for sku_id in update_ids:
+            count = counts[sku_id]
+            if sku_id not in stocks:
+                return JsonResponse({'res': 3, 'sku_id': sku_id, 'errmsg': '商品不存在'})
+            if count > stocks[sku_id]:
+                return JsonResponse({'res': 4, 'sku_id': sku_id, 'errmsg': '商品库存不足'})
+
+        # 业务处理：批量更新购物车记录, 同时得到用户购物车中商品总件数和条目数(一次redis往返)
+        total_count, line_count = batch_update_cart(user.id, counts.items())
+
+        # 返回应答
+        return JsonResponse({'res': 5, 'total_count': total_count, 'line_count': line_count, 'errmsg': '更新成功'})
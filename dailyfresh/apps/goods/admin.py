@@ -1,5 +1,4 @@
 from django.contrib import admin
-from django.core.cache import cache
 from goods.models import GoodsType  # 商品类型类
 from goods.models import IndexGoodsBanner  # 首页轮播商品展示模型类
 from goods.models import IndexPromotionBanner  # 首页促销活动模型类
@@ -7,6 +6,7 @@ from goods.models import IndexTypeGoodsBanner  # 首页分类商品展示模型
 from goods.models import GoodsImage  # 商品图片模型类
 from goods.models import Goods  # 商品SKU模型类
 from goods.models import GoodsSKU  # 商品SKU模型类
+from goods.utils import index_page_cache  # 首页缓存
 
 
 
@@ -16,26 +16,26 @@ class BaseModelAdmin(admin.ModelAdmin):
         super().save_model(request, obj, form, change)
 
         # celery_task:是我存放celery_task任务文件tasks.py的目录，与项目其他应用评级
-        from celery_task.tasks import generate_static_index_html
+        from celery_task.tasks import schedule_static_index_html
         
-        # 调用celery任务重新生成静态页面
-        generate_static_index_html.delay()
+        # 请求celery任务重新生成静态页面(短时间内的多次修改合并为一次)
+        schedule_static_index_html()
 
-        # 清除首页的缓存数据
-        cache.delete('index_page_data')
+        # 标记首页的缓存数据过期
+        index_page_cache.invalidate()
 
     def delete_model(self, request, obj):
         """删除表中的数据时调用"""
         super().delete_model(request, obj)
 
         # celery_task:是我存放celery_task任务文件tasks.py的目录，与项目其他应用评级
-        from celery_task.tasks import generate_static_index_html
+        from celery_task.tasks import schedule_static_index_html
 
-        # 调用celery任务重新生成静态页面
-        generate_static_index_html.delay()
+        # 请求celery任务重新生成静态页面(短时间内的多次修改合并为一次)
+        schedule_static_index_html()
 
-        # 清除首页的缓存数据
-        cache.delete('index_page_data')
+        # 标记首页的缓存数据过期
+        index_page_cache.invalidate()
 
 
 # 由于admin.ModelAdmin中的两个方法相同，所以我们定义一个基类，使以下四个类都继承此类
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class GoodsConfig(AppConfig):
+    name = 'goods'
+
+    def ready(self):
+        # 注册信号处理函数
+        import goods.signals
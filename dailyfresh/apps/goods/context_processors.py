@@ -0,0 +1,22 @@
+from django.utils.functional import SimpleLazyObject
+from cart.utils import get_cart_count
+from goods.utils import get_goods_types
+
+
+def header(request):
+    """
+    页面头部公共数据: 购物车商品条目数, 商品分类导航
+    延迟计算, 只有模板用到时才访问redis, 每个请求最多访问一次
+    视图中传入同名变量时以视图为准
+    """
+    def cart_count():
+        user = request.user
+        # 判断用户是否已登录
+        if not user.is_authenticated():
+            return 0
+        return get_cart_count(user.id)
+
+    return {
+        'cart_count': SimpleLazyObject(cart_count),
+        'types': SimpleLazyObject(get_goods_types),
+    }
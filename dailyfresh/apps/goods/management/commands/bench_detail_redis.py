@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+from utils.redis_scripts import RECORD_HISTORY
+
+
+def percentile(values, p):
+    """计算百分位数(values已排序)"""
+    index = min(int(len(values) * p / 100.0), len(values) - 1)
+    return values[index]
+
+
+class Command(BaseCommand):
+    """详情页浏览记录+购物车数目的redis访问基准测试: 逐条命令 vs lua脚本"""
+    help = '对比详情页逐条redis命令与lua脚本的往返次数和延迟'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        conn = get_redis_connection('default')
+        history_key = 'history_bench'
+        cart_key = 'cart_bench'
+        conn.delete(history_key, cart_key)
+        conn.hset(cart_key, 1, 1)
+
+        def commands(goods_id):
+            # 原来的实现: 4次网络往返
+            conn.hlen(cart_key)
+            conn.lrem(history_key, 0, goods_id)
+            conn.lpush(history_key, goods_id)
+            conn.ltrim(history_key, 0, 4)
+
+        def script(goods_id):
+            # lua脚本: 1次网络往返
+            RECORD_HISTORY(keys=[history_key, cart_key], args=[goods_id, 5], conn=conn)
+
+        for name, func, round_trips in (('commands', commands, 4), ('script', script, 1)):
+            timings = []
+            for i in range(iterations):
+                start = time.perf_counter()
+                func(i % 20)
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            self.stdout.write('%-8s round_trips=%d  p50=%.3fms  p99=%.3fms  max=%.3fms' % (
+                name, round_trips, percentile(timings, 50), percentile(timings, 99), timings[-1]))
+
+        conn.delete(history_key, cart_key)
@@ -0,0 +1,84 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import F
+from goods.models import GoodsSKU
+from goods import stock_buckets
+
+
+def order_once(sku_id, sharded, hold):
+    """模拟一次下单事务: 扣减库存后持有行锁hold秒(模拟写订单等操作)"""
+    with transaction.atomic():
+        if sharded:
+            res = stock_buckets.take(sku_id, 1)
+        else:
+            res = GoodsSKU.objects.filter(id=sku_id, stock__gte=1)\
+                .update(stock=F('stock') - 1, sales=F('sales') + 1)
+        if hold:
+            time.sleep(hold)
+    return bool(res)
+
+
+class Command(BaseCommand):
+    """库存分桶基准测试: 多线程并发购买同一个商品, 对比不同分桶数的每秒订单数"""
+    help = '对同一个商品并发扣减库存, 输出不分桶和不同分桶数时的吞吐量(需要使用mysql)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sku_id', type=int, help='测试使用的商品id, 测试结束后恢复库存和销量')
+        parser.add_argument('--buckets', default='0,1,2,4,8,16', help='分桶数, 逗号分隔, 0表示不分桶')
+        parser.add_argument('--threads', type=int, default=16, help='并发线程数')
+        parser.add_argument('--orders', type=int, default=200, help='每个线程的下单次数')
+        parser.add_argument('--hold-ms', type=float, default=2, help='扣减库存后事务持续的时间(毫秒)')
+
+    def handle(self, *args, **options):
+        sku_id = options['sku_id']
+        try:
+            sku = GoodsSKU.objects.get(id=sku_id)
+        except GoodsSKU.DoesNotExist:
+            raise CommandError('商品不存在')
+        if sku.stock_sharded:
+            raise CommandError('请使用没有开启库存分桶的商品')
+
+        threads = options['threads']
+        orders = options['orders']
+        hold = options['hold_ms'] / 1000
+        stock = threads * orders
+
+        try:
+            for buckets in [int(buckets) for buckets in options['buckets'].split(',')]:
+                if buckets:
+                    stock_buckets.enable(sku_id, buckets, stock)
+                else:
+                    GoodsSKU.objects.filter(id=sku_id).update(stock=stock)
+                self._run(sku_id, buckets, threads, orders, hold)
+                if buckets:
+                    stock_buckets.disable(sku_id)
+        finally:
+            # 恢复商品原来的库存和销量
+            stock_buckets.disable(sku_id)
+            GoodsSKU.objects.filter(id=sku_id).update(stock=sku.stock, sales=sku.sales)
+
+    def _run(self, sku_id, buckets, threads, orders, hold):
+        results = []
+
+        def worker():
+            ok = 0
+            for i in range(orders):
+                ok += order_once(sku_id, buckets > 0, hold)
+            results.append(ok)
+            # 每个线程使用自己的数据库连接
+            connection.close()
+
+        workers = [threading.Thread(target=worker) for i in range(threads)]
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        total = sum(results)
+        self.stdout.write('buckets=%-3d threads=%d orders=%d ok=%d time=%.3fs rate=%.0f orders/s' % (
+            buckets, threads, threads * orders, total, elapsed, total / elapsed))
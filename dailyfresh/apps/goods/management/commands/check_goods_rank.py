@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from goods import ranking
+
+
+class Command(BaseCommand):
+    """检查商品排行索引与数据库是否一致"""
+    help = '检查商品排行索引与数据库是否一致, 不一致时可使用rebuild_goods_rank重建'
+
+    def add_arguments(self, parser):
+        parser.add_argument('type_ids', nargs='*', type=int, help='只检查指定种类, 默认全部')
+
+    def handle(self, *args, **options):
+        type_ids = options['type_ids'] or None
+        problems = ranking.check(type_ids)
+        for type_id, sort, missing, extra, mismatched in problems:
+            self.stdout.write('种类%d[%s]: 缺失%s 多余%s 分数不一致%s' % (type_id, sort, missing, extra, mismatched))
+
+        if problems:
+            raise CommandError('排行索引与数据库不一致')
+        self.stdout.write('排行索引与数据库一致')
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from utils import cache
+
+
+class Command(BaseCommand):
+    """输出页面缓存的命中统计"""
+    help = '输出页面缓存的命中统计(所有worker进程累计)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('keys', nargs='*', help='只输出指定的缓存键, 默认全部')
+        parser.add_argument('--reset', action='store_true', help='输出后清空统计')
+
+    def handle(self, *args, **options):
+        stats = cache.all_stats()
+        keys = options['keys'] or sorted(stats)
+        for key in keys:
+            values = stats.get(key, dict.fromkeys(cache.STATS_FIELDS, 0))
+            total = values['hit'] + values['stale'] + values['miss']
+            rate = values['hit'] * 100.0 / total if total else 0
+            self.stdout.write('%s: hit=%d stale=%d miss=%d rebuild=%d hit_rate=%.1f%%' % (
+                key, values['hit'], values['stale'], values['miss'], values['rebuild'], rate))
+
+        if options['reset']:
+            cache.reset_stats(*options['keys'])
+            self.stdout.write('统计已清空')
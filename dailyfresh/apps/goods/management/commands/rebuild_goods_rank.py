@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from goods import ranking
+
+
+class Command(BaseCommand):
+    """根据数据库重建商品排行索引"""
+    help = '根据数据库重建商品排行索引(redis有序集合)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('type_ids', nargs='*', type=int, help='只重建指定种类, 默认全部')
+
+    def handle(self, *args, **options):
+        type_ids = options['type_ids'] or None
+        for type_id, count in ranking.rebuild(type_ids):
+            self.stdout.write('种类%d: %d个商品' % (type_id, count))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from goods import stock_buckets
+
+
+class Command(BaseCommand):
+    """管理热门商品的库存分桶"""
+    help = '开启/关闭商品的库存分桶, 或立即汇总分桶库存'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['enable', 'disable', 'fold'])
+        parser.add_argument('sku_ids', nargs='*', type=int, help='商品id')
+        parser.add_argument('--buckets', type=int, default=stock_buckets.DEFAULT_BUCKETS, help='分桶数')
+        parser.add_argument('--stock', type=int, help='重新设置的总库存, 默认为当前库存')
+
+    def handle(self, *args, **options):
+        action = options['action']
+        sku_ids = options['sku_ids']
+        if action != 'fold' and not sku_ids:
+            raise CommandError('需要指定商品id')
+
+        if action == 'enable':
+            for sku_id in sku_ids:
+                stock_buckets.enable(sku_id, options['buckets'], options['stock'])
+                self.stdout.write('商品%d: 库存分为%d个分桶' % (sku_id, options['buckets']))
+        elif action == 'disable':
+            for sku_id in sku_ids:
+                stock_buckets.disable(sku_id)
+                self.stdout.write('商品%d: 关闭库存分桶' % sku_id)
+        else:
+            for sku_id, stock in stock_buckets.fold(sku_ids or None).items():
+                self.stdout.write('商品%d: 汇总库存%d' % (sku_id, stock))
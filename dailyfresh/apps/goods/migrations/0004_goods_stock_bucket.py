@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goods', '0003_auto_20190326_2154'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='goodssku',
+            name='stock_sharded',
+            field=models.BooleanField(verbose_name='库存分桶', default=False),
+        ),
+        migrations.CreateModel(
+            name='GoodsStockBucket',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('create_time', models.DateTimeField(verbose_name='创建时间', auto_now_add=True)),
+                ('update_time', models.DateTimeField(verbose_name='更新时间', auto_now=True)),
+                ('is_delete', models.BooleanField(verbose_name='删除标记', default=False)),
+                ('index', models.SmallIntegerField(verbose_name='分桶序号')),
+                ('stock', models.IntegerField(verbose_name='分桶库存', default=0)),
+                ('sales', models.IntegerField(verbose_name='销量增量', default=0)),
+                ('sku', models.ForeignKey(verbose_name='商品', to='goods.GoodsSKU')),
+            ],
+            options={
+                'verbose_name': '商品库存分桶',
+                'verbose_name_plural': '商品库存分桶',
+                'db_table': 'df_goods_stock_bucket',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='goodsstockbucket',
+            unique_together=set([('sku', 'index')]),
+        ),
+    ]
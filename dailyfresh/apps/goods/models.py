@@ -34,6 +34,8 @@ class GoodsSKU(BaseModel):
     stock = models.IntegerField(default=1, verbose_name='商品库存')
     sales = models.IntegerField(default=0, verbose_name='商品销量')
     status = models.SmallIntegerField(default=1, choices=status_chioce, verbose_name='商品状态')
+    # 热门商品的库存分散保存在多个库存分桶中, stock和sales由定时任务汇总
+    stock_sharded = models.BooleanField(default=False, verbose_name='库存分桶')
 
     class Meta:
         db_table = 'df_goods_sku'
@@ -43,6 +45,21 @@ class GoodsSKU(BaseModel):
     def __str__(self):
         return self.name
 
+
+class GoodsStockBucket(BaseModel):
+    """商品库存分桶模型类"""
+    sku = models.ForeignKey('GoodsSKU', verbose_name='商品')
+    index = models.SmallIntegerField(verbose_name='分桶序号')
+    stock = models.IntegerField(default=0, verbose_name='分桶库存')
+    # 上次汇总之后的销量增量
+    sales = models.IntegerField(default=0, verbose_name='销量增量')
+
+    class Meta:
+        db_table = 'df_goods_stock_bucket'
+        verbose_name = '商品库存分桶'
+        verbose_name_plural = verbose_name
+        unique_together = ('sku', 'index')
+
 class Goods(BaseModel):
     """商品SKU模型类"""
     name = models.CharField(max_length=20, verbose_name='商品SPU名称')
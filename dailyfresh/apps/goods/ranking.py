@@ -0,0 +1,205 @@
+import calendar
+
+from django_redis import get_redis_connection
+from goods.models import GoodsType, GoodsSKU
+from utils.pagination import KeysetPage
+from utils.redis_scripts import RedisScript
+
+# 商品排行索引: 每个 (种类, 排序方式) 对应一个redis有序集合, 成员为商品id, 分数为排序字段
+# default: 按id降序  price: 按价格升序  hot: 按销量降序  new: 按创建时间降序
+# goods_rank_built_<种类id>: 该种类的索引已由rebuild完整生成, 只有存在时才增量更新和读取索引
+RANK_SORTS = {
+    'default': 'desc',
+    'price': 'asc',
+    'hot': 'desc',
+    'new': 'desc',
+}
+
+
+def rank_key(type_id, sort):
+    return 'goods_rank_%s_%s' % (sort, type_id)
+
+
+def built_key(type_id):
+    return 'goods_rank_built_%s' % type_id
+
+
+def rank_member(sku_id):
+    """成员补零, 分数相同时按id的数值顺序排列"""
+    return '%010d' % int(sku_id)
+
+
+def rank_score(sku, sort):
+    """商品在排行索引中的分数"""
+    if sort == 'price':
+        return float(sku.price)
+    if sort == 'hot':
+        return sku.sales
+    if sort == 'new':
+        return calendar.timegm(sku.create_time.utctimetuple()) + sku.create_time.microsecond / 1e6
+    return sku.id
+
+
+def _zadd(conn, key, score, member):
+    # 使用execute_command, 兼容不同版本redis-py的zadd参数
+    conn.execute_command('ZADD', key, score, member)
+
+
+# 索引已生成时才写入商品, 避免在没有生成的索引中只写入部分商品
+# KEYS[1]: 种类的生成标记  KEYS[2..]: 各排序方式的索引
+# ARGV[1..n]: 与KEYS[2..]对应的分数  ARGV[n+1]: 商品成员
+ADD_SKU = RedisScript("""
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+for i = 2, #KEYS do
+    redis.call('zadd', KEYS[i], ARGV[i - 1], ARGV[#ARGV])
+end
+return 1
+""")
+
+
+def add_sku(sku):
+    """商品新增或修改时更新排行索引(从其他种类的索引中移除, 处理种类被修改的情况)"""
+    conn = get_redis_connection('default')
+    member = rank_member(sku.id)
+    pipe = conn.pipeline()
+    for type_id in GoodsType.objects.exclude(id=sku.type_id).values_list('id', flat=True):
+        for sort in RANK_SORTS:
+            pipe.zrem(rank_key(type_id, sort), member)
+    sorts = list(RANK_SORTS)
+    ADD_SKU(keys=[built_key(sku.type_id)] + [rank_key(sku.type_id, sort) for sort in sorts],
+            args=[rank_score(sku, sort) for sort in sorts] + [member], conn=pipe)
+    pipe.execute()
+
+
+def remove_sku(sku):
+    """商品删除时从排行索引中移除"""
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    for sort in RANK_SORTS:
+        pipe.zrem(rank_key(sku.type_id, sort), rank_member(sku.id))
+    pipe.execute()
+
+
+def incr_sales(items):
+    """
+    下单后更新销量排行
+    :param items: [(种类id, 商品id, 购买数量), ...]
+    """
+    if not items:
+        return
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    for type_id, sku_id, count in items:
+        key = rank_key(type_id, 'hot')
+        # 索引不存在时不创建, 避免生成只有部分商品的索引
+        pipe.execute_command('ZADD', key, 'XX', 'INCR', count, rank_member(sku_id))
+    pipe.execute()
+
+
+def is_built(type_id):
+    """种类的排行索引是否已生成"""
+    return bool(get_redis_connection('default').exists(built_key(type_id)))
+
+
+def get_rank_ids(type_id, sort, start, stop):
+    """获取排行中 [start, stop] 位置的商品id"""
+    conn = get_redis_connection('default')
+    key = rank_key(type_id, sort)
+    if RANK_SORTS[sort] == 'asc':
+        members = conn.zrange(key, start, stop)
+    else:
+        members = conn.zrevrange(key, start, stop)
+    return [int(member) for member in members]
+
+
+def get_rank_skus(type_id, sort, start, stop):
+    """获取排行中 [start, stop] 位置的商品, 一次查询加载商品信息"""
+    sku_ids = get_rank_ids(type_id, sort, start, stop)
+    skus = GoodsSKU.objects.in_bulk(sku_ids)
+    return [skus[sku_id] for sku_id in sku_ids if sku_id in skus]
+
+
+def rebuild(type_ids=None):
+    """
+    根据数据库重建排行索引, 先写临时键再rename, 重建期间读取不受影响
+    重建完成后写入生成标记, 之后商品修改才会增量更新索引
+    :return: [(种类id, 商品数), ...]
+    """
+    conn = get_redis_connection('default')
+    if type_ids is None:
+        type_ids = GoodsType.objects.values_list('id', flat=True)
+
+    result = []
+    for type_id in type_ids:
+        skus = list(GoodsSKU.objects.filter(type_id=type_id))
+        pipe = conn.pipeline()
+        for sort in RANK_SORTS:
+            key = rank_key(type_id, sort)
+            tmp_key = '%s_tmp' % key
+            pipe.delete(tmp_key)
+            for sku in skus:
+                _zadd(pipe, tmp_key, rank_score(sku, sort), rank_member(sku.id))
+            if skus:
+                pipe.rename(tmp_key, key)
+            else:
+                pipe.delete(key)
+        pipe.set(built_key(type_id), 1)
+        pipe.execute()
+        result.append((type_id, len(skus)))
+    return result
+
+
+def check(type_ids=None):
+    """
+    检查排行索引与数据库是否一致
+    :return: [(种类id, 排序方式, 缺失的商品id, 多余的商品id, 分数不一致的商品id), ...]
+    """
+    conn = get_redis_connection('default')
+    if type_ids is None:
+        type_ids = GoodsType.objects.values_list('id', flat=True)
+
+    problems = []
+    for type_id in type_ids:
+        skus = {sku.id: sku for sku in GoodsSKU.objects.filter(type_id=type_id)}
+        for sort in RANK_SORTS:
+            ranked = {int(member): score for member, score in
+                      conn.zrange(rank_key(type_id, sort), 0, -1, withscores=True)}
+            missing = sorted(set(skus) - set(ranked))
+            extra = sorted(set(ranked) - set(skus))
+            mismatched = sorted(sku_id for sku_id in set(skus) & set(ranked)
+                                if abs(ranked[sku_id] - rank_score(skus[sku_id], sort)) > 1e-6)
+            if missing or extra or mismatched:
+                problems.append((type_id, sort, missing, extra, mismatched))
+    return problems
+
+
+class RankPaginator(object):
+    """使用排行索引分页, ZRANGE按位置读取一页商品id, 深度翻页也不会变慢"""
+    def __init__(self, type_id, sort, per_page, ordering):
+        self.type_id = type_id
+        self.sort = sort
+        self.per_page = per_page
+        # 用于生成翻页游标, 索引失效回退到数据库分页时使用
+        self.ordering = ordering
+        pipe = get_redis_connection('default').pipeline()
+        pipe.exists(built_key(type_id))
+        pipe.zcard(rank_key(type_id, sort))
+        built, self.count = pipe.execute()
+        # 索引没有生成时调用者应回退到数据库分页
+        self.built = bool(built)
+
+    @property
+    def num_pages(self):
+        if self.count == 0:
+            return 1
+        return (self.count + self.per_page - 1) // self.per_page
+
+    def page(self, number, after=None, before=None):
+        start = (number - 1) * self.per_page
+        skus = get_rank_skus(self.type_id, self.sort, start, start + self.per_page - 1)
+        return KeysetPage(skus, number,
+                          has_next=number < self.num_pages,
+                          has_previous=number > 1,
+                          ordering=self.ordering)
@@ -0,0 +1,51 @@
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from goods.models import GoodsType, GoodsSKU, Goods, GoodsImage
+from goods import ranking, stock
+from goods.utils import invalidate_detail_page, invalidate_all_detail_pages, invalidate_type_sku_count, \
+    invalidate_goods_types
+
+
+@receiver([post_save, post_delete], sender=GoodsSKU)
+def goods_sku_changed(sender, instance, **kwargs):
+    """商品SKU修改: 同种类(新品推荐)和同SPU(其他规格)商品的详情页都会展示该商品"""
+    sku_ids = GoodsSKU.objects.filter(Q(type_id=instance.type_id) | Q(goods_id=instance.goods_id))\
+        .values_list('id', flat=True)
+    invalidate_detail_page(instance.id, *sku_ids)
+    # 种类商品数可能变化
+    invalidate_type_sku_count(instance.type_id)
+
+
+@receiver(post_save, sender=GoodsSKU)
+def goods_sku_saved(sender, instance, **kwargs):
+    """更新商品排行索引, 删除库存镜像(保存可能在事务中, 提交后才删除, 添加购物车时从数据库重新加载)"""
+    ranking.add_sku(instance)
+    stock.clear_stock_on_commit(instance.id)
+
+
+@receiver(post_delete, sender=GoodsSKU)
+def goods_sku_deleted(sender, instance, **kwargs):
+    """从商品排行索引和库存镜像中移除"""
+    ranking.remove_sku(instance)
+    stock.clear_stock(instance.id)
+
+
+@receiver([post_save, post_delete], sender=Goods)
+def goods_changed(sender, instance, **kwargs):
+    """商品SPU修改"""
+    sku_ids = GoodsSKU.objects.filter(goods_id=instance.id).values_list('id', flat=True)
+    invalidate_detail_page(*sku_ids)
+
+
+@receiver([post_save, post_delete], sender=GoodsImage)
+def goods_image_changed(sender, instance, **kwargs):
+    """商品图片修改"""
+    invalidate_detail_page(instance.sku_id)
+
+
+@receiver([post_save, post_delete], sender=GoodsType)
+def goods_type_changed(sender, instance, **kwargs):
+    """商品种类修改: 通知所有进程重新加载种类数据, 详情页中展示了商品所属种类名称"""
+    invalidate_goods_types()
+    invalidate_all_detail_pages()
@@ -0,0 +1,44 @@
+from django.db import transaction
+from django_redis import get_redis_connection
+from goods.models import GoodsSKU
+
+# 商品库存在redis中的镜像 {商品id: 库存}, 用于添加购物车时校验库存
+# 只用作购物车数量上限, 下单时仍以数据库中的库存为准
+STOCK_KEY = 'goods_stock'
+# 事务提交前镜像可能被重新加载为旧库存, 延迟该时间(秒)后再清除一次
+STOCK_CLEAR_DELAY = 5
+
+
+def set_stock(sku_id, stock):
+    """更新库存镜像"""
+    get_redis_connection('default').hset(STOCK_KEY, sku_id, stock)
+
+
+def clear_stock(*sku_ids):
+    """删除库存镜像, 下次使用时从数据库重新加载"""
+    if sku_ids:
+        get_redis_connection('default').hdel(STOCK_KEY, *sku_ids)
+
+
+def clear_stock_on_commit(*sku_ids):
+    """
+    在事务中修改库存后调用: 事务提交后删除库存镜像(回滚时镜像中仍是数据库中的值)
+    django 1.8没有 transaction.on_commit, 立即删除一次, 再由celery延迟删除一次,
+    覆盖事务提交前被其他请求重新加载的旧库存
+    """
+    if not sku_ids:
+        return
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is not None:
+        on_commit(lambda: clear_stock(*sku_ids))
+        return
+    clear_stock(*sku_ids)
+    from celery_task.tasks import clear_goods_stock
+    clear_goods_stock.apply_async(sku_ids, countdown=STOCK_CLEAR_DELAY)
+
+
+def load_stock(sku_id):
+    """从数据库加载库存并写入镜像, 商品不存在时抛出GoodsSKU.DoesNotExist"""
+    stock = GoodsSKU.objects.values_list('stock', flat=True).get(id=sku_id)
+    set_stock(sku_id, stock)
+    return stock
@@ -0,0 +1,136 @@
+import random
+
+from django.db import transaction
+from django.db.models import F, Sum, Case, When, Value, IntegerField
+from goods.models import GoodsSKU, GoodsStockBucket
+from goods import stock as stock_mirror
+
+# 库存分桶: 热门商品的库存分散到N行分桶中, 下单时随机选择一个库存足够的分桶扣减,
+# 并发下单不再全部等待商品表中的同一行锁
+# 分桶商品的 GoodsSKU.stock 是分桶库存的汇总, GoodsSKU.sales 累加分桶中的销量增量, 都由定时任务汇总;
+# 分桶商品的库存需要通过 enable() 重新设置, 直接修改 GoodsSKU.stock 会在下次汇总时被覆盖
+DEFAULT_BUCKETS = 8
+
+
+def _split(stock, buckets):
+    """把库存平均分到各个分桶"""
+    base, extra = divmod(stock, buckets)
+    return [base + (1 if index < extra else 0) for index in range(buckets)]
+
+
+def _fold_one(sku_id, rebalance=True):
+    """汇总一个商品的分桶(需要在事务中调用), 返回汇总后的库存, 商品没有分桶时返回None"""
+    buckets = list(GoodsStockBucket.objects.select_for_update().filter(sku_id=sku_id).order_by('index'))
+    if not buckets:
+        return None
+
+    stock = sum(bucket.stock for bucket in buckets)
+    sales = sum(bucket.sales for bucket in buckets)
+    GoodsSKU.objects.filter(id=sku_id).update(stock=stock, sales=F('sales') + sales)
+
+    if rebalance:
+        # 重新平均分配库存, 避免库存集中在少数分桶, 大数量的订单找不到库存足够的分桶
+        stocks = _split(stock, len(buckets))
+        GoodsStockBucket.objects.filter(sku_id=sku_id).update(
+            sales=0,
+            stock=Case(*[When(id=bucket.id, then=Value(stocks[i])) for i, bucket in enumerate(buckets)],
+                       output_field=IntegerField()))
+    elif sales:
+        GoodsStockBucket.objects.filter(sku_id=sku_id).update(sales=0)
+    return stock
+
+
+def fold(sku_ids=None, rebalance=True):
+    """
+    把分桶的库存和销量汇总到商品表(定时任务调用)
+    :return: {商品id: 汇总后的库存}
+    """
+    if sku_ids is None:
+        sku_ids = GoodsSKU.objects.filter(stock_sharded=True).values_list('id', flat=True)
+
+    result = {}
+    for sku_id in sku_ids:
+        # 每个商品一个短事务, 只短暂锁住该商品的分桶
+        with transaction.atomic():
+            stock = _fold_one(sku_id, rebalance)
+        if stock is not None:
+            result[sku_id] = stock
+    stock_mirror.clear_stock(*result)
+    return result
+
+
+def enable(sku_id, buckets=DEFAULT_BUCKETS, stock=None):
+    """
+    开启(或重新设置)商品的库存分桶
+    :param stock: 新的总库存, 默认为当前库存
+    """
+    with transaction.atomic():
+        sku = GoodsSKU.objects.select_for_update().get(id=sku_id)
+        # 已分桶的商品先汇总, 得到准确的库存
+        folded = _fold_one(sku_id, rebalance=False)
+        if stock is None:
+            stock = sku.stock if folded is None else folded
+
+        GoodsStockBucket.objects.filter(sku_id=sku_id).delete()
+        GoodsStockBucket.objects.bulk_create([
+            GoodsStockBucket(sku_id=sku_id, index=index, stock=bucket_stock)
+            for index, bucket_stock in enumerate(_split(stock, buckets))
+        ])
+        GoodsSKU.objects.filter(id=sku_id).update(stock=stock, stock_sharded=True)
+    stock_mirror.clear_stock(sku_id)
+
+
+def disable(sku_id):
+    """关闭商品的库存分桶, 库存汇总回商品表"""
+    with transaction.atomic():
+        GoodsSKU.objects.select_for_update().get(id=sku_id)
+        _fold_one(sku_id, rebalance=False)
+        GoodsStockBucket.objects.filter(sku_id=sku_id).delete()
+        GoodsSKU.objects.filter(id=sku_id).update(stock_sharded=False)
+    stock_mirror.clear_stock(sku_id)
+
+
+def take(sku_id, count):
+    """
+    扣减库存(在下单事务中调用): 优先从随机一个库存足够的分桶中扣减,
+    没有单个分桶足够时从多个分桶中合计扣减
+    :return: 是否扣减成功
+    """
+    buckets = list(GoodsStockBucket.objects.filter(sku_id=sku_id, stock__gte=count)
+                   .values_list('id', flat=True))
+    random.shuffle(buckets)
+    for bucket_id in buckets:
+        # 带条件的更新, 分桶库存已被其他订单买走时换下一个分桶
+        res = GoodsStockBucket.objects.filter(id=bucket_id, stock__gte=count)\
+            .update(stock=F('stock') - count, sales=F('sales') + count)
+        if res:
+            return True
+    return _take_from_many(sku_id, count)
+
+
+def _take_from_many(sku_id, count):
+    """从多个分桶中合计扣减库存, 按分桶顺序加锁避免死锁, 总库存不足时不扣减"""
+    # 先不加锁汇总库存: 售罄时直接返回, 不会让所有订单排队等待全部分桶的行锁
+    total = GoodsStockBucket.objects.filter(sku_id=sku_id).aggregate(stock=Sum('stock'))['stock'] or 0
+    if total < count:
+        return False
+
+    with transaction.atomic():
+        buckets = list(GoodsStockBucket.objects.select_for_update()
+                       .filter(sku_id=sku_id, stock__gt=0).order_by('index'))
+        if sum(bucket.stock for bucket in buckets) < count:
+            return False
+        for bucket in buckets:
+            taken = min(bucket.stock, count)
+            GoodsStockBucket.objects.filter(id=bucket.id)\
+                .update(stock=F('stock') - taken, sales=F('sales') + taken)
+            count -= taken
+            if count == 0:
+                break
+    return True
+
+
+def give_back(sku_id, count):
+    """归还库存(取消订单时调用), 放回第一个分桶, 下次汇总时重新平均分配"""
+    GoodsStockBucket.objects.filter(sku_id=sku_id, index=0)\
+        .update(stock=F('stock') + count, sales=F('sales') - count)
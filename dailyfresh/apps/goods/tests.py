@@ -1,3 +1,147 @@
-from django.test import TestCase
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.db import transaction
+from django.test import TestCase, SimpleTestCase
+from goods.models import GoodsType, Goods, GoodsSKU, GoodsStockBucket
+from goods import stock_buckets
+from utils.pagination import encode_cursor, decode_cursor, KeysetPaginator
+
+
+def create_skus(*stocks):
+    """
+    创建测试商品, 每个库存一个商品
+    使用bulk_create, 不触发post_save信号(信号会更新redis中的排行索引,库存镜像和搜索索引)
+    """
+    GoodsType.objects.bulk_create([GoodsType(name='测试种类', logo='test', image='type/test.jpg')])
+    goods_type = GoodsType.objects.get(name='测试种类')
+    Goods.objects.bulk_create([Goods(name='测试商品')])
+    goods = Goods.objects.get(name='测试商品')
+    GoodsSKU.objects.bulk_create([
+        GoodsSKU(type=goods_type, goods=goods, name='测试商品%d' % i, desc='测试', price=Decimal('10.00'),
+                 unite='500g', image='goods/test.jpg', stock=stock)
+        for i, stock in enumerate(stocks)
+    ])
+    return list(GoodsSKU.objects.filter(goods=goods).order_by('id'))
+
+
+class CursorTest(SimpleTestCase):
+    """游标编码和解码"""
+    ordering = ['price', 'id']
+
+    def test_round_trip(self):
+        sku = GoodsSKU(id=5, price=Decimal('12.50'))
+        cursor = encode_cursor(sku, self.ordering)
+        self.assertEqual(cursor, '12.50,5')
+        self.assertEqual(decode_cursor(cursor, self.ordering, GoodsSKU), [Decimal('12.50'), 5])
+
+    def test_without_model_returns_strings(self):
+        self.assertEqual(decode_cursor('12.50,5', self.ordering), ['12.50', '5'])
+
+    def test_reject(self):
+        for cursor in ['', None, '12.50', '12.50,5,1', 'abc,5', '12.50,x', 'NaN,5', 'Infinity,5']:
+            self.assertIsNone(decode_cursor(cursor, self.ordering, GoodsSKU), cursor)
+
+
+class KeysetPaginatorTest(TestCase):
+    """游标分页"""
+    def setUp(self):
+        self.skus = create_skus(1, 1, 1, 1, 1)
+        self.paginator = KeysetPaginator(GoodsSKU.objects.all(), ['-id'], 2, len(self.skus))
+
+    def ids(self, page):
+        return [sku.id for sku in page]
+
+    def test_next_and_previous(self):
+        expected = [sku.id for sku in reversed(self.skus)]
+        page1 = self.paginator.page(1)
+        self.assertEqual(self.ids(page1), expected[:2])
+        page2 = self.paginator.page(2, after=page1.next_cursor)
+        self.assertEqual(self.ids(page2), expected[2:4])
+        self.assertTrue(page2.has_next())
+        page3 = self.paginator.page(3, after=page2.next_cursor)
+        self.assertEqual(self.ids(page3), expected[4:])
+        self.assertFalse(page3.has_next())
+        # 从第3页返回第2页
+        self.assertEqual(self.ids(self.paginator.page(2, before=page3.previous_cursor)), expected[2:4])
+
+    def test_bad_cursor_returns_first_page(self):
+        page = self.paginator.page(2, after='abc')
+        self.assertEqual(page.number, 1)
+        self.assertEqual(self.ids(page), self.ids(self.paginator.page(1)))
+        self.assertEqual(self.paginator.page(3, before='1,2').number, 1)
+
+
+class StockBucketsTest(TestCase):
+    """库存分桶: 扣减, 汇总前后库存和销量守恒(清除库存镜像的redis操作被替换)"""
+    def setUp(self):
+        patcher = mock.patch('goods.stock.clear_stock')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sku = create_skus(0)[0]
+        GoodsSKU.objects.filter(id=self.sku.id).update(sales=7)
+        stock_buckets.enable(self.sku.id, 4, 10)
+
+    def buckets(self):
+        return list(GoodsStockBucket.objects.filter(sku_id=self.sku.id).order_by('index')
+                    .values_list('stock', 'sales'))
+
+    def totals(self):
+        buckets = self.buckets()
+        return sum(stock for stock, sales in buckets), sum(sales for stock, sales in buckets)
+
+    def take(self, count):
+        with transaction.atomic():
+            return stock_buckets.take(self.sku.id, count)
+
+    def test_enable(self):
+        self.assertEqual(self.buckets(), [(3, 0), (3, 0), (2, 0), (2, 0)])
+        sku = GoodsSKU.objects.get(id=self.sku.id)
+        self.assertTrue(sku.stock_sharded)
+        self.assertEqual((sku.stock, sku.sales), (10, 7))
+
+    def test_take_from_one_bucket(self):
+        self.assertTrue(self.take(3))
+        self.assertEqual(self.totals(), (7, 3))
+        # 只扣减了一个分桶
+        self.assertEqual(len([stock for stock, sales in self.buckets() if sales]), 1)
+
+    def test_take_from_many_buckets(self):
+        # 没有单个分桶的库存足够
+        self.assertTrue(self.take(9))
+        self.assertEqual(self.totals(), (1, 9))
+        self.assertTrue(all(stock >= 0 for stock, sales in self.buckets()))
+
+    def test_take_insufficient(self):
+        self.assertFalse(self.take(11))
+        self.assertEqual(self.totals(), (10, 0))
+        self.assertTrue(self.take(10))
+        self.assertFalse(self.take(1))
+        self.assertEqual(self.totals(), (0, 10))
+
+    def test_give_back(self):
+        self.assertTrue(self.take(4))
+        stock_buckets.give_back(self.sku.id, 4)
+        self.assertEqual(self.totals(), (10, 0))
+
+    def test_fold(self):
+        self.assertTrue(self.take(3))
+        self.assertTrue(self.take(5))
+        self.assertEqual(stock_buckets.fold([self.sku.id]), {self.sku.id: 2})
+
+        sku = GoodsSKU.objects.get(id=self.sku.id)
+        self.assertEqual((sku.stock, sku.sales), (2, 15))
+        # 汇总后分桶的销量清零, 库存重新平均分配
+        self.assertEqual(self.buckets(), [(1, 0), (1, 0), (0, 0), (0, 0)])
+
+        # 再次汇总不会重复累加销量
+        stock_buckets.fold([self.sku.id])
+        self.assertEqual(GoodsSKU.objects.values_list('stock', 'sales').get(id=self.sku.id), (2, 15))
+
+    def test_disable(self):
+        self.assertTrue(self.take(4))
+        stock_buckets.disable(self.sku.id)
+        sku = GoodsSKU.objects.get(id=self.sku.id)
+        self.assertFalse(sku.stock_sharded)
+        self.assertEqual((sku.stock, sku.sales), (6, 11))
+        self.assertEqual(self.buckets(), [])
@@ -0,0 +1,180 @@
+import copy
+import threading
+import time
+
+from django.core.cache import cache
+from utils.cache import PageCache
+from utils.redis_scripts import RECORD_HISTORY
+from order.models import OrderGoods
+from goods.models import GoodsType, GoodsSKU, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner
+from goods import ranking
+
+
+# 商品种类进程内缓存: 种类数据很少变化,每个进程保存一份,通过redis中的版本号判断是否失效
+GOODS_TYPE_VERSION_KEY = 'goods_type_version'
+# 检查版本号的时间间隔(秒), 间隔内不访问redis
+GOODS_TYPE_CHECK_INTERVAL = 5
+
+_goods_types = {'version': None, 'types': [], 'checked': 0}
+_goods_types_lock = threading.Lock()
+
+
+def get_goods_types():
+    """获取商品种类列表(进程内缓存,返回的对象不要修改)"""
+    now = time.time()
+    if now - _goods_types['checked'] < GOODS_TYPE_CHECK_INTERVAL:
+        return _goods_types['types']
+
+    with _goods_types_lock:
+        version = cache.get(GOODS_TYPE_VERSION_KEY, 0)
+        if version != _goods_types['version']:
+            _goods_types['types'] = list(GoodsType.objects.all())
+            _goods_types['version'] = version
+        _goods_types['checked'] = now
+    return _goods_types['types']
+
+
+def get_goods_type(type_id):
+    """根据id获取商品种类,不存在时返回None"""
+    for type in get_goods_types():
+        if str(type.id) == str(type_id):
+            return type
+    return None
+
+
+def invalidate_goods_types():
+    """商品种类修改后调用,所有进程在检查间隔后重新加载种类数据"""
+    _incr_version(GOODS_TYPE_VERSION_KEY)
+    # 当前进程立即重新加载
+    _goods_types['checked'] = 0
+
+
+def get_index_page_data():
+    """组织首页展示所需的上下文数据(首页视图和celery生成静态页面共用)"""
+    # 获取商品的种类信息(复制一份,下面会给type动态增加属性)
+    types = [copy.copy(type) for type in get_goods_types()]
+
+    # 获取首页轮播商品信息(关联查询出sku,避免模板中逐条查询)
+    goods_banners = list(IndexGoodsBanner.objects.select_related('sku').order_by('index'))
+
+    # 获取首页促销活动信息
+    promotion_banners = list(IndexPromotionBanner.objects.all().order_by('index'))
+
+    # 一次查询获取所有种类的首页分类商品展示信息,在内存中按 (种类id, 展示类型) 分组
+    # 之前每个种类需要查询两次,种类越多首页缓存失效时越慢
+    type_banners = {}
+    for banner in IndexTypeGoodsBanner.objects.select_related('sku').order_by('index'):
+        type_banners.setdefault((banner.type_id, banner.display_type), []).append(banner)
+
+    # 动态给type增加属性，分别保存首页分类商品的图片展示信息和文字展示信息
+    for type in types:
+        type.image_banners = type_banners.get((type.id, 1), [])
+        type.title_banners = type_banners.get((type.id, 0), [])
+
+    return {
+        "types": types,
+        "goods_banners": goods_banners,
+        "promotion_banners": promotion_banners,
+    }
+
+
+# 首页上下文缓存
+index_page_cache = PageCache('index_page_data', get_index_page_data, timeout=3600)
+
+
+def get_detail_page_data(goods_id):
+    """组织商品详情页中与用户无关的上下文数据(分类导航除外), 商品不存在时抛出GoodsSKU.DoesNotExist"""
+    sku = GoodsSKU.objects.select_related('type', 'goods').get(id=goods_id)
+
+    # 获取商品的评论信息,过滤掉评论信息为空的数据
+    sku_orders = list(OrderGoods.objects.filter(sku=sku).exclude(comment='')
+                      .select_related('order__user').order_by('-create_time'))
+
+    # 获取同一个SPU商品的 "其他" 规格商品
+    same_spu_skus = list(GoodsSKU.objects.filter(goods_id=sku.goods_id).exclude(id=sku.id))
+
+    # 获取新品信息(推荐新品根据该商品的所属类型进行推荐),根据时间降序排列.
+    new_skus = get_new_skus(sku.type_id)
+
+    return {
+        "sku": sku,
+        "sku_orders": sku_orders,
+        "new_skus": new_skus,
+        "same_spu_skus": same_spu_skus,
+    }
+
+
+# 详情页缓存: 数据和版本号一起保存,版本号变化即视为失效
+# 全局版本号(商品种类变化时递增) + 每个商品的版本号(商品,图片,评论变化时递增)
+DETAIL_PAGE_TIMEOUT = 3600
+DETAIL_PAGE_GLOBAL_VERSION_KEY = 'detail_page_version'
+
+
+def _detail_page_keys(goods_id):
+    return 'detail_page_version_%s' % goods_id, 'detail_page_data_%s' % goods_id
+
+
+def get_cached_detail_page_data(goods_id):
+    """从缓存获取商品详情页上下文, 缓存失效时重新查询数据库"""
+    version_key, data_key = _detail_page_keys(goods_id)
+    # 一次读取版本号和数据
+    values = cache.get_many([DETAIL_PAGE_GLOBAL_VERSION_KEY, version_key, data_key])
+    version = (values.get(DETAIL_PAGE_GLOBAL_VERSION_KEY, 0), values.get(version_key, 0))
+
+    entry = values.get(data_key)
+    if entry is not None and entry['version'] == version:
+        return entry['data']
+
+    # 使用查询前读到的版本号保存,查询期间数据若被修改,版本号已变化,下次访问会重新生成
+    data = get_detail_page_data(goods_id)
+    cache.set(data_key, {'version': version, 'data': data}, DETAIL_PAGE_TIMEOUT)
+    return data
+
+
+def _incr_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        # 版本号不存在
+        cache.set(key, 1, None)
+
+
+def invalidate_detail_page(*goods_ids):
+    """使指定商品的详情页缓存失效"""
+    for goods_id in set(goods_ids):
+        _incr_version(_detail_page_keys(goods_id)[0])
+
+
+def invalidate_all_detail_pages():
+    """使所有商品的详情页缓存失效"""
+    _incr_version(DETAIL_PAGE_GLOBAL_VERSION_KEY)
+
+
+def record_history(user_id, goods_id, history_count=5):
+    """添加用户历史浏览记录, 返回用户购物车内的商品总条目数"""
+    history_key = 'history_%d' % user_id
+    cart_key = 'cart_%d' % user_id
+    return RECORD_HISTORY(keys=[history_key, cart_key], args=[goods_id, history_count])
+
+
+def get_type_sku_count(type_id):
+    """获取种类下的商品总数(列表页页码使用), 商品变化时由信号清除缓存"""
+    key = 'type_sku_count_%s' % type_id
+    count = cache.get(key)
+    if count is None:
+        count = GoodsSKU.objects.filter(type_id=type_id).count()
+        cache.set(key, count, 3600)
+    return count
+
+
+def invalidate_type_sku_count(type_id):
+    """清除种类商品总数缓存"""
+    cache.delete('type_sku_count_%s' % type_id)
+
+
+def get_new_skus(type_id, count=5):
+    """获取种类的新品信息, 优先从排行索引获取"""
+    if ranking.is_built(type_id):
+        return ranking.get_rank_skus(type_id, 'new', 0, count - 1)
+    # 排行索引没有生成,根据时间降序查询数据库
+    return list(GoodsSKU.objects.filter(type_id=type_id).order_by('-create_time')[:count])
@@ -1,64 +1,23 @@
 from django.shortcuts import render, redirect
 from django.core.urlresolvers import reverse
 from django.views.generic import View
-from django.core.paginator import Paginator  # 分页
-from django.core.cache import cache  # django自带缓存api接口
-from django_redis import get_redis_connection
-from order.models import OrderGoods
-from goods.models import GoodsType, GoodsSKU, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner
+from goods.models import GoodsSKU
+from goods.utils import index_page_cache, get_cached_detail_page_data, record_history, get_type_sku_count, get_new_skus, \
+    get_goods_type
+from goods.ranking import RankPaginator  # 排行索引分页
+from utils.pagination import KeysetPaginator  # 游标分页
+
+# 列表页每页显示的商品数
+LIST_PAGE_SIZE = 1
 
 
 class IndexView(View):
     def get(self, request):
         """首页展示"""
-        # 尝试从缓存中获取数据,cache.get获取不到数据返回None
-        context = cache.get("index_page_data")
-        if context is None:
-            """未获取到数据"""
-
-            # 获取商品的种类信息
-            types = GoodsType.objects.all()
-
-            # 获取首页轮播商品信息
-            goods_banners = IndexGoodsBanner.objects.all().order_by('index')
-
-            # 获取首页促销活动信息
-            promotion_banners = IndexPromotionBanner.objects.all().order_by('index')
-
-            # 获取首页分类商品展示信息
-            for type in types:
-                # 获取type种类首页分类商品的图片展示信息
-                image_banners = IndexTypeGoodsBanner.objects.filter(type=type, display_type=1).order_by('index')
-                # 获取type种类首页分类商品的文字展示信息
-                title_banners = IndexTypeGoodsBanner.objects.filter(type=type, display_type=0).order_by('index')
-
-                # 动态给type增加属性，分别保存首页分类商品的图片展示信息和文字展示信息
-                type.image_banners = image_banners
-                type.title_banners = title_banners
-
-            context = {
-                "types": types,
-                "goods_banners": goods_banners,
-                "promotion_banners": promotion_banners,
-            }
-
-            # 设置缓存
-            cache.set("index_page_data", context, 3600)
-
-        # 获取用户购物车中商品的数目
-        user = request.user
-        cart_count = 0
-        # 判断用户是否已登录
-        if user.is_authenticated():
-            # 用户已登录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            # 获取用户购物车内的商品总条目数
-            cart_count = conn.hlen(cart_key)
-
-        # 组织模板上下文(更新用户个人购物车信息)
-        context.update(cart_count=cart_count)
+        # 从缓存中获取数据,缓存过期时只有一个进程重建,其他请求返回旧数据
+        context = index_page_cache.get()
 
+        # 用户购物车中商品的数目由上下文处理器goods.context_processors.header提供
         return render(request, 'index.html', context)
 
 
@@ -66,54 +25,24 @@ class IndexView(View):
 class DetailView(View):
     """商品详情页"""
     def get(self, request, goods_id):
+        # 获取与用户无关的页面数据(商品,评论,其他规格,新品),优先从缓存中获取
         try:
-            sku = GoodsSKU.objects.get(id=goods_id)
+            context = get_cached_detail_page_data(goods_id)
         except GoodsSKU.DoesNotExist:
             # 商品不存在
             return redirect(reverse("goods:index"))
 
-        # 获取商品的分类信息
-        types = GoodsType.objects.all()
-
-        # 获取商品的评论信息,过滤掉评论信息为空的数据
-        sku_orders = OrderGoods.objects.filter(sku=sku).exclude(comment='').order_by('-create_time')
-
-        # 获取同一个SPU商品的 "其他" 规格商品
-        same_spu_skus = GoodsSKU.objects.filter(goods=sku.goods).exclude(id=goods_id)
-
-        # 获取新品信息(推荐新品根据该商品的所属类型进行推荐),根据时间降序排列.
-        new_skus = GoodsSKU.objects.filter(type=sku.type).order_by('-create_time')[:5]
-
         # 获取用户购物车中商品的数目
         user = request.user
         cart_count = 0
         # 判断用户是否已登录
         if user.is_authenticated():
             # 用户已登录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            # 获取用户购物车内的商品总条目数
-            cart_count = conn.hlen(cart_key)
-
-            # 添加用户历史浏览记录
-            conn = get_redis_connection('default')
-            history_key = 'history_%d' % user.id
-            # 移除列表中的goods_id
-            conn.lrem(history_key, 0, goods_id)
-            # 把goods_id插入到列表的左侧
-            conn.lpush(history_key, goods_id)
-            # 只保存最近浏览的5条信息
-            conn.ltrim(history_key, 0, 4)
+            # 添加用户历史浏览记录(只保存最近浏览的5条),同时获取用户购物车内的商品总条目数,一次redis往返
+            cart_count = record_history(user.id, goods_id)
 
-        # 组织模板上下文
-        context = {
-            "sku": sku,
-            "types": types,
-            "sku_orders": sku_orders,
-            "new_skus": new_skus,
-            "same_spu_skus": same_spu_skus,
-            "cart_count": cart_count
-        }
+        # 组织模板上下文(更新用户个人购物车信息, 商品分类信息由上下文处理器提供)
+        context.update(cart_count=cart_count)
 
         # 使用模板
         return render(request, "detail.html", context)
@@ -131,32 +60,33 @@ class ListView(View):
             page: 页码
         :return:
         """
-        # 获取种类信息
-        try:
-            type = GoodsType.objects.get(id=type_id)
-        except GoodsType.DoesNotExist:
+        # 获取种类信息(进程内缓存)
+        type = get_goods_type(type_id)
+        if type is None:
             # 种类不存在
             return redirect(reverse("goods:index"))
 
-        # 获取商品分类信息
-        types = GoodsType.objects.all()
-
         # 获取排序方式，获取分类商品的信息
         # sort=default  默认排序
         # sort=price  按照价格排序
         # sort=hot  按照商品销量排序
         sort = request.GET.get('sort')
 
+        # 排序字段,最后按id排序保证顺序稳定
         if sort == "price":
-            skus = GoodsSKU.objects.filter(type=type).order_by('price')
+            ordering = ['price', 'id']
         elif sort == "hot":
-            skus = GoodsSKU.objects.filter(type=type).order_by('-sales')
+            ordering = ['-sales', '-id']
         else:
             sort = "default"
-            skus = GoodsSKU.objects.filter(type=type).order_by('-id')
+            ordering = ['-id']
 
-        # 对数据进行分页,分页数据列表对象，分页数量
-        paginator = Paginator(skus, 1)
+        # 对数据进行分页: 优先使用redis排行索引分页
+        paginator = RankPaginator(type.id, sort, LIST_PAGE_SIZE, ordering)
+        if not paginator.built:
+            # 排行索引没有生成,使用数据库游标分页,商品总数从缓存获取,不再每次执行COUNT(*)
+            skus = GoodsSKU.objects.filter(type=type)
+            paginator = KeysetPaginator(skus, ordering, LIST_PAGE_SIZE, get_type_sku_count(type.id))
 
         # 获取page页的内容
         try:
@@ -164,12 +94,19 @@ class ListView(View):
         except Exception as e:
             page = 1
 
+        # 翻页时带有上一页的游标
+        after = request.GET.get('after')
+        before = request.GET.get('before')
+
         # 如果请求页码超出页码总页数，则返回第一页数据
-        if page > paginator.num_pages:
+        if page > paginator.num_pages or page < 1:
             page = 1
+            after = before = None
 
         # 获取第page页的实例对象
-        skus_page = paginator.page(page)
+        skus_page = paginator.page(page, after=after, before=before)
+        # 游标无法解析时返回的是第1页
+        page = skus_page.number
 
         # Todo: 进行页码控制，页面上最多显示5个页码
         # 1.总页数小于5页，页面显示所有页码
@@ -187,26 +124,13 @@ class ListView(View):
             pages = range(page-2, page+3)
 
         # 获取新品信息(推荐新品根据该商品的所属类型进行推荐),根据时间降序排列.
-        new_skus = GoodsSKU.objects.filter(type=type).order_by('-create_time')[:5]
-
-        # 获取用户购物车中商品的数目
-        user = request.user
-        cart_count = 0
-        # 判断用户是否已登录
-        if user.is_authenticated():
-            # 用户已登录
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            # 获取用户购物车内的商品总条目数
-            cart_count = conn.hlen(cart_key)
+        new_skus = get_new_skus(type.id)
 
         # 组织模板上下文
         context = {
             "type": type,
-            "types": types,
             "skus_page": skus_page,
             "new_skus": new_skus,
-            "cart_count": cart_count,
             "sort": sort,
             "pages": pages
         }
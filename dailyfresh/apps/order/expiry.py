@@ -0,0 +1,176 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import transaction
+from django.db.models import F, Sum, Case, When, Value, IntegerField
+from django_redis import get_redis_connection
+from goods.models import GoodsSKU
+from goods import ranking
+from goods import stock as stock_mirror
+from goods import stock_buckets
+from order.models import OrderInfo, OrderGoods
+from order import payment
+from utils.redis_scripts import RedisScript
+
+# 超时未支付的订单自动取消, 归还库存
+# order_deadlines: 有序集合, 成员为订单id, 分数为支付截止时间; 取消时只读取到期的成员, 不扫描订单表
+ORDER_DEADLINE_KEY = 'order_deadlines'
+# 下单后多长时间(秒)未支付自动取消
+ORDER_PAY_TIMEOUT = 30 * 60
+# 取出的订单在该时间(秒)内没有处理完(进程崩溃等), 会被再次取出
+ORDER_CLAIM_TIMEOUT = 60
+# 已取消的订单状态
+ORDER_STATUS_CANCELED = 6
+# 取消支付宝订单前并发关闭交易的线程数
+ORDER_CLOSE_WORKERS = 8
+
+
+# 取出一批到期的订单id, 同时把它们的分数推迟ORDER_CLAIM_TIMEOUT秒(处理完成后删除)
+# KEYS[1]: order_deadlines
+# ARGV[1]: 当前时间  ARGV[2]: 最多取出的个数  ARGV[3]: 推迟后的分数
+CLAIM_EXPIRED = RedisScript("""
+local order_ids = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, order_id in ipairs(order_ids) do
+    redis.call('zadd', KEYS[1], ARGV[3], order_id)
+end
+return order_ids
+""")
+
+
+def schedule_cancel(*order_ids):
+    """下单后调用, 超时未支付时自动取消"""
+    if not order_ids:
+        return
+    deadline = time.time() + ORDER_PAY_TIMEOUT
+    conn = get_redis_connection('default')
+    args = []
+    for order_id in order_ids:
+        args.extend([deadline, order_id])
+    conn.execute_command('ZADD', ORDER_DEADLINE_KEY, *args)
+
+
+def unschedule_cancel(*order_ids):
+    """订单已支付, 不再需要取消"""
+    if order_ids:
+        get_redis_connection('default').zrem(ORDER_DEADLINE_KEY, *order_ids)
+
+
+def _restore_stock(counts):
+    """
+    归还库存和销量, 未分桶的商品一条UPDATE, 库存分桶的商品归还到分桶
+    :param counts: {商品id: 数量}
+    """
+    sharded = set(GoodsSKU.objects.filter(id__in=list(counts), stock_sharded=True).values_list('id', flat=True))
+    for sku_id in sorted(sharded):
+        stock_buckets.give_back(sku_id, counts[sku_id])
+
+    sku_ids = sorted(set(counts) - sharded)
+    if not sku_ids:
+        return
+    delta = Case(*[When(id=sku_id, then=Value(counts[sku_id])) for sku_id in sku_ids],
+                 output_field=IntegerField())
+    GoodsSKU.objects.filter(id__in=sku_ids).update(stock=F('stock') + delta, sales=F('sales') - delta)
+
+
+def revive_order(order_id, trade_no):
+    """
+    已取消的订单收到付款时恢复订单: 重新扣减库存, 更新为已支付
+    :return: 是否恢复成功(库存不足时不修改订单)
+    """
+    with transaction.atomic():
+        if not OrderInfo.objects.select_for_update()\
+                .filter(order_id=order_id, order_status=ORDER_STATUS_CANCELED).exists():
+            return False
+        order_skus = sorted(OrderGoods.objects.filter(order_id=order_id).select_related('sku'),
+                            key=lambda order_sku: order_sku.sku_id)
+
+        save_id = transaction.savepoint()
+        # 按商品id顺序扣减, 与下单时相同, 避免死锁
+        for order_sku in order_skus:
+            if order_sku.sku.stock_sharded:
+                res = stock_buckets.take(order_sku.sku_id, order_sku.count)
+            else:
+                res = GoodsSKU.objects.filter(id=order_sku.sku_id, stock__gte=order_sku.count)\
+                    .update(stock=F('stock') - order_sku.count, sales=F('sales') + order_sku.count)
+            if not res:
+                transaction.savepoint_rollback(save_id)
+                return False
+        transaction.savepoint_commit(save_id)
+
+        OrderInfo.objects.filter(order_id=order_id).update(trade_no=trade_no, order_status=4)  # 待评价
+
+    ranking.incr_sales([(order_sku.sku.type_id, order_sku.sku_id, order_sku.count) for order_sku in order_skus])
+    stock_mirror.clear_stock(*[order_sku.sku_id for order_sku in order_skus])
+    return True
+
+
+def _close_trades(order_ids):
+    """
+    关闭支付宝订单的交易, 已付款的订单更新为已支付(之后不会被取消)
+    :return: 请求支付宝失败, 需要下次重试的订单id
+    """
+    alipay_ids = list(OrderInfo.objects.filter(order_id__in=order_ids, pay_method=3, order_status=1)
+                      .values_list('order_id', flat=True))
+    if not alipay_ids:
+        return set()
+
+    retry = set()
+    with ThreadPoolExecutor(ORDER_CLOSE_WORKERS) as executor:
+        for order_id, (status, trade_no) in zip(alipay_ids, executor.map(payment.close_trade, alipay_ids)):
+            if status is None:
+                retry.add(order_id)
+            elif status == payment.PAY_PAID and payment.mark_order_paid(order_id, trade_no):
+                # 超时前已经付款, 只是没有收到通知
+                from celery_task.tasks import handle_order_paid
+                handle_order_paid.delay(order_id)
+    return retry
+
+
+def cancel_expired(batch_size=500):
+    """
+    取消一批超时未支付的订单, 支付宝订单先关闭交易, 取消后用户不能再付款
+    :return: (取出的订单数, 取消的订单数)
+    """
+    now = time.time()
+    order_ids = CLAIM_EXPIRED(keys=[ORDER_DEADLINE_KEY], args=[now, batch_size, now + ORDER_CLAIM_TIMEOUT])
+    order_ids = [order_id.decode() if isinstance(order_id, bytes) else order_id for order_id in order_ids]
+    if not order_ids:
+        return 0, 0
+    claimed = len(order_ids)
+
+    # 交易关闭失败的订单保留在截止时间集合中, ORDER_CLAIM_TIMEOUT秒后重试
+    retry = _close_trades(order_ids)
+    order_ids = [order_id for order_id in order_ids if order_id not in retry]
+
+    counts = {}
+    with transaction.atomic():
+        # 锁住仍是待支付的订单, 这期间支付成功的订单不会被取消
+        canceled = list(OrderInfo.objects.select_for_update()
+                        .filter(order_id__in=order_ids, order_status=1)
+                        .values_list('order_id', flat=True))
+        if canceled:
+            OrderInfo.objects.filter(order_id__in=canceled).update(order_status=ORDER_STATUS_CANCELED)
+            # 按商品汇总需要归还的数量
+            for row in OrderGoods.objects.filter(order_id__in=canceled).values('sku_id').annotate(count=Sum('count')):
+                counts[row['sku_id']] = row['count']
+            if counts:
+                _restore_stock(counts)
+
+    # 已取消和已支付的订单都不需要再处理
+    unschedule_cancel(*order_ids)
+
+    if counts:
+        type_ids = dict(GoodsSKU.objects.filter(id__in=list(counts)).values_list('id', 'type_id'))
+        ranking.incr_sales([(type_ids[sku_id], sku_id, -count) for sku_id, count in counts.items()])
+        stock_mirror.clear_stock(*counts)
+    return claimed, len(canceled)
+
+
+def pending_count():
+    """等待取消的订单数和最早的截止时间"""
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    pipe.zcard(ORDER_DEADLINE_KEY)
+    pipe.zrange(ORDER_DEADLINE_KEY, 0, 0, withscores=True)
+    count, first = pipe.execute()
+    return count, first[0][1] if first else None
@@ -0,0 +1,237 @@
+import json
+import time
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F
+from django_redis import get_redis_connection
+from goods.models import GoodsSKU
+from goods import ranking
+from goods import stock as stock_mirror
+from order.models import OrderInfo, OrderGoods
+from order import expiry
+from utils.redis_scripts import RedisScript
+
+# 秒杀: 开始时把秒杀库存和价格预加载到redis, 下单时在redis中原子扣减库存(预占),
+# 立即返回结果, 订单由celery分批写入mysql, mysql中的库存在写入订单时才扣减
+#
+# flash_sale_<商品id>: hash {stock: 剩余可预占库存, price: 秒杀价格, limit: 每人限购数量}, 键存在表示商品处于秒杀中
+# flash_buyers_<商品id>: set 已抢购的用户id, 每个用户限购一次
+# flash_order_queue: list 等待写入mysql的预占记录(包含预占时的秒杀价格)
+# flash_order_claims: 有序集合 正在写入mysql的预占记录, 分数为取出的时间, 写入失败时由对账任务归还库存
+FLASH_QUEUE = 'flash_order_queue'
+FLASH_CLAIMS = 'flash_order_claims'
+
+# 取出后超过该时间(秒)仍未写入完成, 对账时视为写入失败
+FLASH_PROCESSING_TIMEOUT = 300
+
+# 每人每次最多购买的数量(默认)
+FLASH_USER_LIMIT = 1
+
+# 运费
+FLASH_TRANSIT_PRICE = 10
+
+
+def flash_key(sku_id):
+    return 'flash_sale_%s' % sku_id
+
+
+def buyers_key(sku_id):
+    return 'flash_buyers_%s' % sku_id
+
+
+# 预占库存, 预占记录中写入当前的秒杀价格, 写入订单时不再读取(秒杀可能已经结束)
+# 返回状态: 0 预占成功  1 库存不足  2 已经抢购过  3 商品不在秒杀中  4 超过限购数量
+# KEYS[1]: flash_sale_<商品id>  KEYS[2]: flash_buyers_<商品id>  KEYS[3]: flash_order_queue
+# ARGV[1]: 用户id  ARGV[2]: 数量  ARGV[3]: 预占记录(json)
+RESERVE = RedisScript("""
+local stock = redis.call('hget', KEYS[1], 'stock')
+if not stock then
+    return 3
+end
+local limit = redis.call('hget', KEYS[1], 'limit')
+if limit and tonumber(ARGV[2]) > tonumber(limit) then
+    return 4
+end
+if tonumber(stock) < tonumber(ARGV[2]) then
+    return 1
+end
+if redis.call('sadd', KEYS[2], ARGV[1]) == 0 then
+    return 2
+end
+redis.call('hincrby', KEYS[1], 'stock', -tonumber(ARGV[2]))
+local item = cjson.decode(ARGV[3])
+item['price'] = redis.call('hget', KEYS[1], 'price')
+redis.call('rpush', KEYS[3], cjson.encode(item))
+return 0
+""")
+
+# 从等待队列中取出一批预占记录, 同时放入正在写入集合, 分数为取出的时间
+# KEYS[1]: flash_order_queue  KEYS[2]: flash_order_claims
+# ARGV[1]: 最多取出的条数  ARGV[2]: 当前时间
+TAKE = RedisScript("""
+local items = {}
+for i = 1, tonumber(ARGV[1]) do
+    local item = redis.call('lpop', KEYS[1])
+    if not item then
+        break
+    end
+    redis.call('zadd', KEYS[2], ARGV[2], item)
+    items[#items + 1] = item
+end
+return items
+""")
+
+
+# 归还预占的库存(秒杀已结束的不需要归还), 并允许用户重新抢购
+# KEYS[1]: flash_sale_<商品id>  KEYS[2]: flash_buyers_<商品id>
+# ARGV[1]: 用户id  ARGV[2]: 数量
+RELEASE = RedisScript("""
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('hincrby', KEYS[1], 'stock', tonumber(ARGV[2]))
+end
+redis.call('srem', KEYS[2], ARGV[1])
+""")
+
+
+def start(sku_id, stock, price=None, limit=FLASH_USER_LIMIT):
+    """
+    开始秒杀, 预加载库存(不能超过mysql中的库存), 库存分桶的商品抛出ValueError
+    :param limit: 每人限购数量
+    :return: 实际预加载的库存
+    """
+    if limit < 1:
+        raise ValueError('限购数量至少为1')
+    sku = GoodsSKU.objects.get(id=sku_id)
+    if sku.stock_sharded:
+        # 秒杀订单直接扣减商品表中的库存, 会被分桶汇总覆盖
+        raise ValueError('库存分桶的商品不能参加秒杀')
+    stock = min(stock, sku.stock)
+    if price is None:
+        price = sku.price
+
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    pipe.delete(buyers_key(sku_id))
+    pipe.hmset(flash_key(sku_id), {'stock': stock, 'price': str(price), 'limit': limit})
+    pipe.execute()
+    return stock
+
+
+def stop(sku_id):
+    """结束秒杀, 未卖出的库存本来就在mysql中, 不需要归还"""
+    get_redis_connection('default').delete(flash_key(sku_id), buyers_key(sku_id))
+
+
+def reserve(user_id, sku_id, count, order_id, addr_id, pay_method):
+    """
+    预占秒杀库存, 成功后预占记录进入等待队列
+    :return: 状态 0 预占成功  1 库存不足  2 已经抢购过  3 商品不在秒杀中  4 超过限购数量
+    """
+    item = json.dumps({
+        'order_id': order_id,
+        'user_id': user_id,
+        'sku_id': int(sku_id),
+        'count': count,
+        'addr_id': int(addr_id),
+        'pay_method': int(pay_method),
+        'time': time.time(),
+    })
+    return RESERVE(keys=[flash_key(sku_id), buyers_key(sku_id), FLASH_QUEUE],
+                   args=[user_id, count, item])
+
+
+def _release(pipe, items):
+    """归还预占的库存, 允许用户重新抢购(放在调用者的pipeline中执行)"""
+    for item in items:
+        RELEASE(keys=[flash_key(item['sku_id']), buyers_key(item['sku_id'])],
+                args=[item['user_id'], item['count']], conn=pipe)
+
+
+def persist_batch(batch_size=500):
+    """
+    把一批预占记录写入mysql
+    每个商品只执行一次带条件的库存扣减, 订单和订单商品各批量插入一次
+    :return: (写入成功的订单数, 写入失败的订单数)
+    """
+    conn = get_redis_connection('default')
+    raw_items = TAKE(keys=[FLASH_QUEUE, FLASH_CLAIMS], args=[batch_size, time.time()])
+    if not raw_items:
+        return 0, 0
+    items = [json.loads(raw.decode() if isinstance(raw, bytes) else raw) for raw in raw_items]
+
+    sku_ids = sorted(set(item['sku_id'] for item in items))
+    counts = defaultdict(int)
+    for item in items:
+        counts[item['sku_id']] += item['count']
+
+    failed = []
+    with transaction.atomic():
+        skus = GoodsSKU.objects.in_bulk(sku_ids)
+        ok_sku_ids = set()
+        for sku_id in sku_ids:
+            # 每个商品扣减一次库存, 按商品id顺序更新避免死锁
+            res = GoodsSKU.objects.filter(id=sku_id, stock__gte=counts[sku_id])\
+                .update(stock=F('stock') - counts[sku_id], sales=F('sales') + counts[sku_id])
+            if res:
+                ok_sku_ids.add(sku_id)
+
+        orders = []
+        order_goods = []
+        for item in items:
+            sku = skus.get(item['sku_id'])
+            if item['sku_id'] not in ok_sku_ids or sku is None:
+                # mysql中的库存不足(秒杀期间商品被其他途径卖出)
+                failed.append(item)
+                continue
+            # 预占时的秒杀价格
+            price = Decimal(item['price'])
+            orders.append(OrderInfo(order_id=item['order_id'],
+                                    user_id=item['user_id'],
+                                    addr_id=item['addr_id'],
+                                    pay_method=item['pay_method'],
+                                    total_count=item['count'],
+                                    total_price=price * item['count'],
+                                    transit_price=FLASH_TRANSIT_PRICE))
+            order_goods.append(OrderGoods(order_id=item['order_id'],
+                                          sku_id=item['sku_id'],
+                                          count=item['count'],
+                                          price=price))
+        OrderInfo.objects.bulk_create(orders)
+        OrderGoods.objects.bulk_create(order_goods)
+
+    # 写入完成, 从正在写入集合中移除; 写入失败的归还库存
+    pipe = conn.pipeline()
+    pipe.zrem(FLASH_CLAIMS, *raw_items)
+    _release(pipe, failed)
+    pipe.execute()
+
+    ranking.incr_sales([(skus[sku_id].type_id, sku_id, counts[sku_id]) for sku_id in ok_sku_ids])
+    stock_mirror.clear_stock(*ok_sku_ids)
+    # 在线支付的订单超时未支付自动取消
+    expiry.schedule_cancel(*[order.order_id for order in orders if order.pay_method != 1])
+    return len(orders), len(failed)
+
+
+def reconcile(timeout=FLASH_PROCESSING_TIMEOUT):
+    """
+    对账: 取出后超时仍在正在写入集合中的预占记录, 如果订单没有写入mysql(写入过程中进程崩溃等), 归还库存
+    按取出的时间判断, 在队列中等待较久的记录刚被取出时不会被误判
+    :return: (已写入的记录数, 归还库存的记录数)
+    """
+    conn = get_redis_connection('default')
+    stale = [(raw, json.loads(raw.decode() if isinstance(raw, bytes) else raw))
+             for raw in conn.zrangebyscore(FLASH_CLAIMS, '-inf', time.time() - timeout)]
+    if not stale:
+        return 0, 0
+
+    persisted = set(OrderInfo.objects.filter(order_id__in=[item['order_id'] for raw, item in stale])
+                    .values_list('order_id', flat=True))
+    released = [item for raw, item in stale if item['order_id'] not in persisted]
+
+    pipe = conn.pipeline()
+    pipe.zrem(FLASH_CLAIMS, *[raw for raw, item in stale])
+    _release(pipe, released)
+    pipe.execute()
+    return len(stale) - len(released), len(released)
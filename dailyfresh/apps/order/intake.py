@@ -0,0 +1,221 @@
+import json
+import time
+
+from django.db import transaction, close_old_connections
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+from cart.utils import delete_cart_skus
+from order.models import OrderInfo
+from order import flash_sale
+from order.utils import new_order_id, create_order, order_committed
+
+# 排队下单: 下单请求校验后写入redis stream, 立即返回排队号(即订单id), 前端轮询排队结果
+# 按商品分区, 每个分区由一个消费进程依次创建订单, 同一商品的排队订单不再同时争抢行锁
+# 只有所有商品都在同一分区的订单才排队; 商品跨分区的订单会与多个分区争抢行锁, 仍直接下单
+#
+# order_intake_<分区>: stream 等待处理的下单请求
+# order_ticket_<订单id>: hash 排队结果 {status: queued/done, user_id, res, errmsg, enqueued}
+# order_intake_latency_<分区>: list 最近处理的下单请求从排队到完成的耗时(毫秒)
+ORDER_INTAKE_PARTITIONS = 4
+ORDER_INTAKE_GROUP = 'order_intake'
+# 排队结果保存时间(秒)
+ORDER_TICKET_TIMEOUT = 24 * 3600
+# 每个分区保留的耗时记录条数
+ORDER_INTAKE_LATENCY_SAMPLES = 1000
+
+TICKET_QUEUED = 'queued'
+TICKET_DONE = 'done'
+
+
+def stream_key(partition):
+    return 'order_intake_%d' % partition
+
+
+def ticket_key(ticket):
+    return 'order_ticket_%s' % ticket
+
+
+def latency_key(partition):
+    return 'order_intake_latency_%d' % partition
+
+
+def partition_of(sku_ids):
+    """
+    订单所在的分区: 商品id对分区数取余, 商品跨分区时返回None(不能排队)
+    同一商品的排队订单总在同一分区, 由一个消费进程依次处理
+    """
+    partitions = set(int(sku_id) % ORDER_INTAKE_PARTITIONS for sku_id in sku_ids)
+    if len(partitions) != 1:
+        return None
+    return partitions.pop()
+
+
+def enqueue(user_id, addr_id, pay_method, sku_ids, counts):
+    """
+    下单请求排队(参数由调用者校验, 商品id和数量都必须是数字, 商品必须在同一分区)
+    :param counts: 与sku_ids对应的购买数量(排队时从购物车读取)
+    :return: 排队号
+    """
+    ticket = new_order_id()
+    data = json.dumps({
+        'ticket': ticket,
+        'user_id': user_id,
+        'addr_id': int(addr_id),
+        'pay_method': pay_method,
+        'sku_ids': [int(sku_id) for sku_id in sku_ids],
+        'counts': [int(count) for count in counts],
+    })
+    now = time.time()
+
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    pipe.hmset(ticket_key(ticket), {'status': TICKET_QUEUED, 'user_id': user_id, 'enqueued': now})
+    pipe.expire(ticket_key(ticket), ORDER_TICKET_TIMEOUT)
+    pipe.execute_command('XADD', stream_key(partition_of(sku_ids)), '*', 'data', data, 'enqueued', now)
+    pipe.execute()
+    return ticket
+
+
+def get_ticket(ticket, user_id):
+    """
+    查询排队结果, 排队号不存在或不属于该用户时返回None
+    :return: {status, res, errmsg}
+    """
+    values = get_redis_connection('default').hgetall(ticket_key(ticket))
+    values = {key.decode(): value.decode() for key, value in values.items()}
+    if not values or values.get('user_id') != str(user_id):
+        return None
+    return values
+
+
+def ensure_group(conn, partition):
+    """创建消费组(已存在时忽略)"""
+    try:
+        conn.execute_command('XGROUP', 'CREATE', stream_key(partition), ORDER_INTAKE_GROUP, '0', 'MKSTREAM')
+    except ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def _parse_messages(reply):
+    """解析XREADGROUP的返回值: [(消息id, 字段dict), ...]"""
+    messages = []
+    for stream, entries in reply or []:
+        for message_id, fields in entries:
+            if fields is None:
+                # 已被删除的消息
+                messages.append((message_id, None))
+                continue
+            # 新版本redis-py已解析为dict, 旧版本为 [字段, 值, 字段, 值, ...]
+            if isinstance(fields, dict):
+                values = fields
+            else:
+                values = dict(zip(fields[::2], fields[1::2]))
+            messages.append((message_id, {key.decode() if isinstance(key, bytes) else key:
+                                          value.decode() if isinstance(value, bytes) else value
+                                          for key, value in values.items()}))
+    return messages
+
+
+def _in_flash_sale(conn, sku_ids):
+    """订单中是否有正在秒杀的商品"""
+    pipe = conn.pipeline()
+    for sku_id in sku_ids:
+        pipe.exists(flash_sale.flash_key(sku_id))
+    return any(pipe.execute())
+
+
+def process(conn, partition, message_id, fields):
+    """处理一个下单请求, 结果写入排队结果"""
+    if fields is not None:
+        data = json.loads(fields['data'])
+        ticket = data['ticket']
+
+        if OrderInfo.objects.filter(order_id=ticket).exists():
+            # 已经处理过(上次处理后, 确认消息前进程退出)
+            result = {"res": 7, "errmsg": "创建订单成功"}
+        elif _in_flash_sale(conn, data['sku_ids']):
+            # 排队期间商品开始秒杀, 与下单接口相同不允许普通下单, 否则会卖出已被预占的库存
+            result = {"res": 8, "errmsg": "秒杀商品请通过秒杀下单"}
+        else:
+            with transaction.atomic():
+                result, sales = create_order(data['user_id'], data['addr_id'], data['pay_method'],
+                                             data['sku_ids'], data['counts'], ticket)
+            if result['res'] == 7:
+                order_committed(ticket, data['pay_method'], sales)
+                # 清除用户购物车中对应的记录
+                delete_cart_skus(data['user_id'], *data['sku_ids'])
+
+        latency = int((time.time() - float(fields['enqueued'])) * 1000)
+        pipe = conn.pipeline()
+        pipe.hmset(ticket_key(ticket), {'status': TICKET_DONE, 'res': result['res'],
+                                        'errmsg': result['errmsg'], 'latency': latency})
+        pipe.expire(ticket_key(ticket), ORDER_TICKET_TIMEOUT)
+        pipe.lpush(latency_key(partition), latency)
+        pipe.ltrim(latency_key(partition), 0, ORDER_INTAKE_LATENCY_SAMPLES - 1)
+        pipe.execute()
+
+    # 确认并删除消息, stream的长度即为等待处理的请求数
+    pipe = conn.pipeline()
+    pipe.execute_command('XACK', stream_key(partition), ORDER_INTAKE_GROUP, message_id)
+    pipe.execute_command('XDEL', stream_key(partition), message_id)
+    pipe.execute()
+
+
+def consume(partition, consumer='worker', count=10, block_ms=5000, stop=None):
+    """
+    分区的消费循环, 每个分区只运行一个消费进程, 依次处理下单请求
+    :param stop: 返回True时退出循环的函数
+    """
+    conn = get_redis_connection('default')
+    ensure_group(conn, partition)
+    key = stream_key(partition)
+
+    # 先处理上次退出时已读取未确认的消息
+    last_id = '0'
+    while not (stop and stop()):
+        # 长时间运行的进程, 关闭已超时的数据库连接
+        close_old_connections()
+        reply = conn.execute_command('XREADGROUP', 'GROUP', ORDER_INTAKE_GROUP, consumer,
+                                     'COUNT', count, 'BLOCK', block_ms, 'STREAMS', key, last_id)
+        messages = _parse_messages(reply)
+        if not messages and last_id == '0':
+            # 未确认的消息已处理完, 开始读取新消息
+            last_id = '>'
+            continue
+        for message_id, fields in messages:
+            process(conn, partition, message_id, fields)
+
+
+def metrics():
+    """
+    排队下单的指标: 每个分区的排队长度, 已读取未确认数, 处理耗时
+    :return: [{partition, depth, pending, p50, p95, max, samples}, ...]
+    """
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    for partition in range(ORDER_INTAKE_PARTITIONS):
+        pipe.execute_command('XLEN', stream_key(partition))
+        pipe.lrange(latency_key(partition), 0, -1)
+    results = pipe.execute()
+
+    report = []
+    for partition in range(ORDER_INTAKE_PARTITIONS):
+        depth, latencies = results[partition * 2:partition * 2 + 2]
+        try:
+            pending = conn.execute_command('XPENDING', stream_key(partition), ORDER_INTAKE_GROUP)
+            pending = pending['pending'] if isinstance(pending, dict) else pending[0]
+        except ResponseError:
+            # 消费组还没有创建
+            pending = 0
+        latencies = sorted(int(latency) for latency in latencies)
+        report.append({
+            'partition': partition,
+            'depth': depth,
+            'pending': pending,
+            'samples': len(latencies),
+            'p50': latencies[len(latencies) // 2] if latencies else 0,
+            'p95': latencies[int(len(latencies) * 0.95)] if latencies else 0,
+            'max': latencies[-1] if latencies else 0,
+        })
+    return report
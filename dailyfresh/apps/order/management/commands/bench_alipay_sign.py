@@ -0,0 +1,51 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from order.payment import create_alipay, get_alipay, reset_alipay
+
+
+def sign(alipay, i):
+    """生成一次支付链接参数(包含一次RSA签名)"""
+    return alipay.api_alipay_trade_wap_pay(
+        out_trade_no='bench%d' % i,
+        total_amount='10.00',
+        subject='天天生鲜bench%d' % i,
+        return_url=None,
+        notify_url=None
+    )
+
+
+class Command(BaseCommand):
+    """支付宝签名基准测试: 每次请求创建接口对象 vs 进程内共享接口对象"""
+    help = '对比每次创建AliPay(读取并解析密钥)与共享AliPay时的签名吞吐量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000, help='签名次数')
+        parser.add_argument('--threads', type=int, default=4, help='共享对象的并发线程数')
+
+    def handle(self, *args, **options):
+        count = options['count']
+
+        # 原来的实现: 每次请求都读取密钥文件并解析
+        start = time.perf_counter()
+        for i in range(count):
+            sign(create_alipay(), i)
+        self._report('per_request', count, time.perf_counter() - start)
+
+        # 共享对象, 单线程
+        reset_alipay()
+        start = time.perf_counter()
+        for i in range(count):
+            sign(get_alipay(), i)
+        self._report('shared', count, time.perf_counter() - start)
+
+        # 共享对象, 多线程同时签名
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options['threads']) as executor:
+            list(executor.map(lambda i: sign(get_alipay(), i), range(count)))
+        self._report('shared_%dthreads' % options['threads'], count, time.perf_counter() - start)
+
+    def _report(self, name, count, elapsed):
+        self.stdout.write('%-18s signs=%d time=%.3fs rate=%.0f/s per_sign=%.3fms' % (
+            name, count, elapsed, count / elapsed, elapsed * 1000 / count))
@@ -0,0 +1,46 @@
+import time
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand
+from utils.snowflake import Snowflake, parse_id
+
+
+def generate(args):
+    """在子进程中生成count个id, 返回(id列表, 耗时)"""
+    worker_id, count = args
+    generator = Snowflake(worker_id)
+    start = time.perf_counter()
+    ids = [generator.next_str() for _ in range(count)]
+    return ids, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    """订单id生成器基准测试"""
+    help = '多进程同时生成订单id, 统计吞吐量并检查是否重复, 是否按时间递增'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4, help='进程数')
+        parser.add_argument('--count', type=int, default=200000, help='每个进程生成的id个数')
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+        count = options['count']
+
+        start = time.perf_counter()
+        with Pool(processes) as pool:
+            results = pool.map(generate, [(worker_id, count) for worker_id in range(processes)])
+        elapsed = time.perf_counter() - start
+
+        all_ids = []
+        for worker_id, (ids, worker_elapsed) in enumerate(results):
+            # 同一进程生成的id字符串必须严格递增
+            ordered = all(a < b for a, b in zip(ids, ids[1:]))
+            self.stdout.write('worker=%-3d ids=%d time=%.3fs rate=%.0f/s ordered=%s' % (
+                worker_id, len(ids), worker_elapsed, len(ids) / worker_elapsed, ordered))
+            all_ids.extend(ids)
+
+        duplicates = len(all_ids) - len(set(all_ids))
+        first = min(parse_id(value)[0] for value in all_ids)
+        last = max(parse_id(value)[0] for value in all_ids)
+        self.stdout.write('total ids=%d time=%.3fs rate=%.0f/s duplicates=%d span=%.3fs' % (
+            len(all_ids), elapsed, len(all_ids) / elapsed, duplicates, last - first))
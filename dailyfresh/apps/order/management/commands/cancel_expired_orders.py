@@ -0,0 +1,56 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+from order import expiry
+from order.models import OrderInfo
+
+
+class Command(BaseCommand):
+    """取消超时未支付的订单"""
+    help = '取消超时未支付的订单并归还库存; --backfill 把已有的待支付订单加入超时队列(只需执行一次)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='每批处理的订单数')
+        parser.add_argument('--backfill', action='store_true', help='把已有的待支付在线支付订单加入超时队列')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if options['backfill']:
+            self.backfill(batch_size)
+
+        count, first = expiry.pending_count()
+        self.stdout.write('等待取消的订单: %d, 最早截止时间: %s' % (
+            count, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(first)) if first else '-'))
+
+        claimed = canceled = 0
+        start = time.perf_counter()
+        while True:
+            batch_claimed, batch_canceled = expiry.cancel_expired(batch_size)
+            if not batch_claimed:
+                break
+            claimed += batch_claimed
+            canceled += batch_canceled
+        elapsed = time.perf_counter() - start
+        self.stdout.write('处理%d个到期订单, 取消%d个, 耗时%.3fs' % (claimed, canceled, elapsed))
+
+    def backfill(self, batch_size):
+        """按创建时间计算截止时间, 分批加入超时队列"""
+        conn = get_redis_connection('default')
+        orders = OrderInfo.objects.filter(order_status=1).exclude(pay_method=1).order_by('order_id')
+        last_id = ''
+        total = 0
+        while True:
+            rows = list(orders.filter(order_id__gt=last_id).values_list('order_id', 'create_time')[:batch_size])
+            if not rows:
+                break
+            args = []
+            for order_id, create_time in rows:
+                deadline = create_time + timedelta(seconds=expiry.ORDER_PAY_TIMEOUT)
+                args.extend([deadline.timestamp(), order_id])
+            # NX: 已在队列中的订单保持原来的截止时间
+            conn.execute_command('ZADD', expiry.ORDER_DEADLINE_KEY, 'NX', *args)
+            total += len(rows)
+            last_id = rows[-1][0]
+        self.stdout.write('加入超时队列: %d个订单' % total)
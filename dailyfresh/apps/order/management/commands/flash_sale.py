@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from order import flash_sale
+
+
+class Command(BaseCommand):
+    """管理秒杀活动"""
+    help = '开始/结束秒杀, 写入等待中的秒杀订单, 对账'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['start', 'stop', 'persist', 'reconcile'])
+        parser.add_argument('--sku', type=int, help='商品id')
+        parser.add_argument('--stock', type=int, help='秒杀库存(不能超过商品库存)')
+        parser.add_argument('--price', help='秒杀价格, 默认为商品价格')
+        parser.add_argument('--limit', type=int, default=flash_sale.FLASH_USER_LIMIT, help='每人限购数量')
+
+    def handle(self, *args, **options):
+        action = options['action']
+        sku_id = options['sku']
+
+        if action == 'start':
+            if sku_id is None or options['stock'] is None:
+                raise CommandError('开始秒杀需要 --sku 和 --stock')
+            try:
+                stock = flash_sale.start(sku_id, options['stock'], options['price'], options['limit'])
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write('商品%d开始秒杀, 库存%d' % (sku_id, stock))
+        elif action == 'stop':
+            if sku_id is None:
+                raise CommandError('结束秒杀需要 --sku')
+            flash_sale.stop(sku_id)
+            self.stdout.write('商品%d秒杀结束' % sku_id)
+        elif action == 'persist':
+            persisted = released = 0
+            while True:
+                ok, failed = flash_sale.persist_batch()
+                if not ok and not failed:
+                    break
+                persisted += ok
+                released += failed
+            self.stdout.write('写入%d个订单, 库存不足归还%d个' % (persisted, released))
+        else:
+            persisted, released = flash_sale.reconcile()
+            self.stdout.write('已写入%d个, 归还库存%d个' % (persisted, released))
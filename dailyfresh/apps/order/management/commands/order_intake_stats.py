@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from order import intake
+
+
+class Command(BaseCommand):
+    """排队下单的指标"""
+    help = '输出每个分区的排队长度, 已读取未确认的请求数和处理耗时(毫秒)'
+
+    def handle(self, *args, **options):
+        for stats in intake.metrics():
+            self.stdout.write('partition=%d depth=%d pending=%d samples=%d p50=%dms p95=%dms max=%dms' % (
+                stats['partition'], stats['depth'], stats['pending'], stats['samples'],
+                stats['p50'], stats['p95'], stats['max']))
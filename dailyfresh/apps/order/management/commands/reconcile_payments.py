@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from order.payment import StubAliPay, refund_orders
+from order.reconciliation import reconcile_pending_payments
+
+
+class Command(BaseCommand):
+    """支付对账"""
+    help = '分批查询待支付的支付宝订单, 批量更新已支付的订单, 输出吞吐量和等待时间'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='每批读取的订单数')
+        parser.add_argument('--workers', type=int, default=8, help='并发查询的线程数')
+        parser.add_argument('--max-orders', type=int, default=5000, help='最多对账的订单数')
+        parser.add_argument('--stub', action='store_true', help='使用本地模拟的支付宝接口(离线压测)')
+        parser.add_argument('--stub-delay', type=float, default=0, help='模拟接口第一次查询后多少秒视为已付款')
+
+    def handle(self, *args, **options):
+        alipay = StubAliPay(options['stub_delay']) if options['stub'] else None
+        report = reconcile_pending_payments(batch_size=options['batch_size'],
+                                            workers=options['workers'],
+                                            max_orders=options['max_orders'],
+                                            alipay=alipay)
+        self.stdout.write('checked=%d paid=%d updated=%d pending=%d failed=%d errors=%d batches=%d' % (
+            report['checked'], report['paid'], report['updated'], report['pending'],
+            report['failed'], report['errors'], report['batches']))
+        self.stdout.write('time=%.3fs rate=%.0f orders/s max_lag=%.0fs finished=%s' % (
+            report['elapsed'], report['rate'], report['max_lag'], report['finished']))
+        self.stdout.write('revived=%d refund=%d' % (report['revived'], report['refund']))
+        for order_id, trade_no in sorted(refund_orders().items()):
+            self.stdout.write('待退款: 订单%s 交易号%s' % (order_id, trade_no))
@@ -0,0 +1,30 @@
+import signal
+import socket
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from order import intake
+
+
+class Command(BaseCommand):
+    """排队下单的消费进程"""
+    help = '依次处理一个分区中的排队下单请求, 每个分区运行一个进程(需要settings.ORDER_INTAKE_QUEUE = True)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('partition', type=int, help='分区序号, 0~%d' % (intake.ORDER_INTAKE_PARTITIONS - 1))
+        parser.add_argument('--count', type=int, default=10, help='每次读取的请求数')
+
+    def handle(self, *args, **options):
+        partition = options['partition']
+        if not 0 <= partition < intake.ORDER_INTAKE_PARTITIONS:
+            raise CommandError('分区序号超出范围')
+
+        # 收到退出信号后处理完当前请求再退出
+        stopped = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopped.append(signum))
+        signal.signal(signal.SIGINT, lambda signum, frame: stopped.append(signum))
+
+        consumer = '%s-%d' % (socket.gethostname(), os.getpid())
+        self.stdout.write('分区%d开始处理排队下单请求(%s)' % (partition, consumer))
+        intake.consume(partition, consumer, count=options['count'], block_ms=1000, stop=lambda: bool(stopped))
+        self.stdout.write('分区%d已退出' % partition)
@@ -32,6 +32,7 @@ class OrderInfo(BaseModel):
         3: "待发货",
         4: "待评价",
         5: "已完成",
+        6: "已取消",
     }
 
     ORDER_STATUS_CHOICES = (
@@ -39,7 +40,8 @@ class OrderInfo(BaseModel):
         (2, '待发货'),
         (3, '待发货'),
         (4, '待评价'),
-        (5, '已完成')
+        (5, '已完成'),
+        (6, '已取消')
     )
 
     order_id = models.CharField(max_length=128, primary_key=True, verbose_name='订单id')
@@ -0,0 +1,297 @@
+import threading
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db.models import F
+from django_redis import get_redis_connection
+from alipay import AliPay
+from order.models import OrderInfo
+
+# 支付结果查询: 由celery任务轮询支付宝, 结果写入redis, 查询接口直接读取redis
+# pay_status_<订单id>: 支付状态 pending 等待付款  paid 已支付  failed 交易已关闭
+# pay_notify_<订单id>: list, 得到最终结果时写入一条, 用于长轮询等待
+# pay_checking_<订单id>: 存在表示已有celery任务在轮询该订单
+# pay_refunds: hash {订单id: 支付宝交易号} 已取消后才付款且库存不足, 需要退款的订单
+PAY_PENDING = 'pending'
+PAY_PAID = 'paid'
+PAY_FAILED = 'failed'
+PAY_REFUND_KEY = 'pay_refunds'
+
+# 支付状态保存时间(秒)
+PAY_STATUS_TIMEOUT = 24 * 3600
+# 交易关闭的状态只保存较短时间(秒), 之后用户再次查询时重新查询支付宝
+PAY_FAILED_TIMEOUT = 60
+# celery任务查询支付宝的间隔(秒)
+PAY_CHECK_INTERVAL = 5
+# 超过该时间(秒)仍未付款, 停止轮询(用户再次查询时重新开始)
+PAY_CHECK_DURATION = 30 * 60
+# 查询接口长轮询的最长等待时间(秒)
+PAY_CHECK_MAX_WAIT = 10
+# 配置了异步通知地址时, 支付结果一般由通知得到; 轮询在该时间(秒)后才开始, 作为通知丢失时的补偿
+PAY_NOTIFY_GRACE = 60
+
+# 异步通知中表示支付成功的交易状态
+TRADE_PAID_STATUSES = ('TRADE_SUCCESS', 'TRADE_FINISHED')
+# 关闭交易时表示交易不存在(用户没有打开支付页面)的错误码
+TRADE_NOT_EXIST = 'ACQ.TRADE_NOT_EXIST'
+
+
+def pay_status_key(order_id):
+    return 'pay_status_%s' % order_id
+
+
+def pay_notify_key(order_id):
+    return 'pay_notify_%s' % order_id
+
+
+def pay_checking_key(order_id):
+    return 'pay_checking_%s' % order_id
+
+
+class StubAliPay(object):
+    """
+    本地模拟的支付宝接口, 用于离线压测(settings.ALIPAY_STUB = True)
+    第一次查询订单后经过 ALIPAY_STUB_PAY_DELAY 秒视为用户已付款
+    """
+    def __init__(self, pay_delay):
+        self.pay_delay = pay_delay
+
+    def api_alipay_trade_wap_pay(self, out_trade_no, total_amount, subject, return_url=None, notify_url=None,
+                                 **kwargs):
+        return 'out_trade_no=%s&total_amount=%s&stub=1' % (out_trade_no, total_amount)
+
+    def api_alipay_trade_query(self, out_trade_no=None, trade_no=None):
+        conn = get_redis_connection('default')
+        if conn.exists('alipay_stub_closed_%s' % out_trade_no):
+            return {'code': '10000', 'trade_status': 'TRADE_CLOSED', 'out_trade_no': out_trade_no}
+        key = 'alipay_stub_%s' % out_trade_no
+        conn.set(key, time.time(), ex=PAY_STATUS_TIMEOUT, nx=True)
+        first_query = float(conn.get(key))
+        if time.time() - first_query < self.pay_delay:
+            return {'code': '10000', 'trade_status': 'WAIT_BUYER_PAY', 'out_trade_no': out_trade_no}
+        return {'code': '10000', 'trade_status': 'TRADE_SUCCESS', 'out_trade_no': out_trade_no,
+                'trade_no': 'STUB%s' % out_trade_no}
+
+    def api_alipay_trade_close(self, out_trade_no=None, trade_no=None, operator_id=None):
+        """模拟关闭交易: 已视为付款的交易不能关闭"""
+        conn = get_redis_connection('default')
+        first_query = conn.get('alipay_stub_%s' % out_trade_no)
+        if first_query is not None and time.time() - float(first_query) >= self.pay_delay:
+            return {'code': '40004', 'sub_code': 'ACQ.TRADE_STATUS_ERROR', 'out_trade_no': out_trade_no}
+        conn.set('alipay_stub_closed_%s' % out_trade_no, 1, ex=PAY_STATUS_TIMEOUT)
+        if first_query is None:
+            return {'code': '40004', 'sub_code': TRADE_NOT_EXIST, 'out_trade_no': out_trade_no}
+        return {'code': '10000', 'out_trade_no': out_trade_no}
+
+    def verify(self, data, signature):
+        """模拟验签: 签名为stub即视为通过"""
+        return signature == 'stub'
+
+
+def create_alipay():
+    """根据配置创建支付宝接口对象(读取并解析密钥文件)"""
+    if getattr(settings, 'ALIPAY_STUB', False):
+        return StubAliPay(getattr(settings, 'ALIPAY_STUB_PAY_DELAY', 3))
+
+    return AliPay(
+        appid=settings.ALIPAY_APPID,
+        app_notify_url=settings.ALIPAY_NOTIFY_URL,
+        app_private_key_path=settings.ALIPAY_PRIVATE_KEY_PATH,
+        # alipay public key, do not use your own public key!
+        alipay_public_key_path=settings.ALIPAY_PUBLIC_KEY_PATH,
+        sign_type=settings.ALIPAY_SIGN_TYPE,  # RSA or RSA2
+        debug=settings.ALIPAY_DEBUG,  # 沙箱环境,所以需要设置为True
+    )
+
+
+# 进程内共享的支付宝接口对象: 密钥只在第一次使用时解析一次
+# 签名和验签只读取密钥, 多个线程可以同时使用
+_alipay = None
+_alipay_lock = threading.Lock()
+
+
+def get_alipay():
+    """获取支付宝接口对象, 配置了ALIPAY_STUB时返回本地模拟接口"""
+    global _alipay
+    if _alipay is None:
+        with _alipay_lock:
+            if _alipay is None:
+                _alipay = create_alipay()
+    return _alipay
+
+
+def reset_alipay():
+    """丢弃共享的接口对象(修改配置或更换密钥后调用), 下次使用时重新创建"""
+    global _alipay
+    with _alipay_lock:
+        _alipay = None
+
+
+def get_pay_status(order_id):
+    """读取redis中的支付状态, 没有时返回None"""
+    status = get_redis_connection('default').get(pay_status_key(order_id))
+    return status.decode() if status else None
+
+
+def set_pay_status(order_id, status):
+    """保存支付状态, 最终结果同时通知长轮询等待的请求"""
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    pipe.set(pay_status_key(order_id), status,
+             ex=PAY_FAILED_TIMEOUT if status == PAY_FAILED else PAY_STATUS_TIMEOUT)
+    if status != PAY_PENDING:
+        pipe.rpush(pay_notify_key(order_id), status)
+        pipe.expire(pay_notify_key(order_id), PAY_CHECK_MAX_WAIT * 2)
+    pipe.execute()
+
+
+def start_pay_check(order_id):
+    """
+    开始轮询订单的支付结果(同一订单只有一个celery任务在轮询)
+    :return: 是否发送了新的任务
+    """
+    conn = get_redis_connection('default')
+    if not conn.set(pay_checking_key(order_id), 1, ex=PAY_CHECK_DURATION + 60, nx=True):
+        return False
+    conn.set(pay_status_key(order_id), PAY_PENDING, ex=PAY_STATUS_TIMEOUT)
+    # 会收到异步通知时, 延迟开始轮询, 大多数订单不需要查询支付宝
+    countdown = PAY_NOTIFY_GRACE if settings.ALIPAY_NOTIFY_URL else 0
+    from celery_task.tasks import check_pay_result
+    check_pay_result.apply_async((order_id, time.time() + PAY_CHECK_DURATION), countdown=countdown)
+    return True
+
+
+def wait_pay_status(order_id, timeout):
+    """长轮询: 最多等待timeout秒, 直到得到最终支付结果"""
+    status = get_pay_status(order_id)
+    if status in (PAY_PAID, PAY_FAILED) or timeout <= 0:
+        return status
+
+    conn = get_redis_connection('default')
+    key = pay_notify_key(order_id)
+    item = conn.blpop(key, timeout=min(int(timeout), PAY_CHECK_MAX_WAIT))
+    if item is not None:
+        # 放回去, 同一订单的其他等待请求也能收到
+        conn.rpush(key, item[1])
+    return get_pay_status(order_id)
+
+
+def query_pay_result(order_id):
+    """
+    查询一次支付宝, 支付成功时更新订单(celery任务中调用)
+    :return: 支付状态
+    """
+    response = get_alipay().api_alipay_trade_query(out_trade_no=order_id)
+    code = response.get('code')
+
+    if code == '10000' and response.get('trade_status') == "TRADE_SUCCESS":
+        # 支付成功, 只更新仍是待支付状态的订单
+        if mark_order_paid(order_id, response.get('trade_no')):
+            from celery_task.tasks import handle_order_paid
+            handle_order_paid.delay(order_id)
+        return PAY_PAID
+
+    if code == '10000' and response.get('trade_status') == "TRADE_CLOSED":
+        # 交易已关闭(超时未付款或已全额退款)
+        return PAY_FAILED
+
+    # 等待用户付款(交易不存在, WAIT_BUYER_PAY), 以及系统繁忙等临时错误, 继续轮询
+    return PAY_PENDING
+
+
+def close_trade(order_id):
+    """
+    关闭支付宝交易(取消超时订单前调用), 关闭后用户不能再付款; 交易已付款时不能关闭
+    :return: (支付状态, 支付宝交易号) 交易已关闭或不存在时为PAY_FAILED, 已付款时为PAY_PAID, 请求失败时为None
+    """
+    alipay = get_alipay()
+    try:
+        response = alipay.api_alipay_trade_close(out_trade_no=order_id)
+        if response.get('code') == '10000' or response.get('sub_code') == TRADE_NOT_EXIST:
+            return PAY_FAILED, None
+        # 不能关闭: 交易已付款或已关闭, 查询交易状态
+        response = alipay.api_alipay_trade_query(out_trade_no=order_id)
+    except Exception as e:
+        return None, None
+
+    code = response.get('code')
+    if code == '10000' and response.get('trade_status') in TRADE_PAID_STATUSES:
+        return PAY_PAID, response.get('trade_no')
+    if code == '40004' or (code == '10000' and response.get('trade_status') == 'TRADE_CLOSED'):
+        return PAY_FAILED, None
+    return None, None
+
+
+def mark_order_paid(order_id, trade_no, total_amount=None):
+    """
+    把待支付的订单更新为已支付, 一条带条件的UPDATE, 重复调用只有第一次生效
+    :param total_amount: 支付金额, 传入时必须与订单金额(含运费)一致
+    :return: 是否更新了订单
+    """
+    orders = OrderInfo.objects.filter(order_id=order_id, pay_method=3, order_status=1)
+    if total_amount is not None:
+        orders = orders.filter(total_price=total_amount - F('transit_price'))
+    return orders.update(trade_no=trade_no, order_status=4) == 1  # 待评价
+
+
+def handle_canceled_paid(order_id, trade_no):
+    """
+    已取消的订单收到付款(取消时交易还不存在, 之后用户才付款): 库存足够时恢复订单, 否则记录为待退款
+    :return: 是否恢复了订单
+    """
+    from order import expiry
+    if expiry.revive_order(order_id, trade_no):
+        set_pay_status(order_id, PAY_PAID)
+        from celery_task.tasks import handle_order_paid
+        handle_order_paid.delay(order_id)
+        return True
+    get_redis_connection('default').hset(PAY_REFUND_KEY, order_id, trade_no or '')
+    return False
+
+
+def refund_orders():
+    """需要退款的订单 {订单id: 支付宝交易号}"""
+    return {order_id.decode(): trade_no.decode()
+            for order_id, trade_no in get_redis_connection('default').hgetall(PAY_REFUND_KEY).items()}
+
+
+def handle_notify(data):
+    """
+    处理支付宝异步通知
+    :param data: 通知参数(dict)
+    :return: 是否处理成功(返回False时支付宝会重新通知)
+    """
+    data = dict(data)
+    signature = data.pop('sign', None)
+    if not signature or not get_alipay().verify(data, signature):
+        return False
+
+    if data.get('app_id') != settings.ALIPAY_APPID:
+        return False
+
+    order_id = data.get('out_trade_no')
+    if data.get('trade_status') not in TRADE_PAID_STATUSES:
+        # 等待付款, 交易关闭等通知, 不需要处理
+        return True
+
+    try:
+        total_amount = Decimal(data.get('total_amount'))
+    except (TypeError, InvalidOperation):
+        return False
+
+    if mark_order_paid(order_id, data.get('trade_no'), total_amount):
+        # 通知长轮询等待的请求, 其余工作交给celery
+        set_pay_status(order_id, PAY_PAID)
+        from celery_task.tasks import handle_order_paid
+        handle_order_paid.delay(order_id)
+        return True
+
+    # 没有更新: 重复通知(订单已支付)返回成功; 订单不存在或金额不一致返回失败
+    order = OrderInfo.objects.filter(order_id=order_id, pay_method=3).first()
+    if order is None or order.total_price + order.transit_price != total_amount:
+        return False
+    if order.order_status == 6:  # 已取消
+        handle_canceled_paid(order_id, data.get('trade_no'))
+        return True
+    return order.order_status != 1
@@ -0,0 +1,150 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+from django.db.models import Case, When, Value, CharField
+from django_redis import get_redis_connection
+from order.models import OrderInfo
+from order import payment
+from order import expiry
+from utils.pagination import keyset_filter, encode_cursor, decode_cursor
+
+# 支付对账: 定期查询支付宝, 补上没有收到通知(用户也没有查询)的待支付订单
+# 按 (create_time, order_id) 游标分批读取待支付订单, 线程池并发查询, 每批一次批量更新
+RECONCILE_ORDERING = ['create_time', 'order_id']
+# 上次对账停止的位置, 下次从这里继续, 读到末尾后从头开始
+RECONCILE_CURSOR_KEY = 'pay_reconcile_cursor'
+# 只对账创建超过该时间(秒)的订单, 刚创建的订单等待用户付款和异步通知
+RECONCILE_MIN_AGE = 5 * 60
+
+
+def _query(alipay, order_id):
+    """查询一个订单, 返回 (订单id, 支付状态, 支付宝交易号)"""
+    try:
+        response = alipay.api_alipay_trade_query(out_trade_no=order_id)
+    except Exception as e:
+        return order_id, None, None
+
+    code = response.get('code')
+    if code == '10000' and response.get('trade_status') in payment.TRADE_PAID_STATUSES:
+        return order_id, payment.PAY_PAID, response.get('trade_no')
+    if code == '10000' and response.get('trade_status') == 'TRADE_CLOSED':
+        return order_id, payment.PAY_FAILED, None
+    if code == '40004' or (code == '10000' and response.get('trade_status') == 'WAIT_BUYER_PAY'):
+        return order_id, payment.PAY_PENDING, None
+    # 系统繁忙等临时错误, 下次对账再查询
+    return order_id, None, None
+
+
+def _apply_paid(trade_nos):
+    """
+    批量把已支付的订单更新为待评价(一条UPDATE, 交易号用CASE按订单设置)
+    :param trade_nos: {订单id: 支付宝交易号}
+    :return: 本次更新的订单id
+    """
+    if not trade_nos:
+        return []
+    with transaction.atomic():
+        # 锁住仍是待支付状态的订单, 已被异步通知更新的跳过
+        order_ids = list(OrderInfo.objects.select_for_update()
+                         .filter(order_id__in=list(trade_nos), order_status=1)
+                         .values_list('order_id', flat=True))
+        if order_ids:
+            OrderInfo.objects.filter(order_id__in=order_ids).update(
+                order_status=4,  # 待评价
+                trade_no=Case(*[When(order_id=order_id, then=Value(trade_nos[order_id])) for order_id in order_ids],
+                              output_field=CharField()))
+    return order_ids
+
+
+def _apply_canceled_paid(trade_nos):
+    """
+    查询期间已被超时取消的订单(取消时交易还不存在, 之后用户才付款), 恢复订单或记录为待退款
+    :param trade_nos: {订单id: 支付宝交易号}, 没有被_apply_paid更新的已支付订单
+    :return: (恢复的订单数, 待退款的订单数)
+    """
+    if not trade_nos:
+        return 0, 0
+    revived = refund = 0
+    for order_id in OrderInfo.objects.filter(order_id__in=list(trade_nos), order_status=expiry.ORDER_STATUS_CANCELED)\
+            .values_list('order_id', flat=True):
+        if payment.handle_canceled_paid(order_id, trade_nos[order_id]):
+            revived += 1
+        else:
+            refund += 1
+    return revived, refund
+
+
+def reconcile_pending_payments(batch_size=200, workers=8, max_orders=5000, alipay=None):
+    """
+    对账待支付的支付宝订单
+    :param workers: 并发查询支付宝的线程数
+    :param max_orders: 本次最多对账的订单数, 剩下的下次继续
+    :param alipay: 支付宝接口对象, 默认使用 payment.get_alipay()
+    :return: 统计报告
+    """
+    if alipay is None:
+        alipay = payment.get_alipay()
+    conn = get_redis_connection('default')
+    cursor = conn.get(RECONCILE_CURSOR_KEY)
+    cursor = cursor.decode() if cursor else None
+
+    pending = OrderInfo.objects.filter(pay_method=3, order_status=1,
+                                       create_time__lt=timezone.now() - timedelta(seconds=RECONCILE_MIN_AGE))\
+        .order_by(*RECONCILE_ORDERING)
+
+    report = {'checked': 0, 'paid': 0, 'updated': 0, 'revived': 0, 'refund': 0, 'pending': 0, 'failed': 0,
+              'errors': 0, 'batches': 0, 'max_lag': 0, 'finished': False}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        while report['checked'] < max_orders:
+            orders = pending
+            after = decode_cursor(cursor, RECONCILE_ORDERING)
+            if after is not None:
+                orders = orders.filter(keyset_filter(RECONCILE_ORDERING, after))
+            orders = list(orders.only(*RECONCILE_ORDERING)[:batch_size])
+            if not orders:
+                report['finished'] = True
+                break
+
+            # 最早的订单已经等待了多久
+            report['max_lag'] = max(report['max_lag'], (timezone.now() - orders[0].create_time).total_seconds())
+
+            trade_nos = {}
+            for order_id, status, trade_no in executor.map(lambda order: _query(alipay, order.order_id), orders):
+                if status is None:
+                    report['errors'] += 1
+                elif status == payment.PAY_PAID:
+                    trade_nos[order_id] = trade_no
+                else:
+                    report[status] += 1
+
+            updated = _apply_paid(trade_nos)
+            if updated:
+                from celery_task.tasks import handle_order_paid
+                for order_id in updated:
+                    payment.set_pay_status(order_id, payment.PAY_PAID)
+                    handle_order_paid.delay(order_id)
+            revived, refund = _apply_canceled_paid({order_id: trade_no for order_id, trade_no in trade_nos.items()
+                                                    if order_id not in updated})
+
+            report['checked'] += len(orders)
+            report['paid'] += len(trade_nos)
+            report['updated'] += len(updated)
+            report['revived'] += revived
+            report['refund'] += refund
+            report['batches'] += 1
+            cursor = encode_cursor(orders[-1], RECONCILE_ORDERING)
+
+    if report['finished'] or cursor is None:
+        # 已读到末尾, 下次从头开始
+        conn.delete(RECONCILE_CURSOR_KEY)
+    else:
+        conn.set(RECONCILE_CURSOR_KEY, cursor)
+
+    elapsed = time.perf_counter() - start
+    report['elapsed'] = elapsed
+    report['rate'] = report['checked'] / elapsed if elapsed else 0
+    return report
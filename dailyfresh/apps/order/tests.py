@@ -1,3 +1,246 @@
+import json
+import time
+from decimal import Decimal
+from unittest import mock
+
+from django.db import transaction
 from django.test import TestCase
+from django_redis import get_redis_connection
+from goods.models import GoodsSKU, GoodsStockBucket
+from goods.tests import create_skus
+from order.models import OrderInfo, OrderGoods
+from order import flash_sale
+from order import expiry
+from order import intake
+from order.utils import create_order
+from user.models import User, Address
+
+
+def create_user():
+    """创建测试用户和收货地址"""
+    user = User.objects.create_user('test', 'test@example.com', 'password')
+    addr = Address.objects.create(user=user, receiver='测试', addr='测试地址', zip_code='100000',
+                                  phone='13800000000', is_default=True)
+    return user, addr
+
+
+def shard(sku, *stocks):
+    """直接写入分桶(不经过stock_buckets.enable, 不访问redis)"""
+    GoodsStockBucket.objects.bulk_create([GoodsStockBucket(sku=sku, index=index, stock=stock)
+                                          for index, stock in enumerate(stocks)])
+    GoodsSKU.objects.filter(id=sku.id).update(stock=sum(stocks), stock_sharded=True)
+
+
+class CreateOrderTest(TestCase):
+    """创建订单: 扣减库存, 库存不足时回滚"""
+    def setUp(self):
+        self.user, self.addr = create_user()
+
+    def create(self, skus, counts, order_id='1'):
+        with transaction.atomic():
+            return create_order(self.user.id, self.addr.id, '1', [sku.id for sku in skus], counts, order_id)
+
+    def stocks(self, skus):
+        return list(GoodsSKU.objects.filter(id__in=[sku.id for sku in skus]).order_by('id')
+                    .values_list('stock', 'sales'))
+
+    def test_success(self):
+        skus = create_skus(5, 3)
+        result, sales = self.create(skus, [2, 3])
+        self.assertEqual(result['res'], 7)
+        self.assertEqual(sorted(sales), sorted([(sku.type_id, sku.id, count) for sku, count in zip(skus, [2, 3])]))
+        self.assertEqual(self.stocks(skus), [(3, 2), (0, 3)])
+        order = OrderInfo.objects.get(order_id='1')
+        self.assertEqual(order.total_count, 5)
+        self.assertEqual(order.total_price, skus[0].price * 5)
+        self.assertEqual(OrderGoods.objects.filter(order=order).count(), 2)
+
+    def test_insufficient_stock(self):
+        skus = create_skus(5, 1)
+        result, sales = self.create(skus, [2, 3])
+        self.assertEqual(result['res'], 5)
+        self.assertEqual(sales, [])
+        self.assertEqual(self.stocks(skus), [(5, 0), (1, 0)])
+        self.assertFalse(OrderInfo.objects.exists())
+
+    def test_rollback_earlier_updates(self):
+        # 分桶商品不预先检查库存, 第一个商品已扣减后第二个商品扣减失败, 第一个商品的扣减必须回滚
+        skus = create_skus(5, 0)
+        shard(skus[1], 1, 1)
+        result, sales = self.create(skus, [2, 3])
+        self.assertEqual(result['res'], 5)
+        self.assertEqual(self.stocks(skus)[0], (5, 0))
+        self.assertEqual(sum(GoodsStockBucket.objects.filter(sku=skus[1]).values_list('stock', flat=True)), 2)
+        self.assertFalse(OrderInfo.objects.exists())
+        self.assertFalse(OrderGoods.objects.exists())
+
+    def test_missing_sku(self):
+        skus = create_skus(5)
+        missing = GoodsSKU(id=skus[0].id + 1000)
+        result, sales = self.create([skus[0], missing], [1, 1])
+        self.assertEqual(result['res'], 4)
+        self.assertEqual(self.stocks(skus), [(5, 0)])
+
+
+class FlashSaleTest(TestCase):
+    """秒杀: 预占库存的lua脚本和写入订单(需要redis, 使用test_开头的键)"""
+    def setUp(self):
+        self.user, self.addr = create_user()
+        self.sku = create_skus(10)[0]
+        self.keys = ['test_flash_sale_%s' % self.sku.id, 'test_flash_buyers_%s' % self.sku.id,
+                     'test_flash_order_queue', 'test_flash_order_claims']
+        for patcher in [mock.patch.object(flash_sale, 'flash_key', lambda sku_id: 'test_flash_sale_%s' % sku_id),
+                        mock.patch.object(flash_sale, 'buyers_key', lambda sku_id: 'test_flash_buyers_%s' % sku_id),
+                        mock.patch.object(flash_sale, 'FLASH_QUEUE', 'test_flash_order_queue'),
+                        mock.patch.object(flash_sale, 'FLASH_CLAIMS', 'test_flash_order_claims')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.conn = get_redis_connection('default')
+        self.conn.delete(*self.keys)
+        self.addCleanup(self.conn.delete, *self.keys)
+
+    def reserve(self, count, user_id=None, order_id='1'):
+        return flash_sale.reserve(user_id or self.user.id, self.sku.id, count, order_id, self.addr.id, '1')
+
+    def flash_stock(self):
+        return int(self.conn.hget(flash_sale.flash_key(self.sku.id), 'stock'))
+
+    def test_user_limit(self):
+        flash_sale.start(self.sku.id, 5, Decimal('1.00'), limit=2)
+        self.assertEqual(self.reserve(3), 4)
+        self.assertEqual(self.flash_stock(), 5)
+        self.assertEqual(self.reserve(2), 0)
+        # 每个用户只能抢购一次
+        self.assertEqual(self.reserve(1, order_id='2'), 2)
+        self.assertEqual(self.flash_stock(), 3)
+
+    def test_sold_out(self):
+        flash_sale.start(self.sku.id, 1, limit=2)
+        self.assertEqual(self.reserve(2), 1)
+        self.assertEqual(self.flash_stock(), 1)
+        flash_sale.stop(self.sku.id)
+        self.assertEqual(self.reserve(1), 3)
+
+    def test_persist_uses_reserved_price(self):
+        flash_sale.start(self.sku.id, 5, Decimal('1.00'), limit=2)
+        self.assertEqual(self.reserve(2), 0)
+        # 写入订单前秒杀已经结束, 仍使用预占时的秒杀价格
+        flash_sale.stop(self.sku.id)
+        self.assertEqual(flash_sale.persist_batch(), (1, 0))
+
+        order = OrderInfo.objects.get(order_id='1')
+        self.assertEqual(order.total_price, Decimal('2.00'))
+        self.assertEqual(OrderGoods.objects.get(order=order).price, Decimal('1.00'))
+        self.assertEqual(GoodsSKU.objects.values_list('stock', 'sales').get(id=self.sku.id), (8, 2))
+        self.assertEqual(self.conn.zcard('test_flash_order_claims'), 0)
+
+
+class CancelExpiredTest(TestCase):
+    """超时取消: 归还库存, 重复取出的订单不会重复归还(需要redis, 使用test_开头的键)"""
+    def setUp(self):
+        self.user, self.addr = create_user()
+        self.skus = create_skus(5, 0)
+        shard(self.skus[1], 2, 2)
+        with transaction.atomic():
+            result, sales = create_order(self.user.id, self.addr.id, '1', [sku.id for sku in self.skus], [2, 3], '1')
+        self.assertEqual(result['res'], 7)
+
+        patcher = mock.patch.object(expiry, 'ORDER_DEADLINE_KEY', 'test_order_deadlines')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.conn = get_redis_connection('default')
+        self.conn.delete('test_order_deadlines')
+        self.addCleanup(self.conn.delete, 'test_order_deadlines')
+
+    def expire(self):
+        """订单的支付截止时间设置为已过期"""
+        self.conn.execute_command('ZADD', 'test_order_deadlines', 0, '1')
+
+    def assert_restored(self):
+        self.assertEqual(GoodsSKU.objects.values_list('stock', 'sales').get(id=self.skus[0].id), (5, 0))
+        buckets = GoodsStockBucket.objects.filter(sku=self.skus[1])
+        self.assertEqual(sum(bucket.stock for bucket in buckets), 4)
+        self.assertEqual(sum(bucket.sales for bucket in buckets), 0)
+
+    def test_restore_once(self):
+        self.expire()
+        self.assertEqual(expiry.cancel_expired(), (1, 1))
+        self.assertEqual(OrderInfo.objects.get(order_id='1').order_status, expiry.ORDER_STATUS_CANCELED)
+        self.assert_restored()
+        self.assertEqual(self.conn.zcard('test_order_deadlines'), 0)
+
+        # 再次取出已取消的订单(如处理完成前进程退出), 不会再归还库存
+        self.expire()
+        self.assertEqual(expiry.cancel_expired(), (1, 0))
+        self.assert_restored()
+        self.assertEqual(expiry.cancel_expired(), (0, 0))
+
+    def test_not_expired(self):
+        expiry.schedule_cancel('1')
+        self.assertEqual(expiry.cancel_expired(), (0, 0))
+        self.assertEqual(OrderInfo.objects.get(order_id='1').order_status, 1)
+
+    def test_paid_order_not_canceled(self):
+        OrderInfo.objects.filter(order_id='1').update(order_status=4)
+        self.expire()
+        self.assertEqual(expiry.cancel_expired(), (1, 0))
+        self.assertEqual(GoodsSKU.objects.values_list('stock', flat=True).get(id=self.skus[0].id), 3)
+
+
+class IntakeTest(TestCase):
+    """排队下单: 消费进程处理下单请求(需要redis, 使用test_开头的键)"""
+    def setUp(self):
+        self.user, self.addr = create_user()
+        self.sku = create_skus(5)[0]
+        for patcher in [mock.patch.object(intake, 'stream_key', lambda partition: 'test_order_intake_%d' % partition),
+                        mock.patch.object(intake, 'latency_key', lambda partition: 'test_intake_latency_%d' % partition),
+                        mock.patch.object(intake, 'ticket_key', lambda ticket: 'test_order_ticket_%s' % ticket),
+                        mock.patch.object(flash_sale, 'flash_key', lambda sku_id: 'test_flash_sale_%s' % sku_id)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.conn = get_redis_connection('default')
+        self.keys = ['test_order_intake_0', 'test_intake_latency_0', 'test_order_ticket_1',
+                     'test_flash_sale_%s' % self.sku.id]
+        self.conn.delete(*self.keys)
+        self.addCleanup(self.conn.delete, *self.keys)
+
+    def process(self, count=2):
+        fields = {
+            'data': json.dumps({'ticket': '1', 'user_id': self.user.id, 'addr_id': self.addr.id, 'pay_method': '1',
+                                'sku_ids': [self.sku.id], 'counts': [count]}),
+            'enqueued': str(time.time()),
+        }
+        intake.process(self.conn, 0, '0-1', fields)
+        ticket = self.conn.hgetall('test_order_ticket_1')
+        return {key.decode(): value.decode() for key, value in ticket.items()}
+
+    def test_process_once(self):
+        ticket = self.process()
+        self.assertEqual((ticket['status'], ticket['res']), (intake.TICKET_DONE, '7'))
+        self.assertEqual(GoodsSKU.objects.values_list('stock', 'sales').get(id=self.sku.id), (3, 2))
+
+        # 消息没有确认时进程退出, 重新处理同一个请求: 订单已存在, 不会再次扣减库存
+        ticket = self.process()
+        self.assertEqual(ticket['res'], '7')
+        self.assertEqual(OrderInfo.objects.filter(order_id='1').count(), 1)
+        self.assertEqual(OrderGoods.objects.filter(order_id='1').count(), 1)
+        self.assertEqual(GoodsSKU.objects.values_list('stock', 'sales').get(id=self.sku.id), (3, 2))
+
+    def test_insufficient_stock(self):
+        ticket = self.process(count=6)
+        self.assertEqual(ticket['res'], '5')
+        self.assertFalse(OrderInfo.objects.exists())
+
+    def test_flash_sale_started_while_queued(self):
+        self.conn.hset('test_flash_sale_%s' % self.sku.id, 'stock', 5)
+        ticket = self.process()
+        self.assertEqual(ticket['res'], '8')
+        self.assertFalse(OrderInfo.objects.exists())
+        self.assertEqual(GoodsSKU.objects.values_list('stock', flat=True).get(id=self.sku.id), 5)
 
-# Create your tests here.
+    def test_partition_of(self):
+        partitions = intake.ORDER_INTAKE_PARTITIONS
+        self.assertEqual(intake.partition_of(['5']), 5 % partitions)
+        self.assertEqual(intake.partition_of([1, 1 + partitions]), 1)
+        # 商品跨分区的订单不能排队
+        self.assertIsNone(intake.partition_of([1, 2]))
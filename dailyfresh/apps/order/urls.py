@@ -1,10 +1,15 @@
 from django.conf.urls import url
-from order.views import OrderPlaceView, OrderCommitView, OrderPayView, OrderCheckPayView, OrderCommentView
+from django.views.decorators.csrf import csrf_exempt
+from order.views import OrderPlaceView, OrderCommitView, OrderTicketView, FlashOrderCommitView, OrderPayView, \
+    OrderCheckPayView, AlipayNotifyView, OrderCommentView
 
 urlpatterns = [
     url(r'^place$', OrderPlaceView.as_view(), name='place'),  # 提交订单
     url(r'^commit$', OrderCommitView.as_view(), name='commit'),  # 提交创建
+    url(r'^ticket$', OrderTicketView.as_view(), name='ticket'),  # 排队下单结果查询
+    url(r'^flash$', FlashOrderCommitView.as_view(), name='flash'),  # 秒杀下单
     url(r'^pay$', OrderPayView.as_view(), name='pay'),  # 订单支付
     url(r'^check$', OrderCheckPayView.as_view(), name='check'),  # 支付结果查询
+    url(r'^notify$', csrf_exempt(AlipayNotifyView.as_view()), name='notify'),  # 支付宝异步通知
     url(r'^comment/(?P<order_id>.+)$', OrderCommentView.as_view(), name='comment'),  # 订单评论
 ]
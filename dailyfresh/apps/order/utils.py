@@ -0,0 +1,174 @@
+import os
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django_redis import get_redis_connection
+from goods.models import GoodsSKU
+from goods import ranking
+from goods import stock as stock_mirror
+from goods import stock_buckets
+from order.models import OrderInfo, OrderGoods
+from order import expiry
+from utils.redis_scripts import RedisScript
+from utils.snowflake import ProcessSnowflake, MAX_WORKER_ID
+
+ORDER_ID_WORKER_KEY = 'order_id_worker'
+# 机器id租约: order_id_worker_<机器id> 保存持有该id的进程, 进程使用id时续期, 进程退出后过期释放
+ORDER_ID_LEASE_TIMEOUT = 600
+# 续期间隔(秒), 必须远小于租约时间
+ORDER_ID_LEASE_RENEW = 60
+
+
+def lease_key(worker_id):
+    return 'order_id_worker_%d' % worker_id
+
+
+# 续期机器id租约: 租约属于当前进程或已过期时续期(重新持有), 被其他进程持有时返回0
+# KEYS[1]: order_id_worker_<机器id>
+# ARGV[1]: 当前进程标识  ARGV[2]: 租约时间
+RENEW_LEASE = RedisScript("""
+local owner = redis.call('get', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return 0
+end
+redis.call('set', KEYS[1], ARGV[1], 'EX', tonumber(ARGV[2]))
+return 1
+""")
+
+_lease_owners = {}
+
+
+def _lease_owner():
+    """当前进程的标识, fork出的子进程重新生成"""
+    pid = os.getpid()
+    if pid not in _lease_owners:
+        _lease_owners[pid] = '%d:%s' % (pid, uuid.uuid4().hex)
+    return _lease_owners[pid]
+
+
+def _allocate_worker_id():
+    """分配机器id: 配置中指定的优先, 否则从redis中租用一个没有被其他进程持有的id"""
+    worker_id = getattr(settings, 'ORDER_ID_WORKER_ID', None)
+    if worker_id is not None:
+        return worker_id
+    conn = get_redis_connection('default')
+    owner = _lease_owner()
+    # 从递增的位置开始查找, 进程依次启动时很快找到空闲的id
+    start = conn.incr(ORDER_ID_WORKER_KEY)
+    for i in range(MAX_WORKER_ID + 1):
+        worker_id = (start + i) & MAX_WORKER_ID
+        if conn.set(lease_key(worker_id), owner, nx=True, ex=ORDER_ID_LEASE_TIMEOUT):
+            return worker_id
+    raise RuntimeError('没有空闲的机器id')
+
+
+def _renew_worker_id(worker_id):
+    """续期机器id租约, 返回False时需要重新分配"""
+    if getattr(settings, 'ORDER_ID_WORKER_ID', None) is not None:
+        return True
+    return bool(RENEW_LEASE(keys=[lease_key(worker_id)], args=[_lease_owner(), ORDER_ID_LEASE_TIMEOUT]))
+
+
+_order_ids = ProcessSnowflake(_allocate_worker_id, _renew_worker_id, ORDER_ID_LEASE_RENEW)
+
+
+def new_order_id():
+    """生成订单id: 19位数字, 按时间递增, 多进程并发也不会重复"""
+    return _order_ids.next_str()
+
+
+def create_order(user_id, addr_id, pay_method, sku_ids, counts, order_id):
+    """
+    创建订单(需要在事务中调用): 扣减库存和销量, 写入订单和订单商品
+    直接下单和排队下单共用, 不修改购物车; 事务提交后由调用者执行 order_committed()
+    :param counts: 与sku_ids对应的购买数量
+    :return: (应答数据 {"res": 7, "errmsg": "创建订单成功"} 或失败原因, 销量变化 [(种类id, 商品id, 数量), ...])
+    """
+    # 运费
+    transit_price = 10
+
+    # 设置事物保存点
+    save_id = transaction.savepoint()
+
+    try:
+        # 一次查询获取所有商品信息
+        skus = GoodsSKU.objects.in_bulk(sku_ids)
+
+        # 商品总数目和总价格
+        total_count = 0
+        total_price = 0
+        # 购买的商品 [(商品, 数量), ...]
+        items = []
+        for sku_id, count in zip(sku_ids, counts):
+            sku = skus.get(int(sku_id))
+            if sku is None:
+                # 商品不存在，进行回滚到事物点
+                transaction.savepoint_rollback(save_id)
+                return {"res": 4, "errmsg": "商品不存在"}, []
+
+            count = int(count)
+            # todo: 判断商品库存(分桶商品的stock是定时汇总的, 以扣减分桶的结果为准)
+            if not sku.stock_sharded and count > sku.stock:
+                # 商品库存不足，进行回滚到事物点
+                transaction.savepoint_rollback(save_id)
+                return {"res": 5, "errmsg": "商品库存不足"}, []
+
+            items.append((sku, count))
+            # todo: 累加计算订单商品的总数目和总价格
+            total_count += count
+            total_price += sku.price * count
+
+        # todo: 更新商品的库存和销量
+        # 按商品id顺序更新, 避免多个订单互相等待行锁造成死锁
+        for sku, count in sorted(items, key=lambda item: item[0].id):
+            if sku.stock_sharded:
+                # 热门商品: 从随机一个分桶中扣减, 不锁商品表中的行
+                res = stock_buckets.take(sku.id, count)
+            else:
+                # update df_goods_sku set stock=stock-count, sales=sales+count where id=sku_id and stock>=count
+                # 只要库存足够就能更新成功, 不会因为其他用户同时购买而失败; 返回受影响的行数
+                res = GoodsSKU.objects.filter(id=sku.id, stock__gte=count)\
+                    .update(stock=F('stock') - count, sales=F('sales') + count)
+            if res == 0:
+                # 库存已被其他订单买走
+                transaction.savepoint_rollback(save_id)
+                return {"res": 5, "errmsg": "商品库存不足"}, []
+
+        # todo： 向订单信息表（df_order_info）中添加一条数据
+        order = OrderInfo.objects.create(order_id=order_id,
+                                         user_id=user_id,
+                                         addr_id=addr_id,
+                                         pay_method=pay_method,
+                                         total_price=total_price,
+                                         total_count=total_count,
+                                         transit_price=transit_price)
+
+        # todo: 向订单商品表（df_order_goods）中一次添加所有商品
+        OrderGoods.objects.bulk_create([OrderGoods(order=order, sku=sku, count=count, price=sku.price)
+                                        for sku, count in items])
+
+    except Exception as e:
+        transaction.savepoint_rollback(save_id)
+        return {"res": 6, "errmsg": "下单失败1"}, []
+
+    # 提交事物
+    transaction.savepoint_commit(save_id)
+
+    return {"res": 7, "errmsg": "创建订单成功"}, [(sku.type_id, sku.id, count) for sku, count in items]
+
+
+def order_committed(order_id, pay_method, sales):
+    """
+    订单事务提交后更新redis: 在事务中更新时, 其他请求可能在提交前读到旧库存重新写入镜像,
+    事务回滚时还会留下不存在的订单的销量和取消计划
+    :param sales: create_order返回的销量变化
+    """
+    # 更新商品销量排行索引
+    ranking.incr_sales(sales)
+    # 库存已变化, 清除库存镜像
+    stock_mirror.clear_stock(*[sku_id for type_id, sku_id, count in sales])
+    # 在线支付的订单超时未支付自动取消
+    if pay_method != '1':
+        expiry.schedule_cancel(order_id)
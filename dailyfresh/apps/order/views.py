@@ -3,17 +3,22 @@ from django.views.generic import View
 from django.core.urlresolvers import reverse
 from django.db import transaction
 from django.conf import settings
-from django.http import JsonResponse
-from datetime import datetime
+from django.http import JsonResponse, HttpResponse
+from django.utils import timezone
 
 from goods.models import GoodsSKU
+from goods.utils import invalidate_detail_page
+from cart.utils import load_cart_skus, delete_cart_skus
 from order.models import OrderInfo, OrderGoods
+from order import flash_sale
+from order.utils import new_order_id, create_order, order_committed
+from order import payment
+from order import expiry
+from order import intake
 from user.models import Address
 
 from django_redis import get_redis_connection
 from utils.mixin import LoginRequiredMixin
-from alipay import AliPay, ISVAliPay
-import os
 
 
 # /order/palce
@@ -33,28 +38,15 @@ class OrderPlaceView(LoginRequiredMixin, View):
         conn = get_redis_connection('default')
         cart_key = 'cart_%d' % user.id
 
-        # 保存用户购买商的所有品信息
-        skus = []
+        # 获取用户要购买的商品的数量(一次redis请求)
+        counts = conn.hmget(cart_key, sku_ids)
 
-        # 记录用户购买商品的总件数和总价格
-        total_count = 0
-        total_price = 0
+        # 一次查询获取用户要购买的所有商品信息,动态添加了购买数量和小计属性
+        skus = load_cart_skus((sku_id, count) for sku_id, count in zip(sku_ids, counts) if count is not None)
 
-        # 遍历sku_ids获取用户要购买的商品id信息
-        for sku_id in sku_ids:
-            # 根据商品的id获取商品对象
-            sku = GoodsSKU.objects.get(id=sku_id)
-            # 获取用户要购买的商品的数量
-            count = conn.hget(cart_key, sku_id)
-            # 计算商品小计
-            amount = sku.price*int(count)
-            # 动态给商品对象添加购买数量和小计属性
-            sku.amount = amount
-            sku.count = count
-            skus.append(sku)
-            # 累加计算用户购买商品总件数和总价格
-            total_count += int(count)
-            total_price += amount
+        # 计算用户购买商品总件数和总价格
+        total_count = sum(sku.count for sku in skus)
+        total_price = sum(sku.amount for sku in skus)
 
         # 商品运费 实际开发中,运费会新建一个子系统
         transit_price = 10
@@ -119,8 +111,8 @@ class OrderCommitView1(View):
         # todo： 创建订单核心业务
 
         # 组织参数
-        # 订单id：20190217203835+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S') + str(user.id)
+        # 订单id: 按时间递增的唯一id(时间戳+进程id+序号)
+        order_id = new_order_id()
 
         # 运费
         transit_price = 10
@@ -194,18 +186,20 @@ class OrderCommitView1(View):
         # 提交事物
         transaction.savepoint_commit(save_id)
 
-        # todo: 清除用户购物车中对应的记录
-        conn.hdel(cart_key, *sku_ids)
+        # 在线支付的订单超时未支付自动取消
+        if pay_method != '1':
+            expiry.schedule_cancel(order_id)
+
+        # todo: 清除用户购物车中对应的记录(同时更新购物车商品总件数)
+        delete_cart_skus(user.id, *sku_ids)
 
         # 返回应答
         return JsonResponse({"res": 7, "errmsg": "创建订单成功"})
 
 
-# 乐观锁处理
+# 乐观锁处理: 使用带条件的更新(库存足够才扣减)代替比较原库存, 并发购买时不会失败重试
 class OrderCommitView(View):
     """订单创建"""
-    # mysql事物操作装饰器
-    @transaction.atomic
     def post(self, request):
         # 判断用户是否登录
         user = request.user
@@ -234,100 +228,125 @@ class OrderCommitView(View):
         # todo： 创建订单核心业务
 
         # 组织参数
-        # 订单id：20190217203835+用户id
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S') + str(user.id)
+        # 从redis中获取用户所要购买的商品的数量, 同时检查商品是否正在秒杀(一次redis请求)
+        conn = get_redis_connection('default')
+        cart_key = "cart_%d" % user.id
+        sku_ids = sku_ids.split(',')
+        if not all(sku_id.isdigit() for sku_id in sku_ids):
+            return JsonResponse({"res": 4, "errmsg": "商品不存在"})
+        pipe = conn.pipeline()
+        pipe.hmget(cart_key, sku_ids)
+        for sku_id in sku_ids:
+            pipe.exists(flash_sale.flash_key(sku_id))
+        results = pipe.execute()
+        counts = results[0]
+        if any(results[1:]):
+            # 秒杀中的商品只能通过秒杀下单, 否则会卖出已被预占的库存
+            return JsonResponse({"res": 8, "errmsg": "秒杀商品请通过秒杀下单"})
+        # 排队下单时在这里就要拒绝, 否则要等消费进程处理后才能返回错误
+        if not all(count is not None and count.isdigit() and int(count) > 0 for count in counts):
+            return JsonResponse({"res": 6, "errmsg": "购物车中没有该商品"})
+
+        if settings.ORDER_INTAKE_QUEUE and intake.partition_of(sku_ids) is not None:
+            # 排队下单: 写入队列后立即返回排队号, 前端轮询排队结果
+            # 商品跨分区的订单直接下单, 否则会与多个分区的消费进程争抢同一商品的行锁
+            ticket = intake.enqueue(user.id, addr.id, pay_method, sku_ids, counts)
+            return JsonResponse({"res": 9, "ticket": ticket, "errmsg": "订单排队中"})
+
+        # 订单id: 按时间递增的唯一id(时间戳+进程id+序号)
+        order_id = new_order_id()
+
+        # 创建订单(mysql事物), 提交后再更新redis
+        with transaction.atomic():
+            result, sales = create_order(user.id, addr.id, pay_method, sku_ids, counts, order_id)
+        if result['res'] != 7:
+            return JsonResponse(result)
+        order_committed(order_id, pay_method, sales)
+
+        # todo: 清除用户购物车中对应的记录(同时更新购物车商品总件数)
+        delete_cart_skus(user.id, *sku_ids)
 
-        # 运费
-        transit_price = 10
+        # 返回应答
+        return JsonResponse({"res": 7, "errmsg": "创建订单成功"})
 
-        # 商品总数目和总价格
-        total_count = 0
-        total_price = 0
 
-        # 设置事物保存点
-        save_id = transaction.savepoint()
+# ajax post
+# 前端传递的参数：排队号(ticket)
+# /order/ticket
+class OrderTicketView(View):
+    """排队下单结果查询"""
+    def post(self, request):
+        # 判断用户是否登录
+        user = request.user
+        if not user.is_authenticated():
+            return JsonResponse({"res": 0, "errmsg": "请登录"})
 
-        try:
-            # todo： 向订单信息表（df_order_info）中添加一条数据
-            order = OrderInfo.objects.create(order_id=order_id,
-                                             user=user,
-                                             addr=addr,
-                                             pay_method=pay_method,
-                                             total_price=total_price,
-                                             total_count=total_count,
-                                             transit_price=transit_price)
+        ticket = intake.get_ticket(request.POST.get('ticket', ''), user.id)
+        if ticket is None:
+            return JsonResponse({"res": 1, "errmsg": "无效的排队号"})
+        if ticket['status'] == intake.TICKET_QUEUED:
+            return JsonResponse({"res": 9, "errmsg": "订单排队中"})
+        # 排队处理完成, 返回创建订单的结果
+        return JsonResponse({"res": int(ticket['res']), "errmsg": ticket['errmsg']})
 
-            # todo：用户订单里面有几个商品用户订单里面有几个商品，就需要向订单商品表（df_order_goods）中添加几条数据
-            conn = get_redis_connection('default')
-            cart_key = "cart_%d" % user.id
 
-            sku_ids = sku_ids.split(',')
-            for sku_id in sku_ids:
-                for i in range(3):
-                    # 获取商品信息
-                    try:
-                        sku = GoodsSKU.objects.get(id=sku_id)
-                    except GoodsSKU.DoesNotExist:
-                        # 商品不存在，进行回滚到事物点
-                        transaction.savepoint_rollback(save_id)
-                        return JsonResponse({"res": 4, "errmsg": "商品不存在"})
-
-                    # 从redis中获取用户所要购买的商品的数量
-                    count = conn.hget(cart_key, sku_id)
-
-                    # todo: 判断商品库存
-                    if int(count) > sku.stock:
-                        # 商品库存不足，进行回滚到事物点
-                        transaction.savepoint_rollback(save_id)
-                        return JsonResponse({"res": 5, "errmsg": "商品库存不足"})
-
-                    # todo: 更新商品的库存和销量
-                    orgin_stock = sku.stock
-                    new_stock = orgin_stock - int(count)
-                    new_sales = sku.sales + int(count)
-
-                    # 更新商品库存
-                    # update df_goods_sku set stock=new_stock, sales=new_sales where id=sku_id and stock=orgin_stock
-                    # 返回受影响的行数
-                    res = GoodsSKU.objects.filter(id=sku_id, stock=orgin_stock).update(stock=new_stock, sales=new_sales)
-                    if res == 0:
-                        # 尝试的第三次
-                        if i == 2:
-                            transaction.savepoint_rollback(save_id)
-                            return JsonResponse({"res": 8, "errmsg": "下单失败"})
-                        continue
-
-                    # todo: 向订单商品表（order_goods）中添加一条数据
-                    OrderGoods.objects.create(order=order,
-                                              sku=sku,
-                                              count=count,
-                                              price=sku.price)
-
-                    # todo: 累加计算订单商品的总数目和总价格
-                    amount = sku.price * int(count)
-                    total_count += int(count)
-                    total_price += amount
-
-                    # 跳出循环
-                    break
+# /order/flash
+# 秒杀下单: 在redis中预占库存后立即返回, 订单由celery分批写入mysql
+class FlashOrderCommitView(View):
+    """秒杀订单创建"""
+    def post(self, request):
+        # 判断用户是否登录
+        user = request.user
+        if not user.is_authenticated():
+            return JsonResponse({"res": 0, "errmsg": "请登录"})
 
-            # todo: 更新订单信息表中的商品总数量和总价格
-            order.total_count = total_count
-            order.total_price = total_price
-            order.save()
+        # 接收参数
+        addr_id = request.POST.get('addr_id')
+        pay_method = request.POST.get('pay_method')
+        sku_id = request.POST.get('sku_id')
+        count = request.POST.get('count', 1)
+
+        # 校验参数
+        if not all([addr_id, pay_method, sku_id]):
+            return JsonResponse({"res": 1, "errmsg": "参数不完整"})
+
+        # 校验支付方式
+        if pay_method not in OrderInfo.PAY_METHODS.keys():
+            return JsonResponse({"res": 2, "errmsg": "非法的支付方式"})
 
+        # 校验商品数量
+        try:
+            sku_id = int(sku_id)
+            count = int(count)
         except Exception as e:
-            transaction.savepoint_rollback(save_id)
-            return JsonResponse({"res": 6, "errmsg": "下单失败1"})
+            return JsonResponse({"res": 1, "errmsg": "参数错误"})
+        if count <= 0:
+            return JsonResponse({"res": 1, "errmsg": "商品数目出错"})
 
-        # 提交事物
-        transaction.savepoint_commit(save_id)
+        # 校验地址
+        if not Address.objects.filter(id=addr_id, user=user).exists():
+            return JsonResponse({"res": 3, "errmsg": "地址不存在"})
+
+        # 订单id: 按时间递增的唯一id(时间戳+进程id+序号)
+        order_id = new_order_id()
 
-        # todo: 清除用户购物车中对应的记录
-        conn.hdel(cart_key, *sku_ids)
+        # 在redis中预占库存
+        status = flash_sale.reserve(user.id, sku_id, count, order_id, addr_id, pay_method)
+        if status == 1:
+            return JsonResponse({"res": 5, "errmsg": "商品已抢光"})
+        if status == 2:
+            return JsonResponse({"res": 6, "errmsg": "您已经抢购过该商品"})
+        if status == 3:
+            return JsonResponse({"res": 4, "errmsg": "商品不在秒杀中"})
+        if status == 4:
+            return JsonResponse({"res": 8, "errmsg": "超过限购数量"})
+
+        # 通知celery写入订单(窗口内的多次请求合并为一次任务)
+        from celery_task.tasks import schedule_persist_flash_orders
+        schedule_persist_flash_orders()
 
         # 返回应答
-        return JsonResponse({"res": 7, "errmsg": "创建订单成功"})
+        return JsonResponse({"res": 7, "order_id": order_id, "errmsg": "抢购成功, 订单处理中"})
 
 
 # ajax post
@@ -357,16 +376,14 @@ class OrderPayView(View):
         except OrderInfo.DoesNotExist:
             return JsonResponse({"res": 2, "errmsg": "订单错误"})
 
+        # 支付宝交易的有效时间不超过订单的剩余支付时间, 订单超时取消后用户不能再付款
+        remaining = expiry.ORDER_PAY_TIMEOUT - (timezone.now() - order.create_time).total_seconds()
+        timeout_minutes = int(remaining // 60)
+        if timeout_minutes < 1:
+            return JsonResponse({"res": 4, "errmsg": "订单即将超时取消"})
+
         # 业务处理，使用python的 sdk 调用支付宝支付接口
-        alipay = AliPay(
-            appid="2016092600601590",  # 应用id，由于我们是沙箱环境，所以直接拿沙箱应用下的APPID，实际开发环境根据自己实际应用ID填写
-            app_notify_url=None,  # 支付宝默认回调函数，由于我们是本地项目，没有公网ip所以就算填写了，支付宝也访问不过来。
-            app_private_key_path=os.path.join(settings.BASE_DIR, 'apps/order/app_private_key.pem'),
-            # alipay public key, do not use your own public key!
-            alipay_public_key_path=os.path.join(settings.BASE_DIR, 'apps/order/alipay_public_key.pem'),
-            sign_type="RSA2",  # RSA or RSA2
-            debug=True,  # 沙箱环境,所以需要设置为True
-        )
+        alipay = payment.get_alipay()
 
         # 调用电脑支付接口
         # 电脑网站支付，需要跳转到: https://openapi.alipay.com/gateway.do? + order_string
@@ -377,11 +394,12 @@ class OrderPayView(View):
             total_amount=str(total_amount),  # 总结额：加运费
             subject='天天生鲜%s' % order_id,  # 标题
             return_url=None,
-            notify_url=None
+            notify_url=None,
+            timeout_express='%dm' % timeout_minutes  # 交易超时时间
         )
 
         # 返回应答
-        pay_url = "https://openapi.alipaydev.com/gateway.do?" + order_string
+        pay_url = settings.ALIPAY_GATEWAY_URL + "?" + order_string
         return JsonResponse({"res": 3, "pay_url": pay_url})
 
 
@@ -391,7 +409,10 @@ class OrderPayView(View):
 class OrderCheckPayView(View):
     """支付结果查询"""
     def post(self, request):
-        """查询支付结果"""
+        """
+        查询支付结果: 支付宝由celery任务轮询, 这里只读取redis中的结果, 不会长时间占用worker
+        前端传递wait(秒)时最多等待wait秒(长轮询), 否则立即返回
+        """
         # 登录验证
         user = request.user
 
@@ -400,86 +421,56 @@ class OrderCheckPayView(View):
 
         # 接收参数
         order_id = request.POST.get('order_id')
+        try:
+            wait = int(request.POST.get('wait', 0))
+        except ValueError:
+            wait = 0
 
         # 校验参数
         if not order_id:
             return JsonResponse({"res": 1, "errmsg": "无效的订单id"})
 
+        # 先校验订单属于当前用户, 不能查询其他用户订单的支付结果
         try:
             order = OrderInfo.objects.get(order_id=order_id,
                                           user=user,
-                                          pay_method=3,
-                                          order_status=1)
+                                          pay_method=3)
         except OrderInfo.DoesNotExist:
             return JsonResponse({"res": 2, "errmsg": "订单错误"})
 
-        # 业务处理，使用python的 sdk 调用支付宝支付接口
-        alipay = AliPay(
-            appid="2016092600601590",  # 应用id，由于我们是沙箱环境，所以直接拿沙箱应用下的APPID，实际开发环境根据自己实际应用ID填写
-            app_notify_url=None,  # 支付宝默认回调函数，由于我们是本地项目，没有公网ip所以就算填写了，支付宝也访问不过来。
-            app_private_key_path=os.path.join(settings.BASE_DIR, 'apps/order/app_private_key.pem'),
-            # alipay public key, do not use your own public key!
-            alipay_public_key_path=os.path.join(settings.BASE_DIR, 'apps/order/alipay_public_key.pem'),
-            sign_type="RSA2",  # RSA or RSA2
-            debug=True,  # 沙箱环境,所以需要设置为True
-        )
-
-        while True:
-            # 调用支付宝查询接口
-            # 订单支付查询接口                 商户订单号           支付宝交易号
-            # 参数必传其一，由于是测试环境，我们就使用订单编号进行查询
-            # api_alipay_trade_query(self, out_trade_no=None, trade_no=None)
-            response = alipay.api_alipay_trade_query(out_trade_no=order.order_id)
-
-            """
-                # 自行查看支付宝开发文档/公共文档/公共错误码
-                response = {
-                     "alipay_trade_query_response": {
-                     "trade_no": "2017032121001004070200176844",  # 支付宝交易号
-                     "code": "10000",  # 接口调用是否成功
-                     "invoice_amount": "20.00",
-                     "open_id": "20880072506750308812798160715407",
-                     "fund_bill_list": [
-                         {
-                            "amount": "20.00",
-                            "fund_channel": "ALIPAYACCOUNT"
-                         }
-                     ],
-                     "buyer_logon_id": "csq***@sandbox.com",
-                     "send_pay_date": "2017-03-21 13:29:17",
-                     "receipt_amount": "20.00",
-                     "out_trade_no": "out_trade_no15",
-                     "buyer_pay_amount": "20.00",
-                     "buyer_user_id": "2088102169481075",
-                     "msg": "Success",
-                     "point_amount": "0.00",
-                     "trade_status": "TRADE_SUCCESS",  # 支付结果
-                     "total_amount": "20.00"
-                }
-            """
-
-            code = response.get('code')
-
-            if code == '10000' and response.get('trade_status') == "TRADE_SUCCESS":
-                # 支付成功
-                # 获取支付宝交易号
-                trade_no = response.get('trade_no')
-                # 更新订单状态
-                order.trade_no = trade_no
-                order.order_status = 4  # 待评价
-                order.save()
-                # 返回应答
-                return JsonResponse({"res": 3, "errmsg": "支付成功"})
-
-            elif code == '40004' or (code == '10000' and response.get('trade_status') == "WAIT_BUYER_PAY"):
-                # 等待用户付款
-                # 业务暂时处理失败，可能一会就会成功
-                import time
-                time.sleep(5)
-                continue
-
-            else:
-                return JsonResponse({"res": 4, "errmsg": "支付失败"})
+        # 已经收到支付结果(异步通知或轮询)时直接返回
+        status = payment.get_pay_status(order_id)
+        if status == payment.PAY_PAID:
+            return JsonResponse({"res": 3, "errmsg": "支付成功"})
+
+        if order.order_status == expiry.ORDER_STATUS_CANCELED:
+            return JsonResponse({"res": 4, "errmsg": "订单已超时取消"})
+        if order.order_status != 1:
+            # 订单已经支付
+            return JsonResponse({"res": 3, "errmsg": "支付成功"})
+
+        if status != payment.PAY_PAID:
+            # 订单仍是待支付: 没有任务在轮询时(第一次查询, 上次轮询已超时或结果为交易关闭)发送celery任务
+            payment.start_pay_check(order_id)
+            status = payment.wait_pay_status(order_id, min(wait, payment.PAY_CHECK_MAX_WAIT))
+
+        if status == payment.PAY_PAID:
+            return JsonResponse({"res": 3, "errmsg": "支付成功"})
+        if status == payment.PAY_FAILED:
+            return JsonResponse({"res": 4, "errmsg": "支付失败"})
+        # 等待用户付款
+        return JsonResponse({"res": 5, "errmsg": "等待支付"})
+
+
+# 支付宝异步通知(支付宝服务器post访问, 不需要登录和csrf校验)
+# /order/notify
+class AlipayNotifyView(View):
+    """支付结果异步通知"""
+    def post(self, request):
+        # 验签并更新订单, 返回success后支付宝不再重复通知
+        if payment.handle_notify(request.POST.dict()):
+            return HttpResponse('success')
+        return HttpResponse('fail')
 
 
 class OrderCommentView(LoginRequiredMixin, View):
@@ -546,6 +537,9 @@ class OrderCommentView(LoginRequiredMixin, View):
             order_goods.comment = content
             order_goods.save()
 
+            # 评论变化，清除商品详情页缓存
+            invalidate_detail_page(order_goods.sku_id)
+
         order.order_status = 5  # 修改订单状态为已完成
         order.save()
 
@@ -5,6 +5,7 @@ from django.views.generic import View  # 基于类的视图继承类
 # from django.core.mail import send_mail
 from django.http import HttpResponse
 from django.core.paginator import Paginator
+from django.db.models import Prefetch
 from django.conf import settings
 from user.models import User, Address
 from order.models import OrderInfo, OrderGoods
@@ -233,25 +234,9 @@ class UserOrderView(LoginRequiredMixin, View):
         """显示"""
         # page = "order" :传给前端,让前端判断目前处于哪个标签,从而激活该标签
 
-        # 获取用户订单信息
+        # 获取用户订单信息(只组织查询, 分页后才查询当前页的订单)
         user = request.user
-        orders = OrderInfo.objects.filter(user=user).order_by("-create_time")
-
-        # 遍历获取订单商品信息
-        for order in orders:
-            # 查询订单商品对象
-            order_skus = order.ordergoods_set.all()
-            # 遍历order_skus计算商品的小计
-            for order_sku in order_skus:
-                # 计算小计
-                amount = order_sku.count*order_sku.price
-                # 动态给order_sku增加属性amount,保存订单的小计
-                order_sku.amount = amount
-
-            # 获取订单状态num获取对应属性名，动态给order增加属性，保存订单状态标题
-            order.status_name = OrderInfo.ORDER_STATUS[order.order_status]
-            # 动态给order增加属性，保存订单商品信息
-            order.order_skus = order_skus
+        orders = OrderInfo.objects.filter(user=user).order_by("-create_time", "-order_id")
 
         # 分页
         paginator = Paginator(orders, 1)
@@ -263,12 +248,33 @@ class UserOrderView(LoginRequiredMixin, View):
             page = 1
 
         # 如果请求页码超出页码总页数，则返回第一页数据
-        if page > paginator.num_pages:
+        if page > paginator.num_pages or page < 1:
             page = 1
 
         # 获取第page页的实例对象
         order_page = paginator.page(page)
 
+        # 只查询当前页订单的商品: 一次查询所有订单商品, 同时关联查询商品sku, 查询次数与订单数无关
+        order_goods = OrderGoods.objects.select_related('sku')
+        order_page.object_list = list(order_page.object_list.prefetch_related(
+            Prefetch('ordergoods_set', queryset=order_goods)))
+
+        # 遍历获取当前页的订单商品信息
+        for order in order_page:
+            # 订单商品对象(已预先查询)
+            order_skus = order.ordergoods_set.all()
+            # 遍历order_skus计算商品的小计
+            for order_sku in order_skus:
+                # 计算小计
+                amount = order_sku.count*order_sku.price
+                # 动态给order_sku增加属性amount,保存订单的小计
+                order_sku.amount = amount
+
+            # 获取订单状态num获取对应属性名，动态给order增加属性，保存订单状态标题
+            order.status_name = OrderInfo.ORDER_STATUS[order.order_status]
+            # 动态给order增加属性，保存订单商品信息
+            order.order_skus = order_skus
+
         # Todo: 进行页码控制，页面上最多显示5个页码
         # 1.总页数小于5页，页面显示所有页码
         # 2.如果当前页是前三页，显示1-5页
@@ -1,11 +1,12 @@
 # 使用celery
 import time
+import hashlib
 
 from celery import Celery
 from django.conf import settings
 from django.template import loader
 from django.core.mail import send_mail
-# from django_redis import get_redis_connection
+from django_redis import get_redis_connection
 
 # 加载环境变量,在任务处理者一端加这几句
 import os
@@ -14,11 +15,40 @@ import django
 # os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dailyfresh.settings")
 # django.setup()
 
-from goods.models import GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner
+from goods.utils import get_index_page_data
 
 # 创建一个Celery类的实例对象
 app = Celery('celery_tasks.tasks', broker='redis://192.168.153.140/2')
 
+# 定时任务(需要启动celery beat)
+app.conf.CELERYBEAT_SCHEDULE = {
+    # 每天统计并回收用户购物车和浏览记录占用的redis内存
+    'compact-user-keys': {
+        'task': 'celery_task.tasks.compact_user_redis_keys',
+        'schedule': 24 * 3600,
+    },
+    # 秒杀订单对账: 归还写入mysql失败的预占库存
+    'reconcile-flash-orders': {
+        'task': 'celery_task.tasks.reconcile_flash_orders',
+        'schedule': 60,
+    },
+    # 支付对账: 查询长时间待支付的支付宝订单
+    'reconcile-pending-payments': {
+        'task': 'celery_task.tasks.reconcile_pending_payments',
+        'schedule': 5 * 60,
+    },
+    # 取消超时未支付的订单
+    'cancel-expired-orders': {
+        'task': 'celery_task.tasks.cancel_expired_orders',
+        'schedule': 30,
+    },
+    # 汇总热门商品的分桶库存
+    'fold-stock-buckets': {
+        'task': 'celery_task.tasks.fold_stock_buckets',
+        'schedule': 10,
+    },
+}
+
 
 # 定义任务函数
 @app.task
@@ -38,41 +68,194 @@ def send_register_active_email(to_email, username, token):
     time.sleep(5)
 
 
+# 静态首页重新生成的合并窗口(秒): 窗口内的多次后台修改只生成一次静态页面
+STATIC_INDEX_DEBOUNCE = 5
+
+
+def schedule_static_index_html():
+    """请求重新生成静态首页(后台修改数据时调用)"""
+    conn = get_redis_connection('default')
+    pipe = conn.pipeline()
+    # 记录窗口内的请求次数
+    pipe.incr('static_index_pending')
+    # 窗口内只有第一次请求会真正发送celery任务
+    pipe.set('static_index_scheduled', 1, ex=STATIC_INDEX_DEBOUNCE + 60, nx=True)
+    pending, scheduled = pipe.execute()
+
+    if scheduled:
+        generate_static_index_html.apply_async(countdown=STATIC_INDEX_DEBOUNCE)
+
+
 @app.task
 def generate_static_index_html():
     """产生静态页面"""
-    # 获取商品的种类信息
-    types = GoodsType.objects.all()
+    conn = get_redis_connection('default')
 
-    # 获取首页轮播商品信息
-    goods_banners = IndexGoodsBanner.objects.all().order_by('index')
-
-    # 获取首页促销活动信息
-    promotion_banners = IndexPromotionBanner.objects.all().order_by('index')
-
-    # 获取首页分类商品展示信息
-    for type in types:
-        # 获取type种类首页分类商品的图片展示信息
-        image_banners = IndexTypeGoodsBanner.objects.filter(type=type, display_type=1).order_by('index')
-        # 获取type种类首页分类商品的文字展示信息
-        title_banners = IndexTypeGoodsBanner.objects.filter(type=type, display_type=0).order_by('index')
-        # 动态给type增加属性，分别保存首页分类商品的图片展示信息和文字展示信息
-        type.image_banners = image_banners
-        type.title_banners = title_banners
+    # 取出窗口内合并的请求次数，并允许之后的修改重新发送任务
+    pipe = conn.pipeline()
+    pipe.getset('static_index_pending', 0)
+    pipe.delete('static_index_scheduled')
+    pending = int(pipe.execute()[0] or 0)
+    # 被合并掉的生成次数
+    coalesced = max(pending - 1, 0)
+    if coalesced:
+        conn.incrby('static_index_coalesced', coalesced)
 
     # 组织模板上下文
-    context = {
-        "types": types,
-        "goods_banners": goods_banners,
-        "promotion_banners": promotion_banners,
-    }
+    context = get_index_page_data()
 
     # 1.加载模板文件,返回模板对象
     temp = loader.get_template('static_index.html')
     # 2.模板渲染
     static_index_html = temp.render(context)
 
-    # 生成首页对应的静态文件
+    # 页面内容没有变化，不需要重新写文件
+    content_hash = hashlib.md5(static_index_html.encode()).hexdigest()
+    if conn.get('static_index_hash') == content_hash.encode():
+        print('静态首页无变化，合并了%d次生成请求' % coalesced)
+        return {'coalesced': coalesced, 'written': False}
+
+    # 生成首页对应的静态文件: 先写临时文件再原子重命名，避免用户读到写了一半的文件
     save_path = os.path.join(settings.BASE_DIR, 'static/index.html')
-    with open(save_path, 'w') as f:
+    tmp_path = '%s.%d.tmp' % (save_path, os.getpid())
+    with open(tmp_path, 'w') as f:
         f.write(static_index_html)
+    os.replace(tmp_path, save_path)
+    conn.set('static_index_hash', content_hash)
+
+    print('静态首页已生成，合并了%d次生成请求' % coalesced)
+    return {'coalesced': coalesced, 'written': True}
+
+
+@app.task
+def compact_user_redis_keys():
+    """统计并回收按用户保存的redis键(购物车, 浏览记录)"""
+    from utils.redis_memory import compact_user_keys
+    report = compact_user_keys()
+    print('用户redis键: 活跃用户%d, 占用%d bytes, 每个活跃用户%d bytes' % (
+        report['active_users'], report['bytes'], report['bytes_per_active_user']))
+    return report
+
+
+# 秒杀订单写入的合并窗口(秒): 窗口内的下单请求由一次任务分批写入mysql
+FLASH_PERSIST_DEBOUNCE = 1
+
+
+def schedule_persist_flash_orders():
+    """请求写入秒杀订单(秒杀下单成功后调用)"""
+    conn = get_redis_connection('default')
+    if conn.set('flash_persist_scheduled', 1, ex=FLASH_PERSIST_DEBOUNCE + 60, nx=True):
+        persist_flash_orders.apply_async(countdown=FLASH_PERSIST_DEBOUNCE)
+
+
+@app.task
+def persist_flash_orders():
+    """把等待队列中的秒杀预占记录分批写入mysql"""
+    from order import flash_sale
+    conn = get_redis_connection('default')
+    # 允许之后的下单请求重新发送任务
+    conn.delete('flash_persist_scheduled')
+
+    persisted = released = 0
+    while True:
+        ok, failed = flash_sale.persist_batch()
+        if not ok and not failed:
+            break
+        persisted += ok
+        released += failed
+    print('秒杀订单: 写入%d, 库存不足归还%d' % (persisted, released))
+    return {'persisted': persisted, 'released': released}
+
+
+@app.task
+def reconcile_flash_orders():
+    """秒杀订单对账"""
+    from order import flash_sale
+    persisted, released = flash_sale.reconcile()
+    # 处理任务丢失时留在等待队列中的记录
+    persist_flash_orders.delay()
+    return {'persisted': persisted, 'released': released}
+
+
+@app.task
+def check_pay_result(order_id, deadline):
+    """轮询支付宝查询订单支付结果, 结果写入redis; 等待付款时间隔一段时间再查询"""
+    from order import payment
+    conn = get_redis_connection('default')
+
+    if payment.get_pay_status(order_id) == payment.PAY_PAID:
+        # 已经通过异步通知得到支付结果
+        conn.delete(payment.pay_checking_key(order_id))
+        return payment.PAY_PAID
+
+    try:
+        status = payment.query_pay_result(order_id)
+    except Exception as e:
+        # 网络错误等, 稍后重试
+        print('查询支付结果失败: %s %s' % (order_id, e))
+        status = payment.PAY_PENDING
+
+    if status == payment.PAY_PENDING and time.time() < deadline:
+        check_pay_result.apply_async((order_id, deadline), countdown=payment.PAY_CHECK_INTERVAL)
+        return status
+
+    # 得到最终结果或超时, 停止轮询
+    payment.set_pay_status(order_id, status)
+    conn.delete(payment.pay_checking_key(order_id))
+    return status
+
+
+@app.task
+def handle_order_paid(order_id):
+    """订单支付成功后的后续处理: 通知长轮询请求, 取消超时任务, 发送支付成功邮件"""
+    from order import payment, expiry
+    from order.models import OrderInfo
+    payment.set_pay_status(order_id, payment.PAY_PAID)
+    expiry.unschedule_cancel(order_id)
+
+    order = OrderInfo.objects.select_related('user').get(order_id=order_id)
+    if order.user.email:
+        subject = '天天生鲜订单支付成功'
+        message = '您的订单%s已支付成功, 金额%s元' % (order_id, order.total_price + order.transit_price)
+        send_mail(subject, message, settings.EMAIL_FROM, [order.user.email])
+
+
+@app.task
+def reconcile_pending_payments():
+    """支付对账"""
+    from order.reconciliation import reconcile_pending_payments as reconcile
+    report = reconcile()
+    print('支付对账: 查询%d个订单, 已支付%d, 更新%d, 耗时%.2fs, %.0f个/s, 最长等待%.0fs' % (
+        report['checked'], report['paid'], report['updated'], report['elapsed'], report['rate'],
+        report['max_lag']))
+    return report
+
+
+@app.task
+def cancel_expired_orders():
+    """分批取消超时未支付的订单, 归还库存"""
+    from order import expiry
+    claimed = canceled = 0
+    while True:
+        batch_claimed, batch_canceled = expiry.cancel_expired()
+        if not batch_claimed:
+            break
+        claimed += batch_claimed
+        canceled += batch_canceled
+    if claimed:
+        print('超时订单: 处理%d, 取消%d' % (claimed, canceled))
+    return {'claimed': claimed, 'canceled': canceled}
+
+
+@app.task
+def clear_goods_stock(*sku_ids):
+    """删除商品库存镜像(事务提交后的延迟删除)"""
+    from goods import stock
+    stock.clear_stock(*sku_ids)
+
+
+@app.task
+def fold_stock_buckets():
+    """把分桶商品的库存和销量汇总到商品表"""
+    from goods import stock_buckets
+    return stock_buckets.fold()
@@ -72,6 +72,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                # 页面头部公共数据(购物车商品数目, 商品分类导航)
+                'goods.context_processors.header',
             ],
         },
     },
@@ -140,6 +142,31 @@ CACHES = {
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"
 
+# 用户购物车(cart_*)和浏览记录(history_*)的闲置过期时间(秒), 每次修改时重新计时
+CART_IDLE_TTL = 90 * 24 * 3600
+HISTORY_IDLE_TTL = 30 * 24 * 3600
+
+# 订单id生成器的机器id(0~1023), 为None时每个进程启动后从redis中分配
+ORDER_ID_WORKER_ID = None
+
+# 支付宝接口配置
+ALIPAY_APPID = "2016092600601590"  # 应用id，由于我们是沙箱环境，所以直接拿沙箱应用下的APPID，实际开发环境根据自己实际应用ID填写
+# 支付宝异步通知地址(需要公网可以访问, 如 http://域名/order/notify), 为None时只能轮询支付结果
+ALIPAY_NOTIFY_URL = None
+ALIPAY_PRIVATE_KEY_PATH = os.path.join(BASE_DIR, 'apps/order/app_private_key.pem')
+ALIPAY_PUBLIC_KEY_PATH = os.path.join(BASE_DIR, 'apps/order/alipay_public_key.pem')
+ALIPAY_SIGN_TYPE = "RSA2"
+ALIPAY_DEBUG = True  # 沙箱环境
+# 支付页面地址, 沙箱环境为 https://openapi.alipaydev.com/gateway.do
+ALIPAY_GATEWAY_URL = "https://openapi.alipaydev.com/gateway.do"
+
+# 排队下单: 下单请求写入redis stream, 由 run_order_intake 进程按商品分区依次创建订单
+ORDER_INTAKE_QUEUE = False
+
+# 使用本地模拟的支付宝接口(离线压测), 第一次查询后经过ALIPAY_STUB_PAY_DELAY秒视为已付款
+ALIPAY_STUB = False
+ALIPAY_STUB_PAY_DELAY = 3
+
 
 # django自带邮件模块
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
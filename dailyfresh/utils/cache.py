@@ -0,0 +1,179 @@
+import random
+import threading
+import time
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+# 命中统计: 每个缓存键一个hash {hit, stale, miss, rebuild}, 所有worker进程累加到同一处
+STATS_KEY_PREFIX = 'cache_stats:'
+STATS_FIELDS = ('hit', 'stale', 'miss', 'rebuild')
+# 计数先在进程内累加, 每隔该时间(秒)写入redis一次, 缓存命中时不增加redis往返
+STATS_FLUSH_INTERVAL = 10
+
+
+def _decode_stats(values):
+    stats = dict.fromkeys(STATS_FIELDS, 0)
+    for name, value in values.items():
+        stats[name.decode() if isinstance(name, bytes) else name] = int(value)
+    return stats
+
+
+def all_stats():
+    """返回所有页面缓存的命中统计 {缓存键: {'hit': , 'stale': , 'miss': , 'rebuild': }}"""
+    conn = get_redis_connection('default')
+    keys = list(conn.scan_iter(match=STATS_KEY_PREFIX + '*'))
+    if not keys:
+        return {}
+    pipe = conn.pipeline()
+    for key in keys:
+        pipe.hgetall(key)
+    result = {}
+    for key, values in zip(keys, pipe.execute()):
+        key = key.decode() if isinstance(key, bytes) else key
+        result[key[len(STATS_KEY_PREFIX):]] = _decode_stats(values)
+    return result
+
+
+def reset_stats(*keys):
+    """清空命中统计, 不传缓存键时清空全部"""
+    conn = get_redis_connection('default')
+    if keys:
+        stats_keys = [STATS_KEY_PREFIX + key for key in keys]
+    else:
+        stats_keys = list(conn.scan_iter(match=STATS_KEY_PREFIX + '*'))
+    if stats_keys:
+        conn.delete(*stats_keys)
+
+
+class PageCache(object):
+    """页面上下文缓存
+
+    缓存过期后继续返回旧数据，只有拿到redis锁的一个进程负责重建，
+    避免缓存失效瞬间所有worker同时查询数据库(缓存击穿)。
+    """
+    def __init__(self, key, builder, timeout=3600, stale_timeout=600, jitter=0.1,
+                 lock_timeout=30, wait_timeout=5):
+        """
+        :param key: 缓存键
+        :param builder: 无参函数，返回需要缓存的上下文
+        :param timeout: 数据新鲜期(秒)，过期后变为旧数据
+        :param stale_timeout: 过期后仍可返回旧数据的时间(秒)
+        :param jitter: 过期时间随机浮动比例，避免多个键同时过期
+        :param lock_timeout: 重建锁的超时时间(秒)
+        :param wait_timeout: 没有旧数据可用时，等待其他进程重建的最长时间(秒)
+        """
+        self.key = key
+        self.builder = builder
+        self.timeout = timeout
+        self.stale_timeout = stale_timeout
+        self.jitter = jitter
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.lock_key = 'lock:%s' % key
+        self.stats_key = STATS_KEY_PREFIX + key
+
+        # 还没有写入redis的计数
+        self._pending = dict.fromkeys(STATS_FIELDS, 0)
+        self._flushed = time.time()
+        self._stats_lock = threading.Lock()
+
+    def get(self):
+        """获取缓存数据，必要时重建"""
+        entry = self._get_entry()
+        if entry is not None:
+            if entry['expires'] > time.time():
+                # 数据新鲜，直接返回
+                self._incr('hit')
+                return entry['data']
+
+            # 数据已过期: 抢到锁的进程重建，其他进程返回旧数据
+            self._incr('stale')
+            data = self._rebuild()
+            return entry['data'] if data is None else data
+
+        # 缓存中没有数据
+        self._incr('miss')
+        data = self._rebuild()
+        if data is not None:
+            return data
+
+        # 其他进程正在重建，等待重建结果
+        deadline = time.time() + self.wait_timeout
+        while time.time() < deadline:
+            time.sleep(0.05)
+            entry = self._get_entry()
+            if entry is not None:
+                return entry['data']
+
+        # 等待超时，自己生成数据(不写缓存)
+        return self.builder()
+
+    def invalidate(self):
+        """标记缓存数据过期，下一次访问时由一个进程重建，其余请求仍返回旧数据"""
+        entry = self._get_entry()
+        if entry is not None:
+            entry['expires'] = 0
+            cache.set(self.key, entry, self.stale_timeout)
+
+    def delete(self):
+        """彻底删除缓存数据"""
+        cache.delete(self.key)
+
+    def stats(self):
+        """返回所有进程累计的命中统计 {'hit': , 'stale': , 'miss': , 'rebuild': }(其他进程最多延迟STATS_FLUSH_INTERVAL秒)"""
+        self.flush_stats()
+        return _decode_stats(get_redis_connection('default').hgetall(self.stats_key))
+
+    def flush_stats(self):
+        """把进程内累加的计数写入redis(一次往返)"""
+        with self._stats_lock:
+            pending = self._pending
+            self._pending = dict.fromkeys(STATS_FIELDS, 0)
+            self._flushed = time.time()
+        pending = dict((name, count) for name, count in pending.items() if count)
+        if not pending:
+            return
+        try:
+            pipe = get_redis_connection('default').pipeline(transaction=False)
+            for name, count in pending.items():
+                pipe.hincrby(self.stats_key, name, count)
+            pipe.execute()
+        except Exception as e:
+            # 统计失败不影响页面
+            pass
+
+    def _get_entry(self):
+        entry = cache.get(self.key)
+        if isinstance(entry, dict) and 'expires' in entry:
+            return entry
+        return None
+
+    def _rebuild(self):
+        """拿到锁则重建缓存并返回数据，没拿到锁返回None"""
+        conn = get_redis_connection('default')
+        lock = conn.lock(self.lock_key, timeout=self.lock_timeout)
+        if not lock.acquire(blocking=False):
+            return None
+
+        try:
+            self._incr('rebuild')
+            data = self.builder()
+            # 过期时间加上随机浮动
+            timeout = self.timeout * (1 + random.uniform(-self.jitter, self.jitter))
+            entry = {'data': data, 'expires': time.time() + timeout}
+            cache.set(self.key, entry, int(timeout + self.stale_timeout))
+            return data
+        finally:
+            try:
+                lock.release()
+            except Exception as e:
+                # 锁已超时被释放
+                pass
+
+    def _incr(self, name):
+        with self._stats_lock:
+            self._pending[name] += 1
+            due = time.time() - self._flushed >= STATS_FLUSH_INTERVAL
+        if due:
+            self.flush_stats()
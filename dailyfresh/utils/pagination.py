@@ -0,0 +1,166 @@
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+class KeysetPage(object):
+    """游标分页的一页数据, 提供与django Page相同的模板接口"""
+    def __init__(self, object_list, number, has_next, has_previous, ordering):
+        self.object_list = object_list
+        self.number = number
+        self._has_next = has_next
+        self._has_previous = has_previous
+        self.ordering = ordering
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    @property
+    def next_cursor(self):
+        """下一页的游标(本页最后一条数据的排序字段值)"""
+        if not self.object_list:
+            return ''
+        return encode_cursor(self.object_list[-1], self.ordering)
+
+    @property
+    def previous_cursor(self):
+        """上一页的游标(本页第一条数据的排序字段值)"""
+        if not self.object_list:
+            return ''
+        return encode_cursor(self.object_list[0], self.ordering)
+
+
+def _field_name(field):
+    return field.lstrip('-')
+
+
+def encode_cursor(obj, ordering):
+    """把对象的排序字段值编码为游标字符串"""
+    return ','.join(str(getattr(obj, _field_name(field))) for field in ordering)
+
+
+def decode_cursor(cursor, ordering, model=None):
+    """
+    解码游标字符串, 格式不正确返回None
+    :param model: 传入时按模型字段类型转换游标中的值, 转换失败返回None
+    """
+    if not cursor:
+        return None
+    values = cursor.split(',')
+    if len(values) != len(ordering):
+        return None
+    if model is None:
+        return values
+
+    converted = []
+    for field, value in zip(ordering, values):
+        try:
+            value = model._meta.get_field(_field_name(field)).to_python(value)
+        except (ValueError, TypeError, ValidationError):
+            return None
+        if value is None or (isinstance(value, Decimal) and not value.is_finite()):
+            return None
+        converted.append(value)
+    return converted
+
+
+def keyset_filter(ordering, values, reverse=False):
+    """
+    生成"排在游标之后"的查询条件
+    ordering=['price', 'id'], values=[p, i] -> price > p or (price = p and id > i)
+    reverse=True时生成"排在游标之前"的条件
+    """
+    condition = Q()
+    for i, field in enumerate(ordering):
+        name = _field_name(field)
+        descending = field.startswith('-')
+        if reverse:
+            descending = not descending
+        lookup = '%s__%s' % (name, 'lt' if descending else 'gt')
+
+        # 前面的字段都相等, 当前字段更靠后
+        q = Q(**{lookup: values[i]})
+        for prev_field, prev_value in zip(ordering[:i], values[:i]):
+            q &= Q(**{_field_name(prev_field): prev_value})
+        condition |= q
+    return condition
+
+
+def _reverse_ordering(ordering):
+    return [field[1:] if field.startswith('-') else '-' + field for field in ordering]
+
+
+class KeysetPaginator(object):
+    """
+    游标分页: 翻到相邻页时根据上一页的最后(或第一)条数据定位, 不使用OFFSET;
+    总条数由调用者提供(可以使用缓存), 不会每次请求都执行COUNT(*)
+    ordering的最后一个字段必须唯一(如id), 保证顺序稳定
+    """
+    def __init__(self, queryset, ordering, per_page, count):
+        self.queryset = queryset.order_by(*ordering)
+        self.ordering = ordering
+        self.per_page = per_page
+        self.count = count
+
+    @property
+    def num_pages(self):
+        if self.count == 0:
+            return 1
+        return (self.count + self.per_page - 1) // self.per_page
+
+    def page(self, number, after=None, before=None):
+        """
+        获取第number页的数据
+        :param after: 上一页最后一条数据的游标(点击下一页)
+        :param before: 下一页第一条数据的游标(点击上一页)
+        游标无法解析时返回第1页
+        """
+        model = self.queryset.model
+        cursor = after or before
+        after = decode_cursor(after, self.ordering, model)
+        before = decode_cursor(before, self.ordering, model)
+        if cursor and after is None and before is None:
+            number = 1
+
+        if after is not None:
+            # 取出per_page+1条数据判断是否还有下一页
+            rows = list(self.queryset.filter(keyset_filter(self.ordering, after))[:self.per_page + 1])
+            return KeysetPage(rows[:self.per_page], number,
+                              has_next=len(rows) > self.per_page,
+                              has_previous=True,
+                              ordering=self.ordering)
+
+        if before is not None:
+            # 反向排序取出游标之前的数据, 再恢复正常顺序
+            rows = list(self.queryset.filter(keyset_filter(self.ordering, before, reverse=True))
+                        .order_by(*_reverse_ordering(self.ordering))[:self.per_page + 1])
+            object_list = rows[:self.per_page]
+            object_list.reverse()
+            return KeysetPage(object_list, number,
+                              has_next=True,
+                              has_previous=len(rows) > self.per_page,
+                              ordering=self.ordering)
+
+        # 直接跳转到某一页(点击页码)时使用OFFSET定位
+        offset = (number - 1) * self.per_page
+        rows = list(self.queryset[offset:offset + self.per_page + 1])
+        return KeysetPage(rows[:self.per_page], number,
+                          has_next=len(rows) > self.per_page,
+                          has_previous=number > 1,
+                          ordering=self.ordering)
@@ -0,0 +1,153 @@
+import re
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+# 按用户保存的redis键: (键类别, 扫描模式, 键名正则, 闲置过期时间)
+# cart_total_ 需要写在 cart_ 前面
+USER_KEY_FAMILIES = (
+    ('cart_total', 'cart_total_*', re.compile(r'^cart_total_(\d+)$'), settings.CART_IDLE_TTL),
+    ('cart', 'cart_*', re.compile(r'^cart_(\d+)$'), settings.CART_IDLE_TTL),
+    ('history', 'history_*', re.compile(r'^history_(\d+)$'), settings.HISTORY_IDLE_TTL),
+)
+
+
+def _hash_max_entries(conn):
+    """hash使用紧凑编码(ziplist/listpack)的最大元素个数"""
+    config = conn.config_get('hash-max-ziplist-entries')
+    return int(config.get('hash-max-ziplist-entries', 128))
+
+
+def _match_family(key):
+    for name, pattern, regex, ttl in USER_KEY_FAMILIES:
+        match = regex.match(key)
+        if match:
+            return name, int(match.group(1)), ttl
+    return None
+
+
+def _family_name(key):
+    match = _match_family(key)
+    return match[0] if match else None
+
+
+def _rewrite_hash(conn, key):
+    """重新写入hash, 使元素个数在紧凑编码限制内的hash恢复为紧凑编码"""
+    with conn.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            values = pipe.hgetall(key)
+            ttl = pipe.ttl(key)
+            if not values:
+                return False
+            pipe.multi()
+            pipe.delete(key)
+            pipe.hmset(key, values)
+            if ttl and ttl > 0:
+                pipe.expire(key, ttl)
+            pipe.execute()
+            return True
+        except WatchError:
+            # 重写期间被修改, 下次再处理
+            return False
+
+
+# 统计活跃用户数的HyperLogLog(固定约12KB), 不在进程内保存所有用户id
+ACTIVE_USERS_KEY = 'compact_user_keys_active'
+
+
+def compact_user_keys(batch_size=500, dry_run=False):
+    """
+    使用SCAN分批扫描按用户保存的redis键(cart_*, history_*)
+    1.统计各类键的内存占用
+    2.没有过期时间的键: 闲置超过过期时间的删除, 否则设置剩余的过期时间
+    3.元素个数在紧凑编码限制内却使用hashtable编码的购物车重新写入
+    SCAN可能返回重复的键, 只在每批内去重(不保存已扫描的键), 重复的键只会使统计偏大, 修改操作可以重复执行
+    :param dry_run: 只统计, 不修改
+    :return: 统计报告
+    """
+    conn = get_redis_connection('default')
+    max_entries = _hash_max_entries(conn)
+
+    report = {}
+    for name, pattern, regex, ttl in USER_KEY_FAMILIES:
+        report[name] = {'keys': 0, 'bytes': 0, 'active_keys': 0, 'expire_set': 0,
+                        'deleted': 0, 'deleted_bytes': 0, 'rewritten': 0, 'oversized': 0}
+    conn.delete(ACTIVE_USERS_KEY)
+
+    for name, pattern, regex, ttl in USER_KEY_FAMILIES:
+        cursor = 0
+        while True:
+            cursor, keys = conn.scan(cursor, match=pattern, count=batch_size)
+            keys = [key.decode() if isinstance(key, bytes) else key for key in keys]
+            # cart_* 也会匹配到 cart_total_*, 只处理属于当前类别的键; 批内去重
+            keys = sorted(set(key for key in keys if _family_name(key) == name))
+
+            if keys:
+                # 每批键一次往返获取闲置时间,过期时间,编码,长度,内存占用
+                pipe = conn.pipeline(transaction=False)
+                for key in keys:
+                    pipe.object('idletime', key)
+                    pipe.ttl(key)
+                    pipe.object('encoding', key)
+                    pipe.execute_command('MEMORY', 'USAGE', key)
+                results = pipe.execute()
+
+                actions = conn.pipeline(transaction=False)
+                rewrite = []
+                active_users = []
+                for i, key in enumerate(keys):
+                    idle, key_ttl, encoding, size = results[i * 4:i * 4 + 4]
+                    if idle is None:
+                        # 扫描期间已被删除
+                        continue
+                    family, user_id, family_ttl = _match_family(key)
+                    stats = report[family]
+                    size = size or 0
+                    encoding = encoding.decode() if isinstance(encoding, bytes) else encoding
+                    stats['keys'] += 1
+                    stats['bytes'] += size
+
+                    if key_ttl is None or key_ttl < 0:
+                        # 没有设置过期时间的旧数据
+                        if idle >= family_ttl:
+                            stats['deleted'] += 1
+                            stats['deleted_bytes'] += size
+                            actions.delete(key)
+                            continue
+                        stats['expire_set'] += 1
+                        actions.expire(key, family_ttl - idle)
+
+                    stats['active_keys'] += 1
+                    active_users.append(user_id)
+
+                    if family == 'cart' and encoding == 'hashtable':
+                        rewrite.append(key)
+
+                if not dry_run:
+                    actions.execute()
+                if active_users:
+                    conn.pfadd(ACTIVE_USERS_KEY, *active_users)
+
+                for key in rewrite:
+                    if conn.hlen(key) > max_entries:
+                        # 购物车条目超过紧凑编码限制, 无法压缩
+                        report['cart']['oversized'] += 1
+                    elif dry_run or _rewrite_hash(conn, key):
+                        report['cart']['rewritten'] += 1
+
+            if int(cursor) == 0:
+                break
+
+    total_bytes = sum(stats['bytes'] - stats['deleted_bytes'] for stats in report.values())
+    # 活跃用户数为HyperLogLog的估计值(误差约0.8%)
+    active_users = conn.pfcount(ACTIVE_USERS_KEY)
+    conn.delete(ACTIVE_USERS_KEY)
+    return {
+        'families': report,
+        'active_users': active_users,
+        'bytes': total_bytes,
+        'bytes_per_active_user': total_bytes // active_users if active_users else 0,
+        'dry_run': dry_run,
+    }
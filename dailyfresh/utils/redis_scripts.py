@@ -0,0 +1,124 @@
+from django.conf import settings
+from django_redis import get_redis_connection
+
+
+class RedisScript(object):
+    """redis lua脚本, 第一次调用时注册, 之后使用evalsha执行(一次网络往返)"""
+    def __init__(self, source):
+        self.source = source
+        self._script = None
+
+    def __call__(self, keys=(), args=(), conn=None):
+        if conn is None:
+            conn = get_redis_connection('default')
+        if self._script is None:
+            self._script = conn.register_script(self.source)
+        return self._script(keys=list(keys), args=list(args), client=conn)
+
+
+# 记录用户浏览历史并返回购物车商品条目数
+# KEYS[1]: history_key  KEYS[2]: cart_key
+# ARGV[1]: 商品id  ARGV[2]: 保存的浏览记录条数
+RECORD_HISTORY = RedisScript("""
+redis.call('lrem', KEYS[1], 0, ARGV[1])
+redis.call('lpush', KEYS[1], ARGV[1])
+redis.call('ltrim', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+redis.call('expire', KEYS[1], %d)
+return redis.call('hlen', KEYS[2])
+""" % settings.HISTORY_IDLE_TTL)
+
+# 购物车商品总件数保存在单独的键中, 与购物车同时修改; 不存在时根据购物车计算一次
+# 每次修改购物车后重新设置闲置过期时间
+_CART_TOTAL = """
+local function cart_total(cart_key, total_key)
+    local total = redis.call('get', total_key)
+    if total then
+        return tonumber(total)
+    end
+    total = 0
+    for _, count in ipairs(redis.call('hvals', cart_key)) do
+        total = total + tonumber(count)
+    end
+    return total
+end
+
+local function touch_cart(cart_key, total_key)
+    redis.call('expire', cart_key, %d)
+    redis.call('expire', total_key, %d)
+end
+""" % (settings.CART_IDLE_TTL, settings.CART_IDLE_TTL)
+
+# 设置购物车中商品的数量, 返回 {商品总件数, 商品条目数}
+# KEYS[1]: cart_key  KEYS[2]: cart_total_key
+# ARGV[1]: 商品id  ARGV[2]: 数量
+CART_SET = RedisScript(_CART_TOTAL + """
+local total = cart_total(KEYS[1], KEYS[2])
+local old = tonumber(redis.call('hget', KEYS[1], ARGV[1]) or 0)
+redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+total = total - old + tonumber(ARGV[2])
+redis.call('set', KEYS[2], total)
+touch_cart(KEYS[1], KEYS[2])
+return {total, redis.call('hlen', KEYS[1])}
+""")
+
+# 删除购物车中的商品, 返回商品总件数
+# KEYS[1]: cart_key  KEYS[2]: cart_total_key
+# ARGV: 商品id列表
+CART_DELETE = RedisScript(_CART_TOTAL + """
+local total = cart_total(KEYS[1], KEYS[2])
+for _, sku_id in ipairs(ARGV) do
+    local old = redis.call('hget', KEYS[1], sku_id)
+    if old then
+        total = total - tonumber(old)
+        redis.call('hdel', KEYS[1], sku_id)
+    end
+end
+redis.call('set', KEYS[2], total)
+touch_cart(KEYS[1], KEYS[2])
+return total
+""")
+
+# 添加商品到购物车: 校验库存并累加数量, 返回 {状态, 商品条目数}
+# 状态: 0 添加成功  1 库存不足  2 库存镜像中没有该商品
+# KEYS[1]: cart_key  KEYS[2]: cart_total_key  KEYS[3]: 库存镜像键
+# ARGV[1]: 商品id  ARGV[2]: 添加的数量  ARGV[3]: 库存(镜像中没有该商品时使用, 可以为空)
+CART_ADD = RedisScript(_CART_TOTAL + """
+local stock = redis.call('hget', KEYS[3], ARGV[1])
+if not stock then
+    if ARGV[3] == '' then
+        return {2, 0}
+    end
+    stock = ARGV[3]
+end
+local old = tonumber(redis.call('hget', KEYS[1], ARGV[1]) or 0)
+local count = old + tonumber(ARGV[2])
+if count > tonumber(stock) then
+    return {1, 0}
+end
+local total = cart_total(KEYS[1], KEYS[2])
+redis.call('hset', KEYS[1], ARGV[1], count)
+redis.call('set', KEYS[2], total + tonumber(ARGV[2]))
+touch_cart(KEYS[1], KEYS[2])
+return {0, redis.call('hlen', KEYS[1])}
+""")
+
+# 批量修改购物车, 返回 {商品总件数, 商品条目数}
+# KEYS[1]: cart_key  KEYS[2]: cart_total_key
+# ARGV: 商品id1, 数量1, 商品id2, 数量2, ...  数量为0表示删除该商品
+CART_BATCH = RedisScript(_CART_TOTAL + """
+local total = cart_total(KEYS[1], KEYS[2])
+for i = 1, #ARGV, 2 do
+    local sku_id = ARGV[i]
+    local count = tonumber(ARGV[i + 1])
+    local old = tonumber(redis.call('hget', KEYS[1], sku_id) or 0)
+    if count == 0 then
+        redis.call('hdel', KEYS[1], sku_id)
+    else
+        redis.call('hset', KEYS[1], sku_id, count)
+    end
+    total = total - old + count
+end
+redis.call('set', KEYS[2], total)
+touch_cart(KEYS[1], KEYS[2])
+return {total, redis.call('hlen', KEYS[1])}
+""")
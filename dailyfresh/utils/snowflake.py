@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+
+# snowflake风格的id: 41位毫秒时间戳 + 10位机器(进程)id + 12位毫秒内序号
+# 不同进程的机器id不同, 同一进程内由序号区分, 不需要访问数据库就能保证唯一
+# id按时间递增, 插入主键索引时总是追加在末尾
+EPOCH = 1546272000000  # 2019-01-01 00:00:00 (UTC+8), 毫秒
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+# 时钟回拨在该范围(毫秒)内时等待时钟追上, 超过则报错
+MAX_CLOCK_BACKWARD = 10
+
+
+class ClockMovedBackwards(Exception):
+    pass
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+class Snowflake(object):
+    """
+    线程安全的id生成器
+    :param worker_id: 机器(进程)id, 0~1023, 同时运行的进程必须不同
+    """
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError('worker_id必须在0~%d之间' % MAX_WORKER_ID)
+        self.worker_id = worker_id
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            now = _now_ms()
+            if now < self._last_ms:
+                if self._last_ms - now > MAX_CLOCK_BACKWARD:
+                    raise ClockMovedBackwards('时钟回拨%dms' % (self._last_ms - now))
+                # 短暂回拨, 继续使用上次的时间戳
+                now = self._last_ms
+
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # 本毫秒的序号用完, 等到下一毫秒
+                    while now <= self._last_ms:
+                        now = _now_ms()
+            else:
+                self._sequence = 0
+            self._last_ms = now
+
+            return ((now - EPOCH) << (WORKER_ID_BITS + SEQUENCE_BITS)) \
+                | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+    def next_str(self):
+        """补零到19位的字符串, 字符串顺序与数值顺序一致"""
+        return '%019d' % self.next_id()
+
+
+def parse_id(value):
+    """
+    解析id
+    :return: (生成时间戳(秒), 机器id, 序号)
+    """
+    value = int(value)
+    sequence = value & MAX_SEQUENCE
+    worker_id = (value >> SEQUENCE_BITS) & MAX_WORKER_ID
+    ms = (value >> (WORKER_ID_BITS + SEQUENCE_BITS)) + EPOCH
+    return ms / 1000.0, worker_id, sequence
+
+
+class ProcessSnowflake(object):
+    """
+    每个进程一个生成器, 第一次使用(以及fork出子进程后)时调用get_worker_id分配机器id
+    :param renew_worker_id: 机器id是租用的时, 每隔renew_interval秒使用前调用一次续期,
+                            返回False(租约已被其他进程持有)时重新分配机器id
+    """
+    def __init__(self, get_worker_id, renew_worker_id=None, renew_interval=60):
+        self.get_worker_id = get_worker_id
+        self.renew_worker_id = renew_worker_id
+        self.renew_interval = renew_interval
+        self._pid = None
+        self._generator = None
+        self._renewed = 0
+        self._lock = threading.Lock()
+
+    def next_str(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._generator = Snowflake(self.get_worker_id())
+                    self._pid = os.getpid()
+                    self._renewed = time.time()
+        if self.renew_worker_id is not None and time.time() - self._renewed >= self.renew_interval:
+            with self._lock:
+                if time.time() - self._renewed >= self.renew_interval:
+                    if not self.renew_worker_id(self._generator.worker_id):
+                        self._generator = Snowflake(self.get_worker_id())
+                    self._renewed = time.time()
+        return self._generator.next_str()